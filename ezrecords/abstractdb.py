@@ -1,21 +1,38 @@
 # coding: utf-8
 from __future__ import unicode_literals, print_function, absolute_import, with_statement
 import os
+import re
 import inspect
 import codecs
+import functools
+import random
+import time
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 from timeit import default_timer as timer
 from munch import Munch
 
+from ezrecords.cursors import close_rows, convert_batch, iter_fetchmany, iter_prefetched
+from ezrecords.exceptions import QueryTimeoutError, ScriptError
+from ezrecords.options import parse_options
+from ezrecords.plans import plan_warnings
 from ezrecords.records import Record, RecordCollection
+from ezrecords.scripts import split_statements
 from ezrecords.util import (
+  compile_named_params,
+  is_ddl_statement,
+  json_dumps,
   parse_db_url,
   format_timedelta,
   preg_replace,
   str_replace,
   force_unicode,
+  chunked,
 )
-from ezrecords.compat import numeric_types
+from ezrecords.compat import numeric_types, string_types
+
+# Statements EXPLAIN accepts on every dialect.
+_EXPLAINABLE = re.compile(r"^\s*\(?\s*(?:SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
 
 
 class Database(object):
@@ -42,8 +59,35 @@ class Database(object):
 
   __metaclass__ = ABCMeta
 
-  def __init__(self, db_url=None, logger=None):
-    """Connects to the database server and selects a database."""
+  #: Number of entries kept in `slow_queries`
+  SLOW_QUERY_LOG_SIZE = 100
+
+  #: Options the driver reads from the db URL's query string, as option
+  #: name to (converter, default). See `ezrecords.options`.
+  CONNECTION_OPTIONS = {}
+
+  #: Keyword arguments for `ezrecords.scripts.split_statements`, for the
+  #: dialect's quoting and comment syntax.
+  SCRIPT_SYNTAX = {}
+
+  def __init__(
+    self, db_url=None, logger=None, timeout=None, slow_query_threshold=None, metadata_ttl=300
+  ):
+    """Connects to the database server and selects a database.
+
+    Args:
+        db_url (str, optional): The database URL. Defaults to $DATABASE_URL.
+        logger (logging.Logger, optional): Logger for SQL statements and errors.
+        timeout (float, optional): Default statement timeout, in seconds,
+            applied to every query that doesn't give its own. MySQL only
+            times out SELECT statements.
+        slow_query_threshold (float, optional): Statements running for at
+            least this many seconds are explained and logged to
+            `slow_queries`.
+        metadata_ttl (float, optional): Seconds the schema metadata is
+            cached for, see `table_metadata`. None caches it until
+            `refresh()`.
+    """
     # If no db_url was provided, fallback to $DATABASE_URL.
     self.db_url = db_url or os.getenv("DATABASE_URL", None)
 
@@ -59,6 +103,9 @@ class Database(object):
     self._password = dsn_components["password"]
     self._database = dsn_components["database"]
 
+    #: Typed connection options, from the db URL's query string
+    self.options = self._parse_options(dsn_components["query"])
+
     self._collate = ""
     self._charset = ""
 
@@ -71,6 +118,13 @@ class Database(object):
     #: Flag indicating if current session is or not in transaction.
     self._in_transaction = False
 
+    #: When the current transaction began, and its open savepoints
+    self._transaction_start = None
+    self._savepoints = 0
+
+    #: Whether the current transaction ran DDL, which a rollback undoes
+    self._transaction_ddl = False
+
     #: Flag indicating whether or not Error echoing is turned on.
     # Defaults to False.
     self.show_errors = False
@@ -114,6 +168,50 @@ class Database(object):
     #: The placeholder used when preparing queries
     self._placeholder = "%s"
 
+    #: The maximum number of bound parameters a single statement may carry
+    self._max_params = 999
+
+    #: Type name of each of the driver's type codes in `cursor.description`
+    self._type_codes = {}
+
+    #: Result converters, by type name or driver type code. See `register_converter`
+    self._converters = {}
+
+    #: Converters compiled per result shape, by (column name, type code) pairs
+    self._converter_plans = {}
+
+    #: Default statement timeout in seconds. None means no timeout.
+    self.timeout = timeout
+
+    #: Statements running for at least this many seconds are explained into
+    #: `slow_queries`. None disables it.
+    self.slow_query_threshold = slow_query_threshold
+
+    #: The most recent slow statements, as dicts with their `sql`,
+    #: `seconds` and `plan`, see `explain`
+    self.slow_queries = []
+
+    #: Flag set while `explain` runs, so its EXPLAIN isn't explained
+    self._explaining = False
+
+    #: Seconds schema metadata stays cached. None means until `refresh()`.
+    self.metadata_ttl = metadata_ttl
+
+    #: Cached schema metadata, as (load time, value) by key
+    self._metadata = {}
+
+    #: INSERT/UPDATE/DELETE statements built by the DML helpers, by table
+    #: and column set. See `_dml_template`
+    self._dml_templates = {}
+
+    #: The statement timeout currently set on the session, in milliseconds.
+    #: None when unknown, e.g. after a ROLLBACK undid a SET.
+    self._session_timeout = 0
+
+    #: Counters about the work done through this connection.
+    self.stats = {}
+    self._reset_stats()
+
     # Establish database connection
     self.connect()
 
@@ -122,15 +220,32 @@ class Database(object):
     """Flag indicating if the current session is in a transaction."""
     return self._in_transaction
 
+  def _parse_options(self, query):
+    """Validates the db URL's query string against `CONNECTION_OPTIONS`."""
+    return parse_options(query, self.CONNECTION_OPTIONS)
+
   def connect(self):
-    """Establishes a database connection."""
+    """Establishes a database connection, unless there's one already.
+
+    The time taken to connect, session setup included, is recorded in
+    `stats`.
+    """
+    if self._connection is not None:
+      return
+
     if self.show_sql and self.logger:
       self.logger.debug(
         "host=%s port=%s user=%s password=%s database=%s"
         % (self._host, self._port, self._user, "***", self._database)
       )
 
+    start = timer()
     self._connect()
+    seconds = timer() - start
+
+    self.stats["connections"] += 1
+    self.stats["connect_seconds"] += seconds
+    self.stats["last_connect_seconds"] = seconds
 
   @abstractmethod
   def _connect(self):
@@ -221,76 +336,157 @@ class Database(object):
         **kwargs:
             one=True indicates that only one result should be returned
             proc=True indicates that the query is a stored procedure name
+            timeout=seconds cancels the statement if it runs longer than
+            that. Defaults to `Database.timeout`. MySQL only times out
+            SELECT statements, and raises ValueError for others given one.
+            stream=True fetches rows from the server in batches, as the
+            results are consumed, instead of all at once. Until then, or
+            until the collection is closed, the connection may not be
+            usable for other statements.
+            batch_size=n is the number of rows per batch when streaming.
+            Defaults to 1000.
+            prefetch=n, when streaming, fetches up to n batches ahead in
+            a background thread while the rows are being consumed.
+            params={...} binds values to the `:name` or `%(name)s`
+            parameters of the statement, instead of positional `*args`.
 
     Returns:
         A `RecordCollection`, which can be iterated over to get result rows
         as dictionaries, or as single `Record` if `one=True` is passed as a
         kwarg.
 
+    Raises:
+        QueryTimeoutError: If the statement exceeded its timeout.
+
     Examples:
         >>> user = db.query('SELECT * FROM users WHERE id = %s', 1, one=True)
 
         >>> user = db.query('SELECT * FROM users WHERE name = %s', name)
 
+        >>> user = db.query('SELECT * FROM users WHERE name = :name', params={'name': name})
+
         >>> db.query('sum_values', 1, 2, proc=True)
         3
 
+        >>> db.query('SELECT * FROM big_table', timeout=2.5)
+
+        >>> for row in db.query('SELECT * FROM big_table', stream=True):
+        ...   process(row)
+
+        >>> for row in db.query('SELECT * FROM big_table', stream=True, prefetch=2):
+        ...   process(row)  # meanwhile the next two batches are fetched
+
     TODO:
         * detect cases of multi queries and warn about them. Since not every
           driver supports
     """
-    self.connect()
-    cursor = self._connection.cursor()
-
     proc = kwargs.get("proc", False)
     one = kwargs.get("one", False)
+    params = kwargs.get("params")
+    if params is not None:
+      sql, args = self._bind_params(sql, args, params)
+    stream = kwargs.get("stream", False) and not proc
+    batch_size = kwargs.get("batch_size", 1000)
+    prefetch = kwargs.get("prefetch", 0)
+    timeout = self._resolve_timeout(sql, kwargs.get("timeout"))
+
+    # Tables may have changed, reload their metadata when next needed.
+    # A rollback must reload it too, if DDL ran in the transaction.
+    cached = self._metadata or self._dml_templates
+    if (cached or self._in_transaction) and is_ddl_statement(sql):
+      self._transaction_ddl = self._in_transaction
+      self.refresh()
 
-    if proc:
-      cursor.callproc(sql, args)
-      self.last_query = sql + ", ".join(map(lambda x: str(x), args))
-    else:
-      sql = self.prepare(sql)
-      # NOTE: mogrify is not a standard cursor method in PEP 249
-      self.last_query = cursor.mogrify(sql, args) if hasattr(cursor, "mogrify") else sql
-      if self.save_queries:
-        self.timer_start()
-
-      cursor.execute(sql, args)
-      if self.save_queries:
-        elapsed_time = self.timer_stop()
-        caller = inspect.stack()[1]
-        query_to_save = (
-          self.last_query,
-          elapsed_time,
-          "file %s, function %s" % (caller[1], caller[3]),
-        )
-        self.saved_queries.append(query_to_save)
-
-      self.queries_executed += 1
-
-    self.affected_rows = cursor.rowcount
-    self.last_insert_id = cursor.lastrowid
-
-    if self.show_sql and self.logger:
-      self.logger.debug("last_query: %s" % force_unicode(self.last_query))
+    self.connect()
+    cursor = self._stream_cursor() if stream else self._connection.cursor()
 
     rv = None
+    description = None
+    start = None
     try:
-      rv = cursor.fetchall()
-    except Exception:
-      pass
-      # if self.logger: self.logger.exception(exception)
-
-    cursor.close()
+      with self._statement_timeout(cursor, timeout):
+        if proc:
+          self.last_query = sql + ", ".join(map(lambda x: str(x), args))
+          cursor.callproc(sql, args)
+        else:
+          sql = self.prepare(sql)
+          # NOTE: mogrify is not a standard cursor method in PEP 249
+          self.last_query = cursor.mogrify(sql, args) if hasattr(cursor, "mogrify") else sql
+          if self.save_queries:
+            self.timer_start()
+
+          start = timer()
+          cursor.execute(sql, args)
+          if self.save_queries:
+            elapsed_time = self.timer_stop()
+            caller = inspect.stack()[1]
+            query_to_save = (
+              self.last_query,
+              elapsed_time,
+              "file %s, function %s" % (caller[1], caller[3]),
+            )
+            self.saved_queries.append(query_to_save)
+
+          self.queries_executed += 1
+
+        self.affected_rows = cursor.rowcount
+        self.last_insert_id = cursor.lastrowid
+
+        if self.show_sql and self.logger:
+          self.logger.debug("last_query: %s" % force_unicode(self.last_query))
+
+        try:
+          rv = cursor.fetchmany(batch_size) if stream else cursor.fetchall()
+        except Exception as exception:
+          # Some drivers only cancel the statement while rows are being read.
+          if timeout and self._is_timeout_error(exception):
+            raise
+          # if self.logger: self.logger.exception(exception)
+
+        # Some cursors only describe the results once rows were fetched.
+        description = cursor.description
+        if stream and description is None:
+          rv = None
+    finally:
+      if not stream or rv is None:
+        cursor.close()
+
+    # A streamed statement is still running, its time isn't known yet.
+    if self.slow_query_threshold is not None and start is not None and not stream:
+      elapsed = timer() - start
+      if elapsed >= self.slow_query_threshold and not self._explaining:
+        self._log_slow_query(sql, args, elapsed)
 
     if rv is None:
       return
 
+    converters = self._converters_for(description)
+    close = None
+    if stream and prefetch:
+      rv = iter_prefetched(cursor, rv, batch_size, prefetch, converters)
+    elif stream:
+      rv = iter_fetchmany(cursor, rv, batch_size, converters)
+    elif converters:
+      rv = convert_batch(rv, converters)
+    if stream:
+      close = functools.partial(close_rows, rv, cursor)
+
     # Row-by-row Record generator.
     row_gen = (Record(list(row.keys()), list(row.values())) for row in rv)
 
+    column_types = self._column_types_of(description)
+    if converters and column_types:
+      # Converted columns no longer hold the driver's type.
+      converted = set(name for name, _ in converters)
+      column_types = tuple(
+        None if column[0] in converted else kind
+        for column, kind in zip(description, column_types)
+      )
+
     # Convert psycopg2 results to RecordCollection.
-    results = RecordCollection(row_gen)
+    results = RecordCollection(
+      row_gen, description=description, column_types=column_types, close=close
+    )
 
     if one:
       self._last_result = results.first()
@@ -299,27 +495,432 @@ class Database(object):
 
     return self._last_result
 
-  def query_one(self, sql, *args):
+  def _bind_params(self, sql, args, params):
+    """Translates the named parameters of `sql` to positional ones.
+
+    Returns:
+        tuple: The statement with the driver's placeholders and the values
+        of `params` in the order they appear.
+    """
+    if args:
+      raise ValueError("Pass either positional args or named params, not both.")
+    sql, names = compile_named_params(sql, self._placeholder)
+    try:
+      return sql, tuple(params[name] for name in names)
+    except KeyError as exception:
+      raise ValueError("Missing value for parameter :%s." % exception.args[0])
+
+  def _stream_cursor(self):
+    """Returns a cursor that leaves the rows on the server until fetched.
+
+    Drivers without server-side cursors fall back to a regular cursor.
+    """
+    return self._connection.cursor()
+
+  def _column_types_of(self, description):
+    """Maps the type codes in the cursor's description to type names.
+
+    Returns:
+        tuple: One of 'bool', 'int', 'float', 'decimal', 'date', 'datetime',
+        'time', 'text', 'bytes' per column, or None when the driver's type
+        code is unknown or missing.
+    """
+    if description is None:
+      return None
+    return tuple(self._type_codes.get(column[1]) for column in description)
+
+  def explain(self, sql, *args, **kwargs):
+    """Returns the plan the database picks for a statement.
+
+    The plan comes from `EXPLAIN (FORMAT JSON)` on Postgres,
+    `EXPLAIN FORMAT=JSON` on MySQL and `EXPLAIN QUERY PLAN` on SQLite, and
+    is normalized into the same structure for every dialect.
+
+    Args:
+        sql (str): the statement to explain
+        *args: Values to be replace into the format string
+        **kwargs:
+            analyze=True runs the statement to report actual row counts
+            (`EXPLAIN ANALYZE`). Writes are applied, so explain them in
+            a transaction that is rolled back. SQLite has no EXPLAIN
+            ANALYZE, there the statement is run to time it.
+            timeout=seconds, see `query`
+
+    Returns:
+        dict: with the keys
+            nodes: the steps of the plan, see `ezrecords.plans`
+            warnings: full table scans and likely missing indexes
+            analyzed: whether the statement was run
+            seconds: time taken by the EXPLAIN
+            raw: the plan as returned by the database
+
+    Examples:
+        >>> plan = db.explain('SELECT * FROM users WHERE email = %s', email)
+        >>> plan['warnings']
+        ["Missing index: full scan of 'users' filtered by (email = 'a@b.c')."]
+    """
+    analyze = kwargs.get("analyze", False)
+    timeout = kwargs.get("timeout")
+
+    start = timer()
+    self._explaining = True
+    try:
+      raw, nodes, warnings = self._explain(sql, args, analyze, timeout)
+    finally:
+      self._explaining = False
+
+    return {
+      "nodes": nodes,
+      "warnings": plan_warnings(nodes) + warnings,
+      "analyzed": analyze,
+      "seconds": timer() - start,
+      "raw": raw,
+    }
+
+  def _explain(self, sql, args, analyze, timeout):
+    """Runs the dialect's EXPLAIN.
+
+    Returns:
+        tuple: (raw plan, normalized nodes, dialect specific warnings)
+    """
+    raise NotImplementedError()
+
+  def _log_slow_query(self, sql, args, seconds):
+    """Explains a statement that ran past `slow_query_threshold` and logs it."""
+    self.stats["slow_queries"] += 1
+    last_query = self.last_query
+
+    plan = None
+    if _EXPLAINABLE.match(sql):
+      # EXPLAIN is a query too, keep the caller's view of the last one.
+      state = (self.affected_rows, self.last_insert_id, self.queries_executed)
+      try:
+        if self._in_transaction:
+          # A failed EXPLAIN aborts the caller's transaction on Postgres,
+          # so roll it back to a savepoint instead.
+          with self.transaction():
+            plan = self.explain(sql, *args)
+        else:
+          plan = self.explain(sql, *args)
+      except Exception as exception:
+        if self.logger:
+          self.logger.warning("Could not explain slow query: %s" % exception)
+      finally:
+        self.affected_rows, self.last_insert_id, self.queries_executed = state
+        self.last_query = last_query
+
+    self.slow_queries.append({"sql": last_query, "seconds": seconds, "plan": plan})
+    del self.slow_queries[: -self.SLOW_QUERY_LOG_SIZE]
+
+    if self.logger:
+      warnings = " ".join(plan["warnings"]) if plan else ""
+      self.logger.warning(
+        "Slow query (%.3fs): %s %s" % (seconds, force_unicode(last_query), warnings)
+      )
+
+  def register_converter(self, type, converter):
+    """Converts the values of every result column of the given type.
+
+    Converters apply to this `Database` only, on top of the driver's own
+    conversions. They're called once per non-NULL value.
+
+    Args:
+        type (str|int): a type name ('bool', 'int', 'float', 'decimal',
+            'date', 'datetime', 'time', 'text', 'bytes') or one of the
+            driver's type codes, e.g. a Postgres type OID. Type codes take
+            precedence over type names.
+        converter (callable): receives a value, returns the converted one.
+            None removes the converter.
+
+    Examples:
+        >>> db.register_converter('decimal', float)
+        >>> db.register_converter(114, json.loads)  # Postgres json OID
+
+    Notes:
+        SQLite doesn't report column types, so converters don't apply to
+        its results.
+    """
+    if converter is None:
+      self._converters.pop(type, None)
+    else:
+      self._converters[type] = converter
+    self._converter_plans.clear()
+
+  def _converters_for(self, description):
+    """Compiles the converters that apply to a result, once per result shape.
+
+    Returns:
+        tuple: (column name, converter) pairs for the columns needing
+        conversion. Empty when none do, so rows are used as fetched.
+    """
+    if not self._converters or description is None:
+      return ()
+
+    shape = tuple((column[0], column[1]) for column in description)
+    plan = self._converter_plans.get(shape)
+    if plan is None:
+      plan = []
+      for name, type_code in shape:
+        converter = self._converters.get(type_code)
+        if converter is None:
+          converter = self._converters.get(self._type_codes.get(type_code))
+        if converter is not None:
+          plan.append((name, converter))
+      plan = tuple(plan)
+
+      if len(self._converter_plans) >= 256:
+        self._converter_plans.clear()
+      self._converter_plans[shape] = plan
+    return plan
+
+  @contextmanager
+  def _statement_timeout(self, cursor, timeout):
+    """Arms `timeout` for the statements run on `cursor` inside the block.
+
+    Raises:
+        QueryTimeoutError: If the driver cancelled a statement for running
+            past the timeout.
+    """
+    try:
+      self._set_timeout(cursor, timeout)
+      yield
+    except Exception as exception:
+      if timeout and self._is_timeout_error(exception):
+        self.stats["queries_timed_out"] += 1
+        raise QueryTimeoutError(self.last_query, timeout) from exception
+      raise
+    finally:
+      self._clear_timeout(cursor, timeout)
+
+  def _resolve_timeout(self, sql, timeout):
+    """Returns the timeout `sql` runs with: `timeout`, or `Database.timeout`
+    when it's None.
+
+    Raises:
+        ValueError: If the driver can't time out such statements.
+    """
+    return self.timeout if timeout is None else timeout
+
+  def _set_timeout(self, cursor, timeout):
+    """Arms the statement timeout for the next statement on `cursor`.
+
+    Drivers without support for statement timeouts leave this as a no-op.
+
+    Args:
+        cursor: the cursor the statement will run on
+        timeout (float): the timeout in seconds, or None for no timeout
+    """
+    pass
+
+  def _clear_timeout(self, cursor, timeout):
+    """Disarms whatever `_set_timeout` armed once the statement is done."""
+    pass
+
+  def _is_timeout_error(self, exception):
+    """Tells whether the driver exception means the statement timed out."""
+    return False
+
+  def query_one(self, sql, *args, **kwargs):
     """Perform a database query and returns the first result or None"""
+    kwargs["one"] = True
     try:
-      rv = self.query(sql, *args, one=True)
+      rv = self.query(sql, *args, **kwargs)
     except IndexError:
       return None
     return rv
 
   def query_file(self, path, **kwargs):
-    """Runs a query from the given filename"""
+    """Runs a query from the given filename
 
+    The file must hold a single statement, see `run_script` for scripts.
+    """
+    self._check_file(path)
+
+    with codecs.open(path, "r", "utf-8") as file_handle:
+      query = file_handle.read()
+
+    return self.query(query, **kwargs)
+
+  def _check_file(self, path):
     if not os.path.exists(path):
       raise IOError("File '{}' not found!".format(path))
 
     if os.path.isdir(path):
       raise IOError("'{}' is a directory!".format(path))
 
+  def run_script(self, path, batch_size=100, start=1, timeout=None):
+    """Runs the statements of a SQL script file, such as a migration.
+
+    The file is read a line at a time and split into statements, so its
+    size doesn't matter. Statements run in transactions of `batch_size`
+    statements each.
+
+    Args:
+        path (str): the script's path
+        batch_size (int): statements per transaction. Defaults to 100.
+        start (int): number of the first statement to run, counted from 1,
+            to resume a script that failed. Defaults to 1.
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`. MySQL only times out SELECT
+            statements, see `query`.
+
+    Returns:
+        list: A `(statement number, seconds)` pair per statement run.
+
+    Raises:
+        ScriptError: If a statement fails. Its batch is rolled back and
+            the error's `resume_from` is the `start` to run the rest with.
+
+    Notes:
+        MySQL commits DDL statements implicitly, so batches holding them
+        can't be rolled back. Use `batch_size=1` for such scripts.
+
+    Examples:
+        >>> db.run_script('migrations/0042_orders.sql', batch_size=500)
+
+        >>> db.run_script('migrations/0042_orders.sql', start=error.resume_from)
+    """
+    self._check_file(path)
+
+    self.connect()
+    timings = []
     with codecs.open(path, "r", "utf-8") as file_handle:
-      query = file_handle.read()
+      batch = []
+      for number, (line, sql) in enumerate(self._script_statements(file_handle), 1):
+        if number < start:
+          continue
+        batch.append((number, line, sql))
+        if len(batch) == batch_size:
+          self._run_statements(batch, timeout, timings)
+          batch = []
+      if batch:
+        self._run_statements(batch, timeout, timings)
+
+    # Scripts usually change the schema.
+    self.refresh()
+    return timings
+
+  def _script_statements(self, lines):
+    """Yields the `(line, statement)` pairs of a script's lines."""
+    return split_statements(lines, **self.SCRIPT_SYNTAX)
+
+  def _run_statements(self, batch, timeout, timings):
+    seconds = []
+    try:
+      self._run_script_batch([sql for _, _, sql in batch], timeout, seconds)
+    except Exception as exception:
+      # Every statement before the failed one timed itself.
+      number, line, sql = batch[min(len(seconds), len(batch) - 1)]
+      raise ScriptError(number, line, sql, batch[0][0], exception) from exception
+    timings.extend(zip([number for number, _, _ in batch], seconds))
+
+  def _run_script_batch(self, statements, timeout, seconds):
+    """Runs a batch of script statements in one transaction.
+
+    Appends the time each statement took to `seconds` as it completes.
+    Statements are sent as they are, with no parameters to interpolate.
+    """
+    with self.transaction():
+      cursor = self._connection.cursor()
+      try:
+        for sql in statements:
+          self.last_query = sql
+          start = timer()
+          with self._statement_timeout(cursor, self._resolve_timeout(sql, timeout)):
+            cursor.execute(sql)
+          seconds.append(timer() - start)
+          self.queries_executed += 1
+      finally:
+        cursor.close()
+
+  def query_in(self, sql, column, values, *args, **kwargs):
+    """Runs a query testing whether `column` is in a list of values.
+
+    Writing `IN (%s, %s, ...)` by hand gives a different statement for
+    every list length, which defeats the driver's statement cache, and
+    fails past its parameter limit. Here the driver writes the condition
+    in place of the `{in}` marker: Postgres binds the list as one array,
+    the others pad it to the next power of two so a handful of statement
+    texts cover every length. Lists too long for one statement are split
+    and the query runs once per chunk.
 
-    return self.query(query, **kwargs)
+    Args:
+        sql (str): the statement, with `{in}` where the condition goes
+        column (str): the column to test
+        values (iterable): the values to look for
+        *args: values for the statement's other placeholders, in order
+        **kwargs: passed on to `query`, `params` included. Streaming
+            isn't supported.
+
+    Returns:
+        A `RecordCollection` with the rows of every chunk, None if the
+        statement returns no rows, or a single `Record` if `one=True` is
+        given. `affected_rows` is the total of every chunk.
+
+    Examples:
+        >>> db.query_in('SELECT * FROM users WHERE {in} AND active = %s', 'id', ids, True)
+
+        >>> db.query_in('UPDATE users SET active = :active WHERE {in}', 'id', ids,
+        ...   params={'active': False})
+    """
+    if kwargs.get("stream"):
+      raise ValueError("query_in can't stream, the rows may come from several queries.")
+    one = kwargs.pop("one", False)
+    params = kwargs.pop("params", None)
+    if params is not None:
+      sql, args = self._bind_params(sql, args, params)
+
+    before, marker, after = sql.partition("{in}")
+    if not marker:
+      raise ValueError("The statement must have an {in} marker for the condition.")
+    # Positional values before the marker are bound before the list's.
+    split = before.count(self._placeholder)
+    head, tail = tuple(args[:split]), tuple(args[split:])
+
+    values = list(values)
+    if values:
+      conditions = self._in_conditions(column, values, max(self._max_params - len(args), 1))
+    else:
+      conditions = [("1 = 0", [])]
+
+    chunks = []
+    affected_rows = 0
+    for condition, chunk_args in conditions:
+      results = self.query(before + condition + after, *(head + tuple(chunk_args) + tail), **kwargs)
+      affected_rows += self.affected_rows
+      chunks.append(results)
+
+    self.affected_rows = affected_rows
+    if chunks[0] is None:
+      return None
+    if len(chunks) == 1:
+      results = chunks[0]
+    else:
+      results = RecordCollection(
+        iter([row for chunk in chunks for row in chunk]),
+        description=chunks[0].description,
+        column_types=chunks[0].column_types,
+      )
+    return results.first() if one else results
+
+  def _in_conditions(self, column, values, max_params):
+    """Writes the condition testing `column` against `values`.
+
+    Lists are padded to the next power of two by repeating their last
+    value, and split in chunks of the largest power of two that fits in
+    `max_params`.
+
+    Returns:
+        list: A `(condition, args)` pair per chunk of `values`.
+    """
+    chunk_size = 1 << (max_params.bit_length() - 1)
+    conditions = []
+    for chunk in chunked(values, chunk_size):
+      size = 1 << (len(chunk) - 1).bit_length()
+      chunk.extend([chunk[-1]] * (size - len(chunk)))
+      condition = '"%s" IN (%s)' % (column, ", ".join([self._placeholder] * size))
+      conditions.append((condition, chunk))
+    return conditions
 
   def call_procedure(self, procedure, *args):
     """Runs a stored procedure.
@@ -337,11 +938,147 @@ class Database(object):
     """
     return self.query(procedure, *args, proc=True)
 
+  def executemany(self, sql, values, timeout=None):
+    """Runs a statement once for every row of parameters in `values`.
+
+    The whole sequence is handed to the driver in a single call, so the
+    statement is parsed once and nothing is fetched in between.
+
+    Args:
+        sql (str): the SQL statement
+        values (iterable): rows of values for the statement's placeholders
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`. Not supported on MySQL, see
+            `query`.
+
+    Returns:
+        int: The number of rows affected.
+
+    Examples:
+        >>> db.executemany('UPDATE users SET name = %s WHERE id = %s', [('a', 1), ('b', 2)])
+    """
+    timeout = self._resolve_timeout(sql, timeout)
+
+    self.connect()
+    cursor = self._connection.cursor()
+
+    sql = self.prepare(sql)
+    self.last_query = sql
+
+    try:
+      with self._statement_timeout(cursor, timeout):
+        cursor.executemany(sql, [tuple(row) for row in values])
+      self.affected_rows = cursor.rowcount
+    finally:
+      cursor.close()
+
+    self.queries_executed += 1
+
+    if self.show_sql and self.logger:
+      self.logger.debug("last_query: %s" % force_unicode(self.last_query))
+
+    return self.affected_rows
+
+  def iter_pages(
+    self,
+    table_or_query,
+    key_columns,
+    page_size=1000,
+    after=None,
+    records=False,
+    timeout=None,
+  ):
+    """Pages through a table or query in key order using keyset pagination.
+
+    Each page starts right after the key of the previous page's last row
+    (`WHERE key > last_key ORDER BY key LIMIT page_size`) instead of using
+    OFFSET, so with an index on the key every page costs the same no matter
+    how deep into the table it is.
+
+    Args:
+        table_or_query (str): a table name, or a SELECT whose result columns
+            include `key_columns`
+        key_columns (str|tuple|list): the column, or columns of a composite
+            key, to order and seek by. They must uniquely identify a row.
+        page_size (int, optional): rows per page
+        after (tuple, optional): key of the last row already processed, to
+            resume a previous scan. Defaults to starting from the beginning.
+        records (bool, optional): yield individual `Record`s instead of pages
+        timeout (float, optional): Statement timeout, in seconds, per page.
+            Defaults to `Database.timeout`
+
+    Yields:
+        `RecordCollection` pages, or `Record`s if `records=True`.
+
+    Examples:
+        >>> for page in db.iter_pages('events', ['created_at', 'id'], 5000):
+        ...   process(page)
+        ...   checkpoint = (page[-1].created_at, page[-1].id)
+
+        >>> for event in db.iter_pages('events', 'id', after=(checkpoint,), records=True):
+        ...   process(event)
+    """
+    if isinstance(key_columns, string_types):
+      key_columns = [key_columns]
+    key_columns = list(key_columns)
+
+    if len(table_or_query.split()) == 1:
+      source = '"%s"' % table_or_query
+    else:
+      source = "(%s) AS _page" % table_or_query.strip().rstrip(";")
+
+    order = ", ".join('"%s"' % column for column in key_columns)
+    first_page = "SELECT * FROM %s ORDER BY %s LIMIT %d" % (source, order, page_size)
+    next_page = "SELECT * FROM %s WHERE %s ORDER BY %s LIMIT %d" % (
+      source,
+      self._keyset_condition(key_columns),
+      order,
+      page_size,
+    )
+
+    last_key = tuple(after) if after is not None else None
+    while True:
+      if last_key is None:
+        rows = self.query(first_page, timeout=timeout)
+      else:
+        rows = self.query(next_page, *self._keyset_values(last_key), timeout=timeout)
+
+      page = rows.all()
+      if not page:
+        return
+
+      if records:
+        for record in page:
+          yield record
+      else:
+        yield rows
+
+      if len(page) < page_size:
+        return
+      last_key = tuple(page[-1][column] for column in key_columns)
+
+  def _keyset_condition(self, key_columns):
+    """Builds the condition selecting rows whose key comes after a given key.
+
+    Row value comparison, `(a, b) > (%s, %s)`, is used by default.
+    """
+    if len(key_columns) == 1:
+      return '"%s" > %s' % (key_columns[0], self._placeholder)
+
+    return "(%s) > (%s)" % (
+      ", ".join('"%s"' % column for column in key_columns),
+      ", ".join([self._placeholder] * len(key_columns)),
+    )
+
+  def _keyset_values(self, last_key):
+    """Returns the parameters for the condition of `_keyset_condition`."""
+    return last_key
+
   # ------------------------------------------------------------------
   # DML
   # ------------------------------------------------------------------
 
-  def get_var(self, query, column_offset=0, row_offset=0):
+  def get_var(self, query, column_offset=0, row_offset=0, timeout=None):
     """Retrieve one variable from the database.
 
     Executes a SQL query and returns the value from the SQL result.
@@ -352,6 +1089,8 @@ class Database(object):
             Defaults to 0
         row_offset (int, optional): Row of value to return. Indexed from 0.
             Defaults to 0
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
 
     Returns:
         Database query result (as string)
@@ -360,11 +1099,11 @@ class Database(object):
         >>> db.get_var('SELECT version()')
         5.7.15
     """
-    rows = self.query(query)
+    rows = self.query(query, timeout=timeout)
 
     return rows[row_offset][column_offset]
 
-  def get_row(self, query, output_type="record", row_offset=0):
+  def get_row(self, query, output_type="record", row_offset=0, timeout=None):
     """Retrieve one row from the database.
 
     Executes a SQL query and returns the row from the SQL result.
@@ -375,6 +1114,8 @@ class Database(object):
             One of 'record', 'dict', 'dataset', 'object.'
         row_offset (int, optional): Row to return. Indexed from 0.
             Defaults to 0.
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
 
     Returns:
         Database query result in format specified by `output_type`
@@ -383,7 +1124,7 @@ class Database(object):
         Get the second row from the first 10 users
         >>> db.get_row('SELECT * FROM users LIMIT 10', 'object', 1)
     """
-    rows = self.query(query)
+    rows = self.query(query, timeout=timeout)
     row = rows[row_offset]
 
     if output_type == "record":
@@ -397,13 +1138,15 @@ class Database(object):
 
     return None
 
-  def get_col(self, query, column_offset=0):
+  def get_col(self, query, column_offset=0, timeout=None):
     """Retrieve one column from the database.
     Executes a SQL query and returns the column from the SQL result.
 
     Args:
         query(str): SQL query
         column_offset(int, optional): Column to return. Indexed from 0
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
 
     Returns:
         List indexed from 0 by SQL result row number.
@@ -412,12 +1155,12 @@ class Database(object):
         Get the user mails of all moderators
         >>> db.get_col("SELECT id, username, email FROM users WHERE role='moderator'", 2)
     """
-    rows = self.query(query)
+    rows = self.query(query, timeout=timeout)
     column = list(map(lambda x: x[column_offset], rows))
 
     return column
 
-  def get_results(self, query, output_type="record"):
+  def get_results(self, query, output_type="record", timeout=None):
     """Retrieve an entire SQL result set from the database (i.e., many rows)
 
     Executes a SQL query and returns the entire SQL result.
@@ -426,6 +1169,8 @@ class Database(object):
         query (str): SQL query
         output_type(str, optional): The required output type for the records.
             One of 'record', 'dict', 'dataset', 'object.'
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
 
     Returns:
         list: Database query results with values of the indicated `output_type`
@@ -433,7 +1178,7 @@ class Database(object):
     Examples:
         >>> db.get_results('SELECT * FROM users', 'object')
     """
-    rows = self.query(query)
+    rows = self.query(query, timeout=timeout)
     output_rows = []
 
     for row in rows:
@@ -448,13 +1193,15 @@ class Database(object):
 
     return output_rows
 
-  def insert(self, table, data=None, **kwargs):
+  def insert(self, table, data=None, timeout=None, **kwargs):
     """Inserts a single row into a table.
 
     Args:
         table (str): Table name
         data (dict): Data to insert in column, value pairs
             Sending a None value will cause the column to be set to NULL
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
         **kwargs: Arbitrary column, value pairs of data to insert as
             keyword arguments
 
@@ -469,51 +1216,231 @@ class Database(object):
     if data is not None:
       kwargs.update(data)
 
-    values = kwargs.values()
-
-    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
-      table,
-      ", ".join(kwargs.keys()),
-      ", ".join([self._placeholder] * len(values)),
-    )
-
-    self.query(sql, *values)
+    template = self._dml_template("insert", table, kwargs)
+    self.query(template["sql"], *self._template_values(template, kwargs), timeout=timeout)
 
     return self.affected_rows
 
-  def bulk_insert(self, table, columns, values):
+  def bulk_insert(self, table, columns, values, timeout=None, batch_size=1000, returning=None):
     """Bulk insert
 
+    Rows are sent in multi-row statements of at most `batch_size` rows, or
+    fewer when needed to stay under the driver's parameter limit.
+
     Args:
         table (str): Table name
         columns (tuple|list): columns to insert
         values (tuple|list): values to insert
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
+        batch_size (int, optional): maximum rows per statement
+        returning (tuple|list, optional): columns of the inserted rows to
+            return, like generated ids. On MySQL, only the AUTO_INCREMENT
+            column, and only when innodb_autoinc_lock_mode is 0 or 1;
+            with 2 (the MySQL 8 default) a ValueError is raised.
 
     Returns:
-        int: The number of rows inserted (1) or -1 on error.
+        int: The number of rows inserted or, with `returning`, a
+        `RecordCollection` of the returned columns, one per row in the
+        order the rows were given.
 
     Examples:
         >>> db.bulk_insert('table', (column, column2), [(value1, value2), (value3, value4)])
         >>> db.bulk_insert('table', [column, column2], [(value1, value2), (value1, value2)])
+        >>> ids = [row.id for row in db.bulk_insert('users', ['name'], names, returning=['id'])]
     """
-
+    rows_per_batch = max(1, min(batch_size, self._max_params // len(columns)))
+
+    start = timer()
+    rows = inserted = 0
+    returned = []
+    for batch in chunked(values, rows_per_batch):
+      if returning:
+        returned.extend(self._insert_returning(table, columns, batch, returning, timeout))
+      else:
+        sql = self._insert_sql(table, columns, len(batch))
+        self.query(sql, *[value for row in batch for value in row], timeout=timeout)
+      rows += len(batch)
+      inserted += self.affected_rows
+
+    self.affected_rows = inserted
+    self._record_bulk("bulk_insert", rows, inserted, start)
+    if returning:
+      return RecordCollection(iter(returned))
+    return inserted
+
+  def _insert_sql(self, table, columns, rows):
+    """Builds an INSERT of `rows` rows of `columns`."""
     single_values = "(" + ", ".join([self._placeholder] * len(columns)) + ")"
-
-    sql = "INSERT INTO %s (%s) VALUES %s" % (
+    return "INSERT INTO %s (%s) VALUES %s" % (
       table,
       ", ".join(columns),
-      ", ".join([single_values] * len(values)),
+      ", ".join([single_values] * rows),
     )
 
-    all_values = []
-    for value in values:
-      all_values.extend(list(value))
+  def _insert_returning(self, table, columns, batch, returning, timeout):
+    """Inserts one batch of rows and returns their `returning` columns.
 
-    self.query(sql, *tuple(all_values))
+    Returns:
+        list: one `Record` per row, in the order of `batch`
+    """
+    sql = self._insert_sql(table, columns, len(batch)) + " RETURNING " + ", ".join(returning)
+    rows = self.query(sql, *[value for row in batch for value in row], timeout=timeout).all()
+    # Some drivers only count the rows once they were all fetched.
+    self.affected_rows = len(rows)
+    return rows
 
-    return self.affected_rows
+  def upsert(self, table, data, conflict_columns, update_columns=None, timeout=None):
+    """Inserts a row or, if it conflicts with an existing one, updates it.
 
-  def delete(self, table, where=None, **kwargs):
+    Args:
+        table (str): Table name
+        data (dict): Data to insert in column, value pairs
+        conflict_columns (tuple|list): columns of the unique or primary key
+            that identify an existing row
+        update_columns (tuple|list, optional): columns to overwrite on
+            conflict. Defaults to every column in `data` outside of
+            `conflict_columns`. When empty, conflicting rows are left as is.
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
+
+    Returns:
+        dict: The number of rows 'inserted' and 'updated'.
+
+    Examples:
+        >>> db.upsert('users', {'email': 'scott@example.com', 'name': 'Scott'}, ['email'])
+        {'inserted': 1, 'updated': 0}
+    """
+    columns = list(data.keys())
+    return self.bulk_upsert(
+      table,
+      columns,
+      [[data[column] for column in columns]],
+      conflict_columns,
+      update_columns,
+      timeout=timeout,
+    )
+
+  def bulk_upsert(
+    self,
+    table,
+    columns,
+    values,
+    conflict_columns,
+    update_columns=None,
+    batch_size=1000,
+    timeout=None,
+  ):
+    """Inserts many rows, updating the ones that conflict with existing rows.
+
+    Rows are sent in multi-row statements of at most `batch_size` rows, or
+    fewer when needed to stay under the driver's parameter limit.
+
+    Args:
+        table (str): Table name
+        columns (tuple|list): columns to insert
+        values (tuple|list): rows of values to insert
+        conflict_columns (tuple|list): columns of the unique or primary key
+            that identify an existing row
+        update_columns (tuple|list, optional): columns to overwrite on
+            conflict. Defaults to every column outside of `conflict_columns`.
+            When empty, conflicting rows are left as is.
+        batch_size (int, optional): maximum rows per statement
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
+
+    Returns:
+        dict: The number of rows 'inserted' and 'updated'.
+
+    Examples:
+        >>> db.bulk_upsert('users', ('email', 'name'), [('a@b.c', 'A'), ('d@e.f', 'D')], ['email'])
+    """
+    if update_columns is None:
+      update_columns = [column for column in columns if column not in conflict_columns]
+
+    single_values = "(" + ", ".join([self._placeholder] * len(columns)) + ")"
+    rows_per_batch = max(1, min(batch_size, self._max_params // len(columns)))
+
+    counts = {"inserted": 0, "updated": 0}
+    for batch in chunked(values, rows_per_batch):
+      sql = "INSERT INTO \"%s\" (%s) VALUES %s%s" % (
+        table,
+        ", ".join('"%s"' % column for column in columns),
+        ", ".join([single_values] * len(batch)),
+        self._upsert_clause(conflict_columns, update_columns),
+      )
+
+      inserted, updated = self._run_upsert(
+        table, sql, columns, batch, conflict_columns, update_columns, timeout
+      )
+      counts["inserted"] += inserted
+      counts["updated"] += updated
+
+    self.affected_rows = counts["inserted"] + counts["updated"]
+    return counts
+
+  def _upsert_clause(self, conflict_columns, update_columns):
+    """Builds the conflict handling clause appended to the INSERT."""
+    clause = " ON CONFLICT (%s) " % ", ".join('"%s"' % c for c in conflict_columns)
+    if not update_columns:
+      return clause + "DO NOTHING"
+
+    return clause + "DO UPDATE SET " + ", ".join(
+      '"%s" = EXCLUDED."%s"' % (column, column) for column in update_columns
+    )
+
+  def _run_upsert(self, table, sql, columns, batch, conflict_columns, update_columns, timeout):
+    """Runs one upsert batch.
+
+    Drivers that can't tell inserted from updated rows in the statement's
+    result count the conflicting keys right before the upsert, in the same
+    transaction. In-process engines such as SQLite pay no round-trip for it.
+
+    The counts are exact as long as no other connection writes the counted
+    keys in between. SQLite has a single writer, so it's the case there;
+    drivers on other engines should lock the keys, see `_count_existing`.
+
+    Returns:
+        tuple: The number of rows inserted and updated.
+    """
+    with self.transaction():
+      existing = 0
+      if update_columns:
+        existing = self._count_existing(table, columns, batch, conflict_columns, timeout)
+      self.query(sql, *[value for row in batch for value in row], timeout=timeout)
+      affected_rows = self.affected_rows
+    return affected_rows - existing, existing
+
+  def _count_existing(self, table, columns, batch, conflict_columns, timeout, lock=False):
+    """Counts the rows of `table` whose conflict key is in `batch`.
+
+    With `lock`, the counted rows, and the gaps of the missing keys, stay
+    locked FOR UPDATE until the transaction ends.
+    """
+    key_indexes = [list(columns).index(column) for column in conflict_columns]
+    keys = [[row[i] for i in key_indexes] for row in batch]
+
+    single_key = "(" + ", ".join([self._placeholder] * len(key_indexes)) + ")"
+    if len(key_indexes) == 1:
+      condition = '"%s" IN (%s)' % (
+        conflict_columns[0],
+        ", ".join([self._placeholder] * len(keys)),
+      )
+    else:
+      condition = "(%s) IN (VALUES %s)" % (
+        ", ".join('"%s"' % c for c in conflict_columns),
+        ", ".join([single_key] * len(keys)),
+      )
+
+    rows = self.query(
+      'SELECT count(*) AS existing FROM "%s" WHERE %s%s'
+      % (table, condition, " FOR UPDATE" if lock else ""),
+      *[value for key in keys for value in key],
+      timeout=timeout,
+    )
+    return rows[0][0]
+
+  def delete(self, table, where=None, timeout=None, **kwargs):
     """Deletes rows in the table.
 
     Args:
@@ -521,6 +1448,8 @@ class Database(object):
         where (dict): Dictionary of WHERE clauses in column, value pairs
             Multiple clauses will be joined with ANDs.
             Sending a None value will create an IS NULL comparison.
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
         **kwargs: Arbitrary column, value pairs to use as WHERE clauses
 
     Returns:
@@ -535,27 +1464,12 @@ class Database(object):
     if where is not None:
       kwargs.update(where)
 
-    conditions, values = [], []
-    for field, value in kwargs.items():
-      if value is None:
-        conditions.append('"%s" IS NULL' % field)
-        continue
-
-      conditions.append('"' + field + '" = ' + self._placeholder)
-      values.append(value)
-
-    conditions = " AND ".join(conditions)
-
-    sql = 'DELETE FROM "%s" ' % table
-    if conditions:
-      where_clause = " WHERE %s" % conditions
-      sql += where_clause
-
-    self.query(sql, *values)
+    template = self._dml_template("delete", table, where=kwargs)
+    self.query(template["sql"], *self._template_values(template, where=kwargs), timeout=timeout)
 
     return self.affected_rows
 
-  def update(self, table, data, where):
+  def update(self, table, data, where, timeout=None):
     """Update rows in the table.
 
     Args:
@@ -565,6 +1479,8 @@ class Database(object):
         where (dict): Dictionary of WHERE clauses in column, value pairs
             Multiple clauses will be joined with ANDs.
             Sending a None value will create an IS NULL comparison.
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
 
     Returns:
         int: The number of rows updated, or -1 on error.
@@ -576,59 +1492,428 @@ class Database(object):
     if not isinstance(data, dict) or not isinstance(where, dict):
       return False
 
-    fields, conditions, values = [], [], []
+    if not where:
+      raise ValueError("update requires at least one WHERE column.")
 
-    for field, value in data.items():
-      if value is None:
-        fields.append('"%s" = NULL' % field)
-        continue
+    template = self._dml_template("update", table, data, where)
+    self.query(template["sql"], *self._template_values(template, data, where), timeout=timeout)
 
-      fields.append('"' + field + '" = ' + self._placeholder)
-      values.append(value)
+    return self.affected_rows
+
+  def _dml_template(self, operation, table, data=None, where=None):
+    """Returns the statement of an `insert`, `update` or `delete`.
+
+    Statements are built once per table and set of columns, with the
+    columns in table order whatever the order of the dicts, so the same
+    logical statement always has the same SQL text and the driver's and
+    server's statement caches can reuse it. Columns are validated against
+    the table metadata, and the type coercions picked, at that time too.
 
-    for field, value in where.items():
-      if value is None:
-        conditions.append('"%s" IS NULL' % field)
-        continue
+    Args:
+        operation (str): 'insert', 'update' or 'delete'
+        table (str): the table name
+        data (dict): the column values to write
+        where (dict): the WHERE column values. NULLs compare with IS NULL,
+            so they're part of the statement's identity.
+
+    Returns:
+        dict: with the `sql`, the `columns` and `conditions` whose values
+        are bound, in order, and the `coercers` of the columns, or None
+        if no column needs any.
 
-      conditions.append('"' + field + '" = ' + self._placeholder)
-      values.append(value)
+    Raises:
+        ValueError: If a column isn't in the table.
+    """
+    data = data or {}
+    where = where or {}
+    null_conditions = frozenset(field for field, value in where.items() if value is None)
+    key = (operation, table, frozenset(data), frozenset(where), null_conditions)
+    template = self._dml_templates.get(key)
+    if template is not None:
+      return template
+
+    metadata = self.table_metadata(table)
+    declared = metadata["columns"] if metadata else {}
+    columns = self._canonical_columns(table, declared, data)
+    conditions = self._canonical_columns(table, declared, where)
+
+    clauses = []
+    for field in conditions:
+      if field in null_conditions:
+        clauses.append('"%s" IS NULL' % field)
+      else:
+        clauses.append('"%s" = %s' % (field, self._placeholder))
+    where_clause = " WHERE " + " AND ".join(clauses) if clauses else ""
+
+    if operation == "insert":
+      sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        table,
+        ", ".join(columns),
+        ", ".join([self._placeholder] * len(columns)),
+      )
+    elif operation == "update":
+      sql = 'UPDATE "%s" SET %s%s' % (
+        table,
+        ", ".join('"%s" = %s' % (field, self._placeholder) for field in columns),
+        where_clause,
+      )
+    else:
+      sql = 'DELETE FROM "%s"%s' % (table, where_clause)
 
-    fields = ", ".join(fields)
-    conditions = " AND ".join(conditions)
+    declared_types = dict((name.lower(), kind) for name, kind in declared.items())
+    coercers = tuple(self._coercer_for(declared_types.get(field.lower())) for field in columns)
 
-    sql = 'UPDATE "%s" SET %s WHERE %s' % (table, fields, conditions)
+    template = {
+      "sql": sql,
+      "columns": columns,
+      "conditions": [field for field in conditions if field not in null_conditions],
+      "coercers": coercers if any(coercers) else None,
+    }
 
-    self.query(sql, *values)
+    if len(self._dml_templates) >= 1024:
+      self._dml_templates.clear()
+    self._dml_templates[key] = template
+    return template
 
-    return self.affected_rows
+  def _canonical_columns(self, table, declared, fields):
+    """Orders `fields` as the table declares them.
+
+    Names are matched case-insensitively, as unquoted identifiers are. When
+    the table's metadata isn't available they're sorted by name instead.
+    """
+    if not declared:
+      return sorted(fields)
+
+    positions = dict((name.lower(), position) for position, name in enumerate(declared))
+    unknown = [field for field in fields if field.lower() not in positions]
+    if unknown:
+      raise ValueError("Unknown column(s) %s in table '%s'." % (", ".join(sorted(unknown)), table))
+    return sorted(fields, key=lambda field: positions[field.lower()])
+
+  def _coercer_for(self, declared_type):
+    """Returns the function adapting values bound to a column of the given
+    declared type, or None when the driver can bind them as they are."""
+    if declared_type and declared_type.lower().startswith("json"):
+      return _coerce_json
+    return None
+
+  def _template_values(self, template, data=None, where=None):
+    """Returns the parameters of a `_dml_template`, in order."""
+    values = [data[field] for field in template["columns"]]
+    if template["coercers"] is not None:
+      values = [
+        value if coerce is None or value is None else coerce(value)
+        for coerce, value in zip(template["coercers"], values)
+      ]
+    values.extend(where[field] for field in template["conditions"])
+    return values
+
+  def bulk_update(self, table, rows, key_columns, batch_size=1000, timeout=None):
+    """Updates many rows, each one identified by its key columns.
+
+    Every row must carry the same columns. Rows are sent in batches of at
+    most `batch_size` rows, or fewer when needed to stay under the driver's
+    parameter limit.
+
+    Args:
+        table (str): Table name
+        rows (list): dicts of column, value pairs. Besides the new values,
+            each one holds the values of `key_columns` identifying the row.
+        key_columns (tuple|list): columns identifying the row to update
+        batch_size (int, optional): maximum rows per statement
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
+
+    Returns:
+        int: The number of rows updated.
+
+    Examples:
+        >>> db.bulk_update('users', [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}], ['id'])
+    """
+    rows = list(rows)
+    if not rows:
+      return 0
+
+    columns = [column for column in rows[0].keys() if column not in key_columns]
+    expected = set(columns) | set(key_columns)
+    for number, row in enumerate(rows):
+      for column in key_columns:
+        if column not in row:
+          raise ValueError("Row %s given to bulk_update has no '%s' column." % (number, column))
+      if set(row) != expected:
+        column = sorted(set(row) ^ expected)[0]
+        raise ValueError(
+          "All rows given to bulk_update must have the same columns, row %s differs in '%s'."
+          % (number, column)
+        )
+
+    start = timer()
+    affected_rows = self._bulk_update(table, rows, list(key_columns), columns, batch_size, timeout)
+    self._record_bulk("bulk_update", len(rows), affected_rows, start)
+    return affected_rows
+
+  def _bulk_update(self, table, rows, key_columns, columns, batch_size, timeout):
+    """Updates the rows with one CASE expression per column, per batch.
+
+    Returns:
+        int: The number of rows updated.
+    """
+    if len(key_columns) == 1:
+      match = '"%s" = %s' % (key_columns[0], self._placeholder)
+      key_list = '"%s" IN (%%s)' % key_columns[0]
+      single_key = self._placeholder
+    else:
+      match = "(" + " AND ".join('"%s" = %s' % (k, self._placeholder) for k in key_columns) + ")"
+      key_list = "(" + ", ".join('"%s"' % k for k in key_columns) + ") IN (%s)"
+      single_key = "(" + ", ".join([self._placeholder] * len(key_columns)) + ")"
+
+    params_per_row = len(columns) * (len(key_columns) + 1) + len(key_columns)
+    rows_per_batch = max(1, min(batch_size, self._max_params // params_per_row))
+
+    affected_rows = 0
+    for batch in chunked(rows, rows_per_batch):
+      assignments, values = [], []
+      for column in columns:
+        cases = []
+        for row in batch:
+          cases.append("WHEN %s THEN %s" % (match, self._placeholder))
+          values.extend([row[k] for k in key_columns] + [row[column]])
+        assignments.append('"%s" = CASE %s ELSE "%s" END' % (column, " ".join(cases), column))
+
+      for row in batch:
+        values.extend(row[k] for k in key_columns)
+
+      sql = 'UPDATE "%s" SET %s WHERE %s' % (
+        table,
+        ", ".join(assignments),
+        key_list % ", ".join([single_key] * len(batch)),
+      )
+      self.query(sql, *values, timeout=timeout)
+      affected_rows += self.affected_rows
+
+    self.affected_rows = affected_rows
+    return affected_rows
+
+  def bulk_delete(self, table, key_column, keys, batch_size=None, timeout=None):
+    """Deletes every row whose `key_column` is in `keys`.
+
+    Keys are sent in chunks of at most `batch_size`, or fewer when needed
+    to stay under the driver's parameter limit.
+
+    Args:
+        table (str): Table name
+        key_column (str): the column to match the keys against
+        keys (iterable): the key values of the rows to delete
+        batch_size (int, optional): maximum keys per statement
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
+
+    Returns:
+        int: The number of rows deleted.
+
+    Examples:
+        >>> db.bulk_delete('users', 'id', [1, 2, 3])
+    """
+    keys = list(keys)
+    start = timer()
+    affected_rows = self._bulk_delete(table, key_column, keys, batch_size, timeout)
+    self._record_bulk("bulk_delete", len(keys), affected_rows, start)
+    return affected_rows
+
+  def _bulk_delete(self, table, key_column, keys, batch_size, timeout):
+    """Deletes the rows with one `IN (...)` list per chunk of keys."""
+    keys_per_batch = min(batch_size or self._max_params, self._max_params)
+
+    affected_rows = 0
+    for batch in chunked(keys, keys_per_batch):
+      sql = 'DELETE FROM "%s" WHERE "%s" IN (%s)' % (
+        table,
+        key_column,
+        ", ".join([self._placeholder] * len(batch)),
+      )
+      self.query(sql, *batch, timeout=timeout)
+      affected_rows += self.affected_rows
+
+    self.affected_rows = affected_rows
+    return affected_rows
+
+  def _record_bulk(self, operation, rows, affected_rows, start):
+    """Saves the throughput of a bulk operation in `stats['last_bulk']`."""
+    seconds = timer() - start
+    self.stats["last_bulk"] = {
+      "operation": operation,
+      "rows": rows,
+      "affected_rows": affected_rows,
+      "seconds": seconds,
+      "rows_per_second": rows / seconds if seconds else None,
+    }
 
   # ------------------------------------------------------------------
   # Transaction Management
   # ------------------------------------------------------------------
 
-  def begin_transaction(self):
+  ISOLATION_LEVELS = ("READ UNCOMMITTED", "READ COMMITTED", "REPEATABLE READ", "SERIALIZABLE")
+
+  @contextmanager
+  def transaction(self, isolation_level=None, read_only=False, deferrable=False):
+    """Runs the block in a transaction, committed when it exits normally and
+    rolled back when it raises.
+
+    Blocks nest: inside a transaction, a new block opens a SAVEPOINT, so
+    its failure only undoes its own statements.
+
+    Args:
+        isolation_level (str, optional): 'READ UNCOMMITTED', 'READ
+            COMMITTED', 'REPEATABLE READ' or 'SERIALIZABLE'. Defaults to
+            the server's. SQLite transactions are always serializable.
+        read_only (bool, optional): reject writes in the transaction
+        deferrable (bool, optional): with SERIALIZABLE and read_only, let
+            Postgres wait for a snapshot that can't fail. Ignored elsewhere.
+
+    Yields:
+        Database: this database
+
+    Raises:
+        ValueError: If options are given to a nested block; they only apply
+            to the outermost transaction.
+
+    Examples:
+        >>> with db.transaction():
+        ...   db.insert('orders', id=1)
+        ...   try:
+        ...     with db.transaction():  # SAVEPOINT
+        ...       db.insert('order_lines', order_id=1, sku='x')
+        ...   except IntegrityError:
+        ...     pass  # the order is still inserted
+    """
+    if not self._in_transaction:
+      self.begin_transaction(isolation_level, read_only, deferrable)
+      try:
+        yield self
+      except BaseException:
+        self.rollback()
+        raise
+      self.commit()
+      return
+
+    if isolation_level or read_only or deferrable:
+      raise ValueError("Transaction options only apply to the outermost transaction.")
+
+    self._savepoints += 1
+    savepoint = "ezrecords_%d" % self._savepoints
+    try:
+      self.query("SAVEPOINT %s" % savepoint)
+      try:
+        yield self
+      except BaseException as exception:
+        # When the server aborted the whole transaction, e.g. on a deadlock,
+        # ROLLBACK TO fails too. Raise the original error, which tells
+        # run_in_transaction whether to retry, and leave the transaction
+        # to the outer block.
+        try:
+          self.query("ROLLBACK TO SAVEPOINT %s" % savepoint)
+        except Exception:
+          raise exception
+        finally:
+          self._session_timeout = None
+          if self._transaction_ddl:
+            self.refresh()
+        raise
+      else:
+        self.query("RELEASE SAVEPOINT %s" % savepoint)
+    finally:
+      self._savepoints -= 1
+
+  def run_in_transaction(self, fn, retries=3, backoff=0.05, max_backoff=2.0, name=None, **options):
+    """Runs `fn(db)` in a transaction, re-running the whole of it when the
+    database aborts it with a serialization failure or a deadlock.
+
+    Between attempts it sleeps a random time up to `backoff` seconds,
+    doubled on every attempt and capped at `max_backoff`, so clashing
+    transactions don't retry in lockstep. `fn` may run several times, so
+    it must not have side effects outside the database.
+
+    Args:
+        fn (callable): the unit of work, called with this database
+        retries (int, optional): attempts made after the first one
+        backoff (float, optional): base delay, in seconds
+        max_backoff (float, optional): longest delay, in seconds
+        name (str, optional): the call site the retries are counted under
+            in `stats['transaction_retries']`. Defaults to `fn`'s name.
+        **options: `isolation_level`, `read_only` and `deferrable`, see
+            `transaction`
+
+    Returns:
+        the value returned by `fn`
+
+    Examples:
+        >>> def transfer(db):
+        ...   db.query('UPDATE accounts SET balance = balance - 10 WHERE id = 1')
+        ...   db.query('UPDATE accounts SET balance = balance + 10 WHERE id = 2')
+        >>> db.run_in_transaction(transfer, isolation_level='SERIALIZABLE')
+    """
+    # Inside a transaction the failure aborts the enclosing one, so it's the
+    # outermost unit that has to be retried.
+    if self._in_transaction:
+      with self.transaction(**options):
+        return fn(self)
+
+    if name is None:
+      name = "%s.%s" % (fn.__module__, getattr(fn, "__qualname__", fn.__name__))
+
+    attempt = 0
+    while True:
+      try:
+        with self.transaction(**options):
+          return fn(self)
+      except Exception as exception:
+        if attempt >= retries or not self._is_retryable_error(exception):
+          raise
+        if self.logger:
+          self.logger.warning(
+            "Retrying %s after %s (attempt %s of %s)" % (name, exception, attempt + 1, retries)
+          )
+
+      retried = self.stats["transaction_retries"]
+      retried[name] = retried.get(name, 0) + 1
+      time.sleep(random.uniform(0, min(max_backoff, backoff * 2 ** attempt)))
+      attempt += 1
+
+  def _is_retryable_error(self, exception):
+    """Tells whether the driver exception aborted the transaction in a way
+    that running it again may succeed, like a deadlock."""
+    return False
+
+  def begin_transaction(self, isolation_level=None, read_only=False, deferrable=False):
     """Begins a transaction on the current connection.
 
+    See `transaction` for the arguments, which also handles nesting.
+
     Raises:
-        RuntimeError: If there's no current connection.
+        RuntimeError: If there's no current connection or a transaction is
+            already in progress.
     """
     if self._connection is None:
       raise RuntimeError(
         "Cannot BEGIN/START TRANSACTION on no connection. Connect first."
       )
+    if self._in_transaction:
+      raise RuntimeError("A transaction is already in progress. Nest with transaction().")
+
+    if isolation_level is not None:
+      isolation_level = isolation_level.upper().replace("_", " ")
+      if isolation_level not in self.ISOLATION_LEVELS:
+        raise ValueError(
+          "isolation_level must be one of %s." % ", ".join(self.ISOLATION_LEVELS)
+        )
 
-    # TODO: Move these conditionals into individual drivers
-    if self._dialect == "mysql":
-      self._connection.begin()
-
-    if self._dialect == "postgres":
-      self._connection.set_session(autocommit=False)
-
-    if self._dialect == "sqlite":
-      self.query("BEGIN TRANSACTION")
-
+    self._begin(isolation_level, read_only, deferrable)
     self._in_transaction = True
+    self._transaction_start = timer()
+
+  def _begin(self, isolation_level, read_only, deferrable):
+    """Starts a transaction with the dialect's syntax."""
+    self.query("BEGIN")
 
   def rollback(self):
     """Rollback the current transaction on the current connection.
@@ -639,30 +1924,56 @@ class Database(object):
     if self._connection is None or not self._in_transaction:
       raise RuntimeError("Cannot ROLLBACK. There's no current connection")
 
-    self._connection.rollback()
+    ran_ddl = self._transaction_ddl
+    try:
+      self._rollback()
+    finally:
+      self._end_transaction(committed=False)
 
-    # TODO: Move these conditionals into individual drivers
-    if self._dialect == "postgres":
-      self._connection.set_session(autocommit=True)
+    # A ROLLBACK may undo session settings and DDL made inside the transaction.
+    self._session_timeout = None
+    if ran_ddl:
+      self.refresh()
 
-    self._in_transaction = False
+  def _rollback(self):
+    self._connection.rollback()
 
   def commit(self):
     """Commits the current transaction on the current connection.
 
+    Outside of a transaction it only commits what the driver may have
+    started implicitly.
+
     Raises:
         RuntimeError: If there's no current connection.
     """
     if self._connection is None:
       raise RuntimeError("Cannot COMMIT. There's no current connection.")
 
-    self._connection.commit()
+    if not self._in_transaction:
+      self._connection.commit()
+      return
 
-    # TODO: Move these conditionals into individual drivers
-    if self._dialect == "postgres":
-      self._connection.set_session(autocommit=True)
+    try:
+      self._commit()
+    finally:
+      self._end_transaction(committed=True)
 
+  def _commit(self):
+    self._connection.commit()
+
+  def _end_transaction(self, committed):
+    """Leaves the transaction and records its duration in `stats`."""
+    seconds = timer() - self._transaction_start
     self._in_transaction = False
+    self._savepoints = 0
+    self._transaction_ddl = False
+
+    self.stats["transactions"] += 1
+    if not committed:
+      self.stats["rollbacks"] += 1
+    self.stats["transaction_seconds"] += seconds
+    self.stats["last_transaction_seconds"] = seconds
 
   # ------------------------------------------------------------------
   # Helpers & Common queries
@@ -671,7 +1982,7 @@ class Database(object):
 
   def db_version(self):
     """Retrieves the database server version number."""
-    version = self._db_version()
+    version = self._cached_metadata("version", self._db_version)
     version = preg_replace(r"[^0-9.].*", "", version)
     return version
 
@@ -694,24 +2005,90 @@ class Database(object):
   def exists(self, name, kind="table", schema="public"):
     """Checks if an object with the given name, type exists in the given schema.
 
+    With the default `kind` and `schema` it's answered from the cached
+    table names, see `get_table_names`, where views count as tables.
+    Other kinds and schemas are looked up in the catalog every time.
+
     Args:
         name (str): the object name to be checked
-        kind (str, optional): the type of the object
-        schema (str, optional): the schema in which the object belongs
+        kind (str, optional): the type of the object: 'table', 'view',
+            'index', ... as the driver supports
+        schema (str, optional): the schema in which the object belongs.
+            'public' stands for the connection's default schema.
 
     Returns:
         bool: True case the object exists, False otherwise.
+
+    Raises:
+        ValueError: If the driver doesn't know the kind.
     """
+    if kind == "table" and schema == "public":
+      return name in self._table_names()
+    return self._exists(name, kind, schema)
+
+  def _exists(self, name, kind, schema):
+    """Looks the object up in the catalog, see `exists`."""
     raise NotImplementedError()
 
   def get_table_names(self):
-    """Returns a list of table names for the connected database."""
-    return self._get_table_names()
+    """Returns a list of table names for the connected database.
+
+    The names are cached, see `table_metadata`.
+    """
+    return RecordCollection(iter([Record(["table"], [name]) for name in self._table_names()]))
+
+  def _table_names(self):
+    def load():
+      rows = self._get_table_names()
+      return [] if rows is None else [row["table"] for row in rows]
+
+    return self._cached_metadata("tables", load)
 
   def _get_table_names(self):
-    """Retrieves the database server version."""
+    """Retrieves the names of the tables and views, as rows with a `table` column."""
+    raise NotImplementedError()
+
+  def table_metadata(self, table):
+    """Returns the columns, primary key and indexes of a table.
+
+    Schema metadata is cached for `metadata_ttl` seconds. DDL statements
+    run through `query` and `rollback()` clear the cache, as does `refresh()`.
+
+    Args:
+        table (str): the table name
+
+    Returns:
+        dict: None if the table doesn't exist, otherwise with the keys
+            columns: OrderedDict of column name to declared type, in the
+                table's column order
+            primary_key: list of the primary key columns
+            indexes: list of dicts with the `name`, `columns` and `unique`
+                of each index
+
+    Examples:
+        >>> db.table_metadata('users')['primary_key']
+        ['id']
+    """
+    return self._cached_metadata(("table", table), lambda: self._load_table_metadata(table))
+
+  def _load_table_metadata(self, table):
+    """Reads the metadata of a table from the catalog, see `table_metadata`."""
     raise NotImplementedError()
 
+  def refresh(self):
+    """Clears the cached schema metadata, so it's read again when needed."""
+    self._metadata.clear()
+    self._dml_templates.clear()
+
+  def _cached_metadata(self, key, load):
+    entry = self._metadata.get(key)
+    if entry is None or (
+      self.metadata_ttl is not None and timer() - entry[0] >= self.metadata_ttl
+    ):
+      entry = (timer(), load())
+      self._metadata[key] = entry
+    return entry[1]
+
   # ------------------------------------------------------------------
   # Debug Helpers
   # ------------------------------------------------------------------
@@ -723,6 +2100,35 @@ class Database(object):
     self.last_query = 0
     self.queries_executed = 0
     del self.saved_queries[:]
+    del self.slow_queries[:]
+    self._reset_stats()
+
+  def _reset_stats(self):
+    """Zeroes the counters in `stats`."""
+    self.stats.clear()
+    self.stats.update(
+      {
+        # Statements cancelled for running past their timeout
+        "queries_timed_out": 0,
+        # Rows, affected rows and throughput of the last bulk operation
+        "last_bulk": None,
+        # Statements that ran past `slow_query_threshold`
+        "slow_queries": 0,
+        # Transactions finished, how many were rolled back, the time spent
+        # in them and in the last one, in seconds
+        "transactions": 0,
+        "rollbacks": 0,
+        "transaction_seconds": 0.0,
+        "last_transaction_seconds": None,
+        # Transactions re-run by run_in_transaction, by call site
+        "transaction_retries": {},
+        # Connections opened, the time spent opening them and the last one,
+        # in seconds
+        "connections": 0,
+        "connect_seconds": 0.0,
+        "last_connect_seconds": None,
+      }
+    )
 
   def timer_start(self):
     """Starts the timer, for debugging purposes."""
@@ -740,3 +2146,42 @@ class Database(object):
   def last_query_elapsed_time(self):
     """Returns the amount of elapsed time during the most recent query."""
     return format_timedelta(self._time_stop - self._time_start)
+
+
+def _coerce_json(value):
+  """Serializes dicts and lists bound to JSON columns, drivers don't."""
+  if isinstance(value, (dict, list)):
+    return json_dumps(value)
+  return value
+
+
+def create_database(db_url=None, **kwargs):
+  """Creates a `Database` for the dialect named in the URL.
+
+  Args:
+      db_url (str, optional): The database URL. Defaults to $DATABASE_URL.
+      **kwargs: Forwarded to the driver's constructor.
+
+  Returns:
+      Database: a connected `MySQLDb`, `PostgresDb` or `SQLiteDb`.
+
+  Examples:
+      >>> db = create_database('sqlite:///:memory:')
+  """
+  db_url = db_url or os.getenv("DATABASE_URL", None)
+  if not db_url:
+    raise ValueError("You must provide a db_url.")
+
+  dialect = parse_db_url(db_url)["dialect"]
+
+  # Drivers are imported lazily so only the ones in use need to be installed.
+  if dialect == "mysql":
+    from ezrecords.mysqldb import MySQLDb as database_class
+  elif dialect in ("postgres", "postgresql"):
+    from ezrecords.postgresdb import PostgresDb as database_class
+  elif dialect == "sqlite":
+    from ezrecords.sqlitedb import SQLiteDb as database_class
+  else:
+    raise ValueError("Unsupported dialect '%s'." % dialect)
+
+  return database_class(db_url=db_url, **kwargs)
@@ -8,31 +8,51 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")
 from sys import stdout
 from docopt import docopt
 
-from ezrecords.mysqldb import MySQLDb
-from ezrecords.postgresdb import PostgresDb
-from ezrecords.sqlitedb import SQLiteDb
-from ezrecords.util import parse_db_url
+from ezrecords.abstractdb import create_database
+from ezrecords.columnar import COLUMNAR_FORMATS
+from ezrecords.export import PARTITIONED_FORMATS, partitioned_export
 
 
 def cli():
   supported_formats = "csv tsv json yaml html xls xlsx dbf latex ods".split()
+  supported_formats += list(COLUMNAR_FORMATS)
   formats_list = ", ".join(supported_formats)
   cli_docs = """ezrecords: SQL for Humans™ Enhanced
 Based on Kenneth Reitz, Records: SQL for Humans™.
 
 Usage:
   records <query> <format> [<params>...] [--url=<url>]
+  records <query> <format> --partition-key=<column> --output=<path> [--partitions=<n>] [--workers=<n>] [--processes] [--merge] [--url=<url>]
   records (-h | --help)
 
 Options:
-  -h --help     Show this screen.
-  --url=<url>   The database URL to use. Defaults to $DATABASE_URL.
+  -h --help                 Show this screen.
+  --url=<url>               The database URL to use. Defaults to $DATABASE_URL.
+  --partition-key=<column>  Export in parallel, splitting the range of this
+                            numeric or date column between workers.
+  --output=<path>           File to write the partitioned export to.
+  --partitions=<n>          Number of key ranges [default: 4].
+  --workers=<n>             Number of concurrent connections. Defaults to
+                            one per partition.
+  --processes               Use worker processes instead of threads.
+  --merge                   Merge the per-partition files into <path>, in
+                            key order. Otherwise they're left as <path>.N.
 
 Supported Formats:
     %(formats_list)s
 
-   Note: xls, xlsx, dbf, and ods formats are binary, and should only be
-         used with redirected output e.g. '$ records sql xls > sql.xls'.
+   Note: xls, xlsx, dbf, ods, arrow, feather, parquet and npz formats are
+         binary, and should only be used with redirected output e.g.
+         '$ records sql xls > sql.xls'.
+
+   The columnar formats (arrow, feather, parquet and npz) are streamed from
+   the database in batches, so they suit large exports. All but npz require
+   pyarrow.
+
+   Partitioned exports support %(partitioned_formats)s, and <query> may also
+   be a table name e.g.:
+
+    $ records events csv --partition-key=id --partitions=8 --output=events.csv --merge
 
 Query Parameters:
     Query parameters can be specified in key=value format, and injected
@@ -47,16 +67,17 @@ Notes:
     can be provided instead. Use this feature discernfully; it's dangerous.
   - Records is intended for report-style exports of database queries, and
     has not yet been optimized for extremely large data dumps.
-    """ % dict(formats_list=formats_list)
+    """ % dict(formats_list=formats_list, partitioned_formats=", ".join(PARTITIONED_FORMATS))
 
   # Parse the command-line arguments.
   arguments = docopt(cli_docs)
 
+  if arguments["--partition-key"]:
+    _partitioned_export(arguments)
+    return
+
   # Create the Database.
-  dsn_components = parse_db_url(arguments["--url"])
-  dialect_map = {"mysql": MySQLDb, "postgres": PostgresDb, "sqlite": SQLiteDb}
-  db = dialect_map[dsn_components["dialect"]](arguments["--url"])
-  assert db is not None
+  db = create_database(arguments["--url"])
 
   query = arguments["<query>"]
   params = arguments["<params>"]
@@ -76,13 +97,16 @@ Notes:
     print("Parameters must be given in key=value format.")
     exit(64)  # TODO: What is 64?
 
+  # Columnar exports don't need every row in memory.
+  stream = format in COLUMNAR_FORMATS
+
   # Execute the query, if it is a found file.
   if os.path.isfile(query):
-    rows = db.query_file(query, **params)
+    rows = db.query_file(query, stream=stream, params=params)
 
   # Execute the query, if it appears to be a query string.
   elif len(query.split()) > 2:
-    rows = db.query(query, **params)
+    rows = db.query(query, stream=stream, params=params)
 
   # Otherwise, say the file wasn't found.
   else:
@@ -90,7 +114,9 @@ Notes:
     exit(66)  # TODO: what is 66?
 
   # Print results in desired format
-  if format:
+  if stream:
+    rows.export(format, target=getattr(stdout, "buffer", stdout))
+  elif format:
     content = rows.export(format)
     if arguments["<format>"]:
       _print_bytes(content)
@@ -98,7 +124,36 @@ Notes:
       print(content)
 
 
+def _partitioned_export(arguments):
+  query = arguments["<query>"]
+  format = arguments["<format>"]
+  if format not in PARTITIONED_FORMATS:
+    print("%s format not supported for partitioned exports." % format)
+    print("Supported formats are %s." % ", ".join(PARTITIONED_FORMATS))
+    exit(62)
+
+  if os.path.isfile(query):
+    with open(query, encoding="utf-8") as file_handle:
+      query = file_handle.read()
+
+  files = partitioned_export(
+    arguments["--url"],
+    query,
+    arguments["--partition-key"],
+    arguments["--output"],
+    format=format,
+    partitions=int(arguments["--partitions"]),
+    workers=int(arguments["--workers"]) if arguments["--workers"] else None,
+    processes=arguments["--processes"],
+    merge=arguments["--merge"],
+  )
+  for path, rows in files:
+    print("%s: %s rows" % (path, rows))
+
+
 def _print_bytes(content):
+  if not isinstance(content, bytes):
+    content = content.encode("utf-8")
   try:
     stdout.buffer.write(content)
   except AttributeError:
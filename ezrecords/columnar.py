@@ -0,0 +1,357 @@
+# coding: utf-8
+"""
+Columnar exports of query results.
+
+Arrow IPC, Feather and Parquet are written with pyarrow when it's installed.
+The npz format, a zip of one NumPy `.npy` array per column, is written
+without any dependency so it's always available.
+"""
+from __future__ import unicode_literals, print_function, absolute_import, with_statement
+
+import array
+import datetime
+import io
+import shutil
+import struct
+import sys
+import tempfile
+import zipfile
+from decimal import Decimal
+
+from ezrecords.compat import string_types
+
+COLUMNAR_FORMATS = ("arrow", "feather", "parquet", "npz")
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_DATE = _EPOCH.date()
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+_BYTE_ORDER = "<" if sys.byteorder == "little" else ">"
+
+
+def export_columnar(rows, format, target=None, batch_size=10000, compression=None):
+  """Exports a `RecordCollection` to a columnar format, batch by batch.
+
+  Column types come from the cursor description when the driver provides
+  them, otherwise from the values of the first batch.
+
+  Args:
+      rows (RecordCollection): the rows to export. Rows that weren't fetched
+          yet are streamed through without being kept in memory.
+      format (str): 'arrow' (IPC stream), 'feather' (IPC file), 'parquet' or
+          'npz'. All but 'npz' require pyarrow.
+      target (str|file, optional): path or binary file object to write to.
+          When not given, the exported bytes are returned.
+      batch_size (int, optional): rows converted and written at a time
+      compression (str, optional): 'zstd', 'snappy', 'lz4'... for the
+          pyarrow formats. Any value deflates the npz archive.
+
+  Returns:
+      bytes: The exported data, if no `target` was given.
+
+  Examples:
+      >>> db.query('SELECT * FROM events', stream=True).export('parquet', target='events.parquet')
+  """
+  if format not in COLUMNAR_FORMATS:
+    raise ValueError("format must be one of %s." % ", ".join(COLUMNAR_FORMATS))
+
+  output = io.BytesIO() if target is None else target
+  close = False
+  if isinstance(output, string_types):
+    output = open(output, "wb")
+    close = True
+
+  try:
+    if format == "npz":
+      _write_npz(rows, output, batch_size, compression)
+    else:
+      _write_arrow(rows, format, output, batch_size, compression)
+  finally:
+    if close:
+      output.close()
+
+  if target is None:
+    return output.getvalue()
+
+
+def _column_names(rows, batch):
+  if batch:
+    return list(batch[0].keys())
+  if rows.description:
+    return [column[0] for column in rows.description]
+  return []
+
+
+def _column_kind(kind, values):
+  """Returns the declared kind of a column or guesses it from its values."""
+  if kind is not None:
+    return kind
+
+  for value in values:
+    if value is None:
+      continue
+    if isinstance(value, bool):
+      return "bool"
+    if isinstance(value, int):
+      return "int"
+    if isinstance(value, float):
+      return "float"
+    if isinstance(value, Decimal):
+      return "decimal"
+    if isinstance(value, datetime.datetime):
+      return "datetime"
+    if isinstance(value, datetime.date):
+      return "date"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+      return "bytes"
+    return "text"
+  return "text"
+
+
+# ----------------------------------------------------------------------
+# Arrow, Feather & Parquet
+# ----------------------------------------------------------------------
+
+
+def _import_pyarrow():
+  try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+  except ImportError:
+    raise ImportError(
+      "pyarrow is required for arrow, feather and parquet exports. "
+      "Install it or use the npz format instead."
+    )
+  return pyarrow
+
+
+def _arrow_type(pa, kind, column, values):
+  if kind == "bool":
+    return pa.bool_()
+  if kind == "int":
+    return pa.int64()
+  if kind == "float":
+    return pa.float64()
+  if kind == "date":
+    return pa.date32()
+  if kind == "datetime":
+    aware = any(v is not None and getattr(v, "tzinfo", None) for v in values)
+    return pa.timestamp("us", tz="UTC" if aware else None)
+  if kind == "bytes":
+    return pa.binary()
+  if kind == "decimal":
+    precision, scale = (column[4], column[5]) if column else (None, None)
+    if precision and scale is not None and precision <= 38:
+      return pa.decimal128(precision, scale)
+    return pa.float64()
+  return pa.string()
+
+
+def _arrow_array(pa, values, arrow_type):
+  try:
+    return pa.array(values, type=arrow_type)
+  except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError):
+    # Loosely typed engines (SQLite) may mix types in a column.
+    if pa.types.is_string(arrow_type):
+      return pa.array([None if v is None else str(v) for v in values], type=arrow_type)
+    if pa.types.is_floating(arrow_type):
+      return pa.array([None if v is None else float(v) for v in values], type=arrow_type)
+    raise
+
+
+def _write_arrow(rows, format, output, batch_size, compression):
+  pa = _import_pyarrow()
+
+  schema = None
+  writer = None
+  try:
+    for batch in rows.iter_batches(batch_size):
+      columns = list(zip(*[record.values() for record in batch]))
+
+      if schema is None:
+        names = _column_names(rows, batch)
+        kinds = rows.column_types or [None] * len(names)
+        description = rows.description or [None] * len(names)
+        schema = pa.schema(
+          [
+            (name, _arrow_type(pa, _column_kind(kind, values), column, values))
+            for name, kind, column, values in zip(names, kinds, description, columns)
+          ]
+        )
+        writer = _arrow_writer(pa, format, output, schema, compression)
+
+      arrays = [_arrow_array(pa, list(values), field.type) for values, field in zip(columns, schema)]
+      writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+
+    if writer is None:
+      names = _column_names(rows, [])
+      schema = pa.schema([(name, pa.string()) for name in names])
+      writer = _arrow_writer(pa, format, output, schema, compression)
+  finally:
+    if writer is not None:
+      writer.close()
+
+
+def _arrow_writer(pa, format, output, schema, compression):
+  if format == "parquet":
+    return pa.parquet.ParquetWriter(output, schema, compression=compression or "snappy")
+
+  options = pa.ipc.IpcWriteOptions(compression=compression) if compression else None
+  if format == "feather":
+    # Feather V2 is the Arrow IPC file format.
+    return pa.ipc.new_file(output, schema, options=options)
+  return pa.ipc.new_stream(output, schema, options=options)
+
+
+# ----------------------------------------------------------------------
+# NumPy .npz
+# ----------------------------------------------------------------------
+
+# Type name to (npy dtype, array module typecode, null placeholder)
+_NPY_TYPES = {
+  "bool": ("|b1", "b", 0),
+  "int": (_BYTE_ORDER + "i8", "q", 0),
+  "float": (_BYTE_ORDER + "f8", "d", float("nan")),
+  "decimal": (_BYTE_ORDER + "f8", "d", float("nan")),
+  "date": (_BYTE_ORDER + "M8[D]", "q", -(2**63)),
+  "datetime": (_BYTE_ORDER + "M8[us]", "q", -(2**63)),
+}
+
+
+def _to_datetime(value):
+  if isinstance(value, string_types):
+    value = datetime.datetime.fromisoformat(value)
+  elif not isinstance(value, datetime.datetime):
+    value = datetime.datetime(value.year, value.month, value.day)
+  if value.tzinfo is not None:
+    value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+  return (value - _EPOCH) // _ONE_MICROSECOND
+
+
+def _to_date(value):
+  if isinstance(value, string_types):
+    value = datetime.datetime.fromisoformat(value)
+  if isinstance(value, datetime.datetime):
+    value = value.date()
+  return (value - _EPOCH_DATE).days
+
+
+_NPY_CONVERTERS = {
+  "bool": lambda value: 1 if value else 0,
+  "int": int,
+  "float": float,
+  "decimal": float,
+  "date": _to_date,
+  "datetime": _to_datetime,
+}
+
+
+def _npy_header(descr, length):
+  header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, length)
+  # magic (6) + version (2) + header length (2) + header + newline, the
+  # whole preamble padded to a multiple of 64 bytes.
+  header += " " * (-(10 + len(header) + 1) % 64) + "\n"
+  return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+class _NpyColumn(object):
+  """Spools one column to a temporary file until its length is known."""
+
+  def __init__(self, name, kind):
+    self.name = name
+    self.kind = kind if kind in _NPY_TYPES or kind == "bytes" else "text"
+    self.length = 0
+    self.width = 1
+    self.data = tempfile.TemporaryFile()
+    self.mask = tempfile.TemporaryFile()
+    self.has_nulls = False
+
+  def append(self, values):
+    mask = array.array("b", [value is None for value in values])
+    self.has_nulls = self.has_nulls or any(mask)
+    self.mask.write(mask.tobytes())
+    self.length += len(values)
+
+    if self.kind in _NPY_TYPES:
+      _, typecode, null = _NPY_TYPES[self.kind]
+      convert = _NPY_CONVERTERS[self.kind]
+      try:
+        data = array.array(typecode, [null if v is None else convert(v) for v in values])
+      except (TypeError, ValueError) as exception:
+        raise ValueError("Column '%s' holds a non-%s value: %s" % (self.name, self.kind, exception))
+      self.data.write(data.tobytes())
+      return
+
+    # Variable width values: length-prefixed until the widest one is known.
+    for value in values:
+      if value is None:
+        encoded = b""
+      elif self.kind == "bytes":
+        encoded = bytes(value)
+        self.width = max(self.width, len(encoded))
+      else:
+        text = value if isinstance(value, string_types) else str(value)
+        self.width = max(self.width, len(text))
+        encoded = text.encode("utf-8")
+      self.data.write(struct.pack("<I", len(encoded)))
+      self.data.write(encoded)
+
+  def write_to(self, archive):
+    self.data.seek(0)
+    with archive.open(self.name + ".npy", "w", force_zip64=True) as entry:
+      if self.kind in _NPY_TYPES:
+        entry.write(_npy_header(_NPY_TYPES[self.kind][0], self.length))
+        shutil.copyfileobj(self.data, entry)
+      else:
+        if self.kind == "bytes":
+          entry.write(_npy_header("|S%d" % self.width, self.length))
+        else:
+          entry.write(_npy_header(_BYTE_ORDER + "U%d" % self.width, self.length))
+        self._write_fixed_width(entry)
+
+    if self.has_nulls:
+      self.mask.seek(0)
+      with archive.open(self.name + "__mask.npy", "w", force_zip64=True) as entry:
+        entry.write(_npy_header("|b1", self.length))
+        shutil.copyfileobj(self.mask, entry)
+
+    self.data.close()
+    self.mask.close()
+
+  def _write_fixed_width(self, entry):
+    codec = "utf-32-le" if _BYTE_ORDER == "<" else "utf-32-be"
+    for _ in range(self.length):
+      (size,) = struct.unpack("<I", self.data.read(4))
+      value = self.data.read(size)
+      if self.kind == "bytes":
+        entry.write(value.ljust(self.width, b"\0"))
+      else:
+        entry.write(value.decode("utf-8").encode(codec).ljust(self.width * 4, b"\0"))
+
+
+def _write_npz(rows, output, batch_size, compression):
+  """Writes one `<column>.npy` array per column, plus a `<column>__mask.npy`
+  boolean array flagging the NULLs of the columns that have any."""
+  columns = None
+  try:
+    for batch in rows.iter_batches(batch_size):
+      values = list(zip(*[record.values() for record in batch]))
+      if columns is None:
+        names = _column_names(rows, batch)
+        kinds = rows.column_types or [None] * len(names)
+        columns = [
+          _NpyColumn(name, _column_kind(kind, column_values))
+          for name, kind, column_values in zip(names, kinds, values)
+        ]
+      for column, column_values in zip(columns, values):
+        column.append(column_values)
+
+    mode = zipfile.ZIP_DEFLATED if compression else zipfile.ZIP_STORED
+    with zipfile.ZipFile(output, "w", compression=mode, allowZip64=True) as archive:
+      for column in columns or []:
+        column.write_to(archive)
+  finally:
+    for column in columns or []:
+      if not column.data.closed:
+        column.data.close()
+        column.mask.close()
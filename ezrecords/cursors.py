@@ -0,0 +1,142 @@
+# coding: utf-8
+"""
+Helpers to read rows from DB-API cursors lazily.
+"""
+from __future__ import unicode_literals, print_function, absolute_import, with_statement
+
+import inspect
+import queue
+import threading
+
+#: Put by the prefetching thread once the cursor is exhausted.
+_DONE = object()
+
+
+def convert_batch(rows, converters):
+  """Applies converters to a batch of dict-like rows, in place.
+
+  Conversion runs column by column over the whole batch, so each converter
+  is looked up once per batch instead of once per value. NULLs are left
+  as they are.
+
+  Args:
+      rows (list): rows as returned by a dict cursor
+      converters (tuple): (column name, function) pairs, for the columns
+          that need converting only
+
+  Returns:
+      list: `rows`
+  """
+  for key, convert in converters:
+    for row in rows:
+      value = row[key]
+      if value is not None:
+        row[key] = convert(value)
+  return rows
+
+
+def iter_fetchmany(cursor, first_batch, batch_size, converters=()):
+  """Yields the cursor's rows, fetching `batch_size` rows at a time.
+
+  The cursor is closed once it's exhausted or the generator is closed.
+
+  Args:
+      cursor: a cursor the statement was already executed on
+      first_batch (list): rows already fetched from the cursor
+      batch_size (int): rows to fetch per round-trip
+      converters (tuple, optional): applied to every batch, see `convert_batch`
+  """
+  try:
+    batch = first_batch
+    while batch:
+      if converters:
+        convert_batch(batch, converters)
+      for row in batch:
+        yield row
+      batch = cursor.fetchmany(batch_size)
+  finally:
+    cursor.close()
+
+
+def iter_prefetched(cursor, first_batch, batch_size, depth=2, converters=()):
+  """Yields the cursor's rows while a background thread fetches the next
+  batches, so the caller's processing overlaps the round-trips.
+
+  Up to `depth` fetched batches wait in a queue, bounding memory use. When
+  the generator is closed early, the thread stops after its current fetch
+  and the cursor is closed once it's done. Errors raised while fetching
+  are raised to the caller.
+
+  Args:
+      cursor: a cursor the statement was already executed on
+      first_batch (list): rows already fetched from the cursor
+      batch_size (int): rows to fetch per round-trip
+      depth (int, optional): batches fetched ahead of the caller
+      converters (tuple, optional): applied to every batch, in the
+          background thread, see `convert_batch`
+  """
+  batches = queue.Queue(maxsize=max(1, depth))
+  stopped = threading.Event()
+
+  def put(item):
+    # Gives up once the caller is gone rather than wait on a full queue.
+    while not stopped.is_set():
+      try:
+        batches.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def fetch():
+    try:
+      while not stopped.is_set():
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+          break
+        if converters:
+          convert_batch(batch, converters)
+        if not put(batch):
+          return
+    except Exception as exception:
+      put(exception)
+      return
+    put(_DONE)
+
+  thread = threading.Thread(target=fetch, name="ezrecords-prefetch")
+  thread.daemon = True
+  try:
+    if not first_batch:
+      return
+    thread.start()
+    if converters:
+      convert_batch(first_batch, converters)
+    for row in first_batch:
+      yield row
+
+    while True:
+      batch = batches.get()
+      if batch is _DONE:
+        break
+      if isinstance(batch, Exception):
+        raise batch
+      for row in batch:
+        yield row
+  finally:
+    stopped.set()
+    if thread.ident is not None:
+      thread.join()
+    cursor.close()
+
+
+def close_rows(rows, cursor):
+  """Closes a generator of `iter_fetchmany` or `iter_prefetched` and its
+  cursor, stopping the prefetching thread if it runs.
+
+  A generator that never started doesn't run its cleanup when closed, so
+  the cursor is closed here then.
+  """
+  started = inspect.getgeneratorstate(rows) != inspect.GEN_CREATED
+  rows.close()
+  if not started:
+    cursor.close()
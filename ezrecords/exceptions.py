@@ -0,0 +1,42 @@
+# coding: utf-8
+from __future__ import unicode_literals, print_function, absolute_import, with_statement
+
+
+class QueryTimeoutError(RuntimeError):
+  """Raised when a statement runs past its allowed execution time.
+
+  Attributes:
+      sql (str): the statement that was cancelled
+      timeout (float): the deadline, in seconds, the statement exceeded
+  """
+
+  def __init__(self, sql, timeout):
+    super(QueryTimeoutError, self).__init__(
+      "Query exceeded the %ss timeout: %s" % (timeout, sql)
+    )
+    self.sql = sql
+    self.timeout = timeout
+
+
+class ScriptError(RuntimeError):
+  """Raised when a statement of a SQL script fails.
+
+  The transaction of the failed statement's batch is rolled back, so
+  running the script again from `resume_from` picks up where the committed
+  statements end.
+
+  Attributes:
+      statement (int): number of the failed statement, counted from 1
+      line (int): line of the script the failed statement starts on
+      sql (str): the failed statement
+      resume_from (int): number of the first statement not committed
+  """
+
+  def __init__(self, statement, line, sql, resume_from, error):
+    super(ScriptError, self).__init__(
+      "Statement %s, on line %s, failed: %s" % (statement, line, error)
+    )
+    self.statement = statement
+    self.line = line
+    self.sql = sql
+    self.resume_from = resume_from
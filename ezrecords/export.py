@@ -0,0 +1,196 @@
+# coding: utf-8
+"""
+Parallel export of large tables, split into key ranges.
+"""
+from __future__ import unicode_literals, print_function, absolute_import, with_statement
+
+import csv
+import datetime
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from ezrecords.abstractdb import create_database
+from ezrecords.compat import string_types
+from ezrecords.util import json_dumps
+
+PARTITIONED_FORMATS = ("csv", "jsonl")
+
+
+def partitioned_export(
+  db_url,
+  source,
+  key_column,
+  path,
+  format="csv",
+  partitions=4,
+  workers=None,
+  processes=False,
+  merge=False,
+  **kwargs
+):
+  """Exports a table or query in parallel, one key range per worker.
+
+  The range between the minimum and maximum of `key_column` is split into
+  `partitions` equal ranges. Each range is read over its own connection, in
+  a thread or process pool, and written to its own shard file named
+  `<path>.<partition number>`. Rows with a NULL key are not exported.
+
+  Args:
+      db_url (str): The database URL. Each worker opens its own connection.
+      source (str): a table name or a SELECT whose results include `key_column`
+      key_column (str): a numeric or date/datetime column to split the range on.
+          It should be indexed.
+      path (str): the output file. Shards are written next to it.
+      format (str, optional): 'csv' or 'jsonl'
+      partitions (int, optional): the number of key ranges
+      workers (int, optional): the number of concurrent workers.
+          Defaults to one per partition.
+      processes (bool, optional): use a process pool instead of threads
+      merge (bool, optional): concatenate the shards, in key order, into
+          `path` and remove them
+      **kwargs: forwarded to the `Database` constructor
+
+  Returns:
+      list: The paths of the files written and the number of rows in each.
+
+  Examples:
+      >>> partitioned_export(url, 'events', 'id', 'events.csv', partitions=8, merge=True)
+      [('events.csv', 200000000)]
+  """
+  if format not in PARTITIONED_FORMATS:
+    raise ValueError("format must be one of %s." % ", ".join(PARTITIONED_FORMATS))
+
+  if len(source.split()) == 1:
+    source = '"%s"' % source
+  else:
+    source = "(%s) AS _export" % source.strip().rstrip(";")
+
+  db = create_database(db_url, **kwargs)
+  try:
+    bounds = db.query_one(
+      'SELECT min("%s") AS low, max("%s") AS high FROM %s' % (key_column, key_column, source)
+    )
+    placeholder = db._placeholder
+  finally:
+    db.close()
+
+  if bounds is None or bounds["low"] is None:
+    ranges = []
+  else:
+    ranges = split_range(bounds["low"], bounds["high"], partitions)
+
+  jobs = []
+  for number, (start, end) in enumerate(ranges):
+    # The first range has no lower bound: the minimum, as the database
+    # compares it, is never lost to a boundary written in another format.
+    if number == 0:
+      sql = 'SELECT * FROM %s WHERE "%s" IS NOT NULL' % (source, key_column)
+      args = []
+    else:
+      sql = 'SELECT * FROM %s WHERE "%s" >= %s' % (source, key_column, placeholder)
+      args = [start]
+    if end is not None:
+      sql += ' AND "%s" < %s' % (key_column, placeholder)
+      args.append(end)
+    sql += ' ORDER BY "%s"' % key_column
+    jobs.append((db_url, sql, args, "%s.%d" % (path, number), format, kwargs))
+
+  pool_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+  with pool_class(max_workers=workers or max(len(jobs), 1)) as executor:
+    shards = list(executor.map(_export_partition, jobs))
+
+  if not merge:
+    return shards
+
+  total = 0
+  header_written = False
+  with open(path, "w", newline="", encoding="utf-8") as output:
+    for shard_path, rows in shards:
+      total += rows
+      with open(shard_path, newline="", encoding="utf-8") as shard:
+        # Every non-empty csv shard has its own header, keep only the first.
+        if format == "csv" and rows:
+          if header_written:
+            shard.readline()
+          header_written = True
+        shutil.copyfileobj(shard, output)
+      os.remove(shard_path)
+
+  return [(path, total)]
+
+
+def split_range(low, high, partitions):
+  """Splits [low, high] into at most `partitions` contiguous ranges.
+
+  Works on numbers, dates and datetimes, and on ISO 8601 date strings as
+  returned by SQLite.
+
+  Returns:
+      list: (start, end) tuples. `start` is inclusive and `end` exclusive;
+      the last range has no `end` so it includes `high`. Text boundaries
+      keep the format of `low`: dates stay dates.
+  """
+  text_format = None
+  if isinstance(low, string_types):
+    if len(low) == 10:
+      # Date-only text stays date-only, so boundaries compare as the keys do.
+      text_format = "date"
+      low = datetime.date.fromisoformat(low)
+      high = datetime.date.fromisoformat(high[:10])
+    else:
+      text_format = "T" if "T" in low else " "
+      low = datetime.datetime.fromisoformat(low)
+      high = datetime.datetime.fromisoformat(high)
+
+  if isinstance(low, int):
+    step = max(1, -(-(high - low + 1) // partitions))
+  elif isinstance(low, datetime.datetime):
+    step = (high - low) / partitions
+  elif isinstance(low, datetime.date):
+    step = datetime.timedelta(days=max(1, -(-((high - low).days + 1) // partitions)))
+  else:
+    step = (high - low) / partitions
+
+  starts = [low]
+  # A zero step means every row has the same key: one partition holds all.
+  if step:
+    while len(starts) < partitions and starts[-1] + step <= high:
+      starts.append(starts[-1] + step)
+
+  ranges = [(start, end) for start, end in zip(starts, starts[1:])] + [(starts[-1], None)]
+
+  if text_format:
+    args = () if text_format == "date" else (text_format,)
+    ranges = [
+      (start.isoformat(*args), end.isoformat(*args) if end else None) for start, end in ranges
+    ]
+  return ranges
+
+
+def _export_partition(job):
+  """Writes the rows of one key range to its shard file."""
+  db_url, sql, args, path, format, kwargs = job
+
+  db = create_database(db_url, **kwargs)
+  try:
+    # The next batches are fetched while the current one is written.
+    rows = db.query(sql, *args, stream=True, prefetch=2)
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as output:
+      writer = None
+      # Batches aren't kept in the collection, so memory use stays flat.
+      for batch in rows.iter_batches(1000):
+        if format == "csv":
+          if writer is None:
+            writer = csv.writer(output)
+            writer.writerow(batch[0].keys())
+          writer.writerows(row.values() for row in batch)
+        else:
+          output.write("".join(json_dumps(row.as_dict()) + "\n" for row in batch))
+        count += len(batch)
+  finally:
+    db.close()
+
+  return path, count
+
@@ -0,0 +1,243 @@
+# coding: utf-8
+"""
+Coalesces lookups by key into one `IN` query per batch.
+
+Handlers that fetch rows one key at a time (the N+1 pattern) pay a
+round-trip per key. A loader collects the keys asked for while a batch is
+open, fetches them all with a single `Database.query_in` when it closes,
+and hands each caller its rows. Results are memoized for the loader's
+lifetime, so create one per request.
+
+    users = Loader(db, 'SELECT * FROM users WHERE {in}', 'id')
+    with users.batch():
+      author = users.load(post.author_id)
+      editor = users.load(post.editor_id)
+    author.result().name
+
+    users = AsyncLoader(db, 'SELECT * FROM users WHERE {in}', 'id')
+    author, editor = await asyncio.gather(users.load(1), users.load(2))
+"""
+from __future__ import unicode_literals, print_function, absolute_import, with_statement
+
+import asyncio
+import threading
+import weakref
+from contextlib import contextmanager
+
+#: One lock per Database, held by the AsyncLoader batch using its connection
+_db_locks = weakref.WeakKeyDictionary()
+_db_locks_guard = threading.Lock()
+
+
+def _lock_for(db):
+  with _db_locks_guard:
+    lock = _db_locks.get(db)
+    if lock is None:
+      lock = _db_locks[db] = threading.Lock()
+    return lock
+
+
+class _BaseLoader(object):
+  def __init__(self, db, sql, key_column, *args, **kwargs):
+    """
+    Args:
+        db (Database): where the rows are read from
+        sql (str): the statement, with `{in}` where the key condition goes.
+            It must select `key_column`.
+        key_column (str): the column the keys are looked up in
+        *args: values for the statement's other placeholders
+        **kwargs:
+            many: map each key to the list of its rows instead of to its
+                only row. Defaults to False.
+            Anything else is passed on to `Database.query_in`.
+    """
+    self.db = db
+    self.sql = sql
+    self.key_column = key_column
+    self.many = kwargs.pop("many", False)
+    self._args = args
+    self._kwargs = kwargs
+    self._cache = {}
+
+  def _fetch(self, keys):
+    """Runs one query for `keys` and returns a dict of key to result.
+
+    Keys without rows map to None, or to an empty list with `many`.
+    """
+    rows = self.db.query_in(self.sql, self.key_column, keys, *self._args, **self._kwargs)
+    found = {}
+    for row in rows if rows is not None else ():
+      key = row[self.key_column]
+      if self.many:
+        found.setdefault(key, []).append(row)
+      else:
+        found.setdefault(key, row)
+    return dict((key, found.get(key, [] if self.many else None)) for key in keys)
+
+  def clear(self, key=None):
+    """Forgets the memoized result of `key`, or of every key."""
+    if key is None:
+      self._cache.clear()
+    else:
+      self._cache.pop(key, None)
+
+
+class Loader(_BaseLoader):
+  """Batches the `load` calls made within a `batch()` scope.
+
+  Inside the scope `load` returns a `LoadResult` right away, and the keys
+  are fetched together when the scope exits or when a result is first
+  asked for, whichever comes first. Outside of a scope each `load` is
+  fetched on its own.
+  """
+
+  def __init__(self, db, sql, key_column, *args, **kwargs):
+    super(Loader, self).__init__(db, sql, key_column, *args, **kwargs)
+    self._pending = []
+    self._depth = 0
+
+  @contextmanager
+  def batch(self):
+    """Collects the keys loaded in the scope and fetches them on exit.
+
+    Scopes can be nested, the outermost one fetches.
+    """
+    self._depth += 1
+    try:
+      yield self
+    finally:
+      self._depth -= 1
+      if self._depth == 0:
+        self.dispatch()
+
+  def load(self, key):
+    """Returns the `LoadResult` of `key`."""
+    if key not in self._cache:
+      self._cache[key] = LoadResult(self)
+      self._pending.append((key, self._cache[key]))
+      if self._depth == 0:
+        self.dispatch()
+    return self._cache[key]
+
+  def load_many(self, keys):
+    """Fetches the keys not loaded yet in one query and returns their results."""
+    with self.batch():
+      results = [self.load(key) for key in keys]
+    return [result.result() for result in results]
+
+  def prime(self, key, value):
+    """Memoizes `value` as the result of `key`, unless it's loaded already."""
+    if key not in self._cache:
+      result = self._cache[key] = LoadResult(self)
+      result._resolve(value)
+
+  def dispatch(self):
+    """Fetches the pending keys now."""
+    pending, self._pending = self._pending, []
+    if not pending:
+      return
+    keys, results = zip(*pending)
+
+    try:
+      values = self._fetch(keys)
+    except Exception as exception:
+      for key, result in zip(keys, results):
+        # Failed keys aren't memoized, loading them again retries.
+        if self._cache.get(key) is result:
+          del self._cache[key]
+        result._reject(exception)
+      raise
+
+    for key, result in zip(keys, results):
+      result._resolve(values[key])
+
+
+class LoadResult(object):
+  """The result of a key loaded in a batch, available once it's fetched."""
+
+  def __init__(self, loader):
+    self._loader = loader
+    self._done = False
+    self._value = None
+    self._exception = None
+
+  def done(self):
+    """Tells whether the key was fetched already."""
+    return self._done
+
+  def result(self):
+    """Returns the key's row, or rows. Fetches the pending batch if needed.
+
+    Raises:
+        Exception: whatever the batch's query raised.
+    """
+    if not self._done:
+      self._loader.dispatch()
+    if self._exception is not None:
+      raise self._exception
+    return self._value
+
+  def _resolve(self, value):
+    self._value, self._done = value, True
+
+  def _reject(self, exception):
+    self._exception, self._done = exception, True
+
+
+class AsyncLoader(_BaseLoader):
+  """Batches the `load` calls made within one tick of the event loop.
+
+  The keys are fetched together once the tasks that asked for them yield
+  to the loop. `Database` is synchronous, so the query runs in the loop's
+  default executor, one batch at a time per `Database`, whichever loader
+  it's from. Don't query the same `Database` from the loop thread while
+  batches may be running.
+  """
+
+  def __init__(self, db, sql, key_column, *args, **kwargs):
+    super(AsyncLoader, self).__init__(db, sql, key_column, *args, **kwargs)
+    self._pending = []
+    self._lock = _lock_for(db)
+
+  def load(self, key):
+    """Returns an awaitable for the result of `key`."""
+    if key not in self._cache:
+      loop = asyncio.get_running_loop()
+      if not self._pending:
+        loop.call_soon(self._dispatch, loop)
+      self._cache[key] = loop.create_future()
+      self._pending.append((key, self._cache[key]))
+    return self._cache[key]
+
+  async def load_many(self, keys):
+    """Returns the results of `keys`, fetched in one batch."""
+    return await asyncio.gather(*[self.load(key) for key in keys])
+
+  def prime(self, key, value):
+    """Memoizes `value` as the result of `key`, unless it's loaded already."""
+    if key not in self._cache:
+      future = self._cache[key] = asyncio.get_running_loop().create_future()
+      future.set_result(value)
+
+  def _dispatch(self, loop):
+    pending, self._pending = self._pending, []
+    keys, futures = zip(*pending)
+    task = loop.run_in_executor(None, self._fetch_locked, keys)
+    task.add_done_callback(lambda task: self._settle(keys, futures, task))
+
+  def _fetch_locked(self, keys):
+    with self._lock:
+      return self._fetch(keys)
+
+  def _settle(self, keys, futures, task):
+    exception = task.exception()
+    for key, future in zip(keys, futures):
+      if exception is not None and self._cache.get(key) is future:
+        # Failed keys aren't memoized, loading them again retries.
+        del self._cache[key]
+      if future.done():
+        continue
+      if exception is not None:
+        future.set_exception(exception)
+      else:
+        future.set_result(task.result()[key])
@@ -1,16 +1,67 @@
 # coding: utf-8
 import os
+from collections import OrderedDict
+
 import pymysql
 import pymysql.cursors
+from pymysql.constants import FIELD_TYPE
 
 from ezrecords.abstractdb import Database
+from ezrecords.options import boolean, positive
+from ezrecords.plans import parse_mysql_analyze, parse_mysql_plan
+from ezrecords.records import Record
+from ezrecords.util import is_read_statement
+
+
+def _compress(value):
+  if boolean(value):
+    raise ValueError("PyMySQL doesn't support protocol compression")
+  return False
 
 
 class MySQLDb(Database):
-  def __init__(self, db_url=None, logger=None):
-    super(MySQLDb, self).__init__(db_url=db_url, logger=logger)
+  CONNECTION_OPTIONS = {
+    # Seconds to wait for the connection, and for each read and write on it
+    "connect_timeout": (positive(float), 10),
+    "read_timeout": (positive(float), None),
+    "write_timeout": (positive(float), None),
+    "compress": (_compress, False),
+    "autocommit": (boolean, False),
+  }
+
+  SCRIPT_SYNTAX = {"backslash_escapes": True, "dollar_quotes": False, "hash_comments": True}
+
+  def __init__(self, db_url=None, logger=None, **kwargs):
+    super(MySQLDb, self).__init__(db_url=db_url, logger=logger, **kwargs)
     self._placeholder = "%s"
 
+    #: (innodb_autoinc_lock_mode, auto_increment_increment), once read
+    self._autoinc = None
+    self._max_params = 65535
+
+    self._type_codes = {
+      FIELD_TYPE.BIT: "int",
+      FIELD_TYPE.TINY: "int",
+      FIELD_TYPE.SHORT: "int",
+      FIELD_TYPE.LONG: "int",
+      FIELD_TYPE.INT24: "int",
+      FIELD_TYPE.LONGLONG: "int",
+      FIELD_TYPE.YEAR: "int",
+      FIELD_TYPE.FLOAT: "float",
+      FIELD_TYPE.DOUBLE: "float",
+      FIELD_TYPE.DECIMAL: "decimal",
+      FIELD_TYPE.NEWDECIMAL: "decimal",
+      FIELD_TYPE.DATE: "date",
+      FIELD_TYPE.DATETIME: "datetime",
+      FIELD_TYPE.TIMESTAMP: "datetime",
+      FIELD_TYPE.TIME: "time",
+      FIELD_TYPE.VARCHAR: "text",
+      FIELD_TYPE.VAR_STRING: "text",
+      FIELD_TYPE.STRING: "text",
+      FIELD_TYPE.JSON: "text",
+      FIELD_TYPE.ENUM: "text",
+    }
+
   def _connect(self):
     if self._connection is None:
       """
@@ -27,6 +78,20 @@ class MySQLDb(Database):
       )
       DB_TIMEZONE = os.getenv("DB_TIMEZONE", "'+2:00'")
 
+      # Default MySQL behavior to conform more closely to SQL standards.
+      # This allows to run almost seamlessly on many different kinds of database systems.
+      # These settings force MySQL to behave the same as Postgres or SQLite
+      # in regards to syntax interpretation and invalid data handling. See
+      # https://www.drupal.org/node/344575 for further discussion. Also, as MySQL
+      # 5.5 changed the meaning of TRADITIONAL we need to spell out the modes one by one
+      init_command = "SET SESSION sql_mode = %s, SESSION time_zone = %s" % (
+        DB_SQL_MODE,
+        DB_TIMEZONE,
+      )
+
+      # The session is set up while connecting: PyMySQL sends SET NAMES for
+      # the charset and collation, which also covers the results' charset,
+      # then the init_command, in one round-trip each.
       self._connection = pymysql.connect(
         host=self._host,
         user=self._user,
@@ -34,26 +99,17 @@ class MySQLDb(Database):
         database=self._database,
         port=self._port,
         charset=DB_CHARSET,
+        collation=DB_COLLATION,
+        init_command=init_command,
         cursorclass=pymysql.cursors.DictCursor,
+        connect_timeout=self.options["connect_timeout"],
+        read_timeout=self.options["read_timeout"],
+        write_timeout=self.options["write_timeout"],
+        autocommit=self.options["autocommit"],
         # persistent
       )
-
-      # Force MySQL to UTF-8 Encodingclear
-      self.set_charset(DB_CHARSET, DB_COLLATION)
-      # self.query("SET NAMES %s COLLATE %s" % (DB_CHARSET, DB_COLLATION))
-      # self.query("SET CHARACTER_SET_RESULTS='%s'" % DB_CHARSET)
-
-      # Default MySQL behavior to conform more closely to SQL standards.
-      # This allows to run almost seamlessly on many different kinds of database systems.
-      # These settings force MySQL to behave the same as Postgres or SQLite
-      # in regards to syntax interpretation and invalid data handling. See
-      # https://www.drupal.org/node/344575 for further discussion. Also, as MySQL
-      # 5.5 changed the meaning of TRADITIONAL we need to spell out the modes one by one
-      self.query(
-        "SET SESSION sql_mode = %s" % DB_SQL_MODE
-      )  # Force MySQL ANSI compatibilities
-
-      self.query("SET SESSION time_zone = %s" % DB_TIMEZONE)
+      self._charset = DB_CHARSET
+      self._collate = DB_COLLATION
 
   def _set_charset(self, charset, collate=None):
     sql = "SET NAMES %s" % charset
@@ -61,8 +117,125 @@ class MySQLDb(Database):
     if collate is not None:
       sql += " COLLATE %s" % collate
 
+    # SET NAMES also sets character_set_results.
     self.query(sql)
-    self.query("SET CHARACTER_SET_RESULTS=%s", charset)
+
+  def _stream_cursor(self):
+    # Unbuffered cursor: rows are read off the socket as they are fetched.
+    return self._connection.cursor(pymysql.cursors.SSDictCursor)
+
+  def _resolve_timeout(self, sql, timeout):
+    # MAX_EXECUTION_TIME only bounds read-only SELECT statements, so giving
+    # another statement a timeout is an error. The default one stays armed
+    # for them, saving a SET, but it doesn't bound them.
+    if timeout and not is_read_statement(sql):
+      raise ValueError("MySQL can only time out SELECT statements, not: %s" % sql)
+    return super(MySQLDb, self)._resolve_timeout(sql, timeout)
+
+  def _set_timeout(self, cursor, timeout):
+    milliseconds = int(timeout * 1000) if timeout else 0
+    if milliseconds != self._session_timeout:
+      with self._connection.cursor() as session_cursor:
+        session_cursor.execute("SET SESSION max_execution_time = %s", (milliseconds,))
+      self._session_timeout = milliseconds
+
+  def _is_timeout_error(self, exception):
+    # 3024: ER_QUERY_TIMEOUT (MySQL), 1969: ER_STATEMENT_TIMEOUT (MariaDB)
+    return isinstance(exception, pymysql.err.OperationalError) and (
+      exception.args[0] in (3024, 1969)
+    )
+
+  def _keyset_condition(self, key_columns):
+    # MySQL only uses an index range for row value comparisons in recent
+    # versions, so spell out `a > %s OR (a = %s AND b > %s)` instead.
+    conditions = []
+    for i, column in enumerate(key_columns):
+      equals = ['"%s" = %%s' % previous for previous in key_columns[:i]]
+      conditions.append("(" + " AND ".join(equals + ['"%s" > %%s' % column]) + ")")
+    return "(" + " OR ".join(conditions) + ")"
+
+  def _keyset_values(self, last_key):
+    values = []
+    for i in range(len(last_key)):
+      values.extend(last_key[: i + 1])
+    return values
+
+  def _upsert_clause(self, conflict_columns, update_columns):
+    # MySQL resolves conflicts on any unique key, it can't be told which.
+    if not update_columns:
+      # There's no DO NOTHING, so update a key column to itself instead.
+      column = conflict_columns[0]
+      return ' ON DUPLICATE KEY UPDATE "%s" = "%s"' % (column, column)
+
+    return " ON DUPLICATE KEY UPDATE " + ", ".join(
+      '"%s" = VALUES("%s")' % (column, column) for column in update_columns
+    )
+
+  def _run_upsert(self, table, sql, columns, batch, conflict_columns, update_columns, timeout):
+    # MySQL counts 1 affected row per insert, 2 per update and 0 per row
+    # already holding the new values, so the statement's count can't tell
+    # them apart. Count the existing keys first instead, locked until the
+    # upsert commits. Rows left unchanged count as updated, as on Postgres.
+    if not update_columns:
+      self.query(sql, *[value for row in batch for value in row], timeout=timeout)
+      return self.affected_rows, 0
+
+    with self.transaction():
+      existing = self._count_existing(table, columns, batch, conflict_columns, timeout, lock=True)
+      self.query(sql, *[value for row in batch for value in row], timeout=timeout)
+    return len(batch) - existing, existing
+
+  def _insert_returning(self, table, columns, batch, returning, timeout):
+    # No RETURNING in MySQL. A multi-row INSERT takes its AUTO_INCREMENT
+    # values in one block, and LAST_INSERT_ID() is the first of them,
+    # unless the lock mode lets concurrent inserts interleave theirs.
+    if len(returning) != 1 or returning[0] in columns:
+      raise ValueError("MySQL can only return the generated AUTO_INCREMENT column.")
+
+    if self._autoinc is None:
+      row = self.query_one(
+        "SELECT @@innodb_autoinc_lock_mode AS lock_mode, @@auto_increment_increment AS step"
+      )
+      self._autoinc = (int(row["lock_mode"]), int(row["step"]))
+    lock_mode, step = self._autoinc
+    if lock_mode == 2:
+      # Interleaved ids (the MySQL 8 default) can't be told apart without a
+      # round-trip per row, which is what bulk inserts are meant to avoid.
+      raise ValueError(
+        "bulk_insert can't return ids with innodb_autoinc_lock_mode = 2; "
+        "set it to 1 or insert the rows with insert()."
+      )
+
+    self.query(
+      self._insert_sql(table, columns, len(batch)),
+      *[value for row in batch for value in row],
+      timeout=timeout,
+    )
+    # The server sends LAST_INSERT_ID() with the result, as lastrowid.
+    first = self.last_insert_id
+    return [Record(list(returning), [first + i * step]) for i in range(len(batch))]
+
+  def _is_retryable_error(self, exception):
+    # ER_LOCK_DEADLOCK and ER_LOCK_WAIT_TIMEOUT
+    return isinstance(exception, pymysql.err.MySQLError) and (
+      bool(exception.args) and exception.args[0] in (1213, 1205)
+    )
+
+  def _begin(self, isolation_level, read_only, deferrable):
+    # SET TRANSACTION applies to the next transaction only.
+    if isolation_level:
+      self.query("SET TRANSACTION ISOLATION LEVEL %s" % isolation_level)
+    self.query("START TRANSACTION READ ONLY" if read_only else "START TRANSACTION")
+
+  def _explain(self, sql, args, analyze, timeout):
+    if analyze:
+      # EXPLAIN ANALYZE (8.0.18+) only prints the tree format.
+      raw = self.query("EXPLAIN ANALYZE " + sql, *args, timeout=timeout, one=True)[0]
+      return raw, parse_mysql_analyze(raw), []
+
+    raw = self.query("EXPLAIN FORMAT=JSON " + sql, *args, timeout=timeout, one=True)[0]
+    nodes, warnings = parse_mysql_plan(raw)
+    return raw, nodes, warnings
 
   def _db_version(self):
     sql = "SELECT version() as version"
@@ -73,13 +246,7 @@ class MySQLDb(Database):
   def use(self, db_name):
     """Selects a new database to work with"""
     self._connection.select_db(db_name)
-
-  def exists(self, name, kind="table", schema="public"):
-    rv = self.query_one(
-      "SELECT COUNT(*) as table_count FROM information_schema.tables WHERE table_schema = database() AND table_name = %s",
-      name,
-    )
-    return bool(rv["table_count"])
+    self.refresh()
 
   def set_sql_mode(self, modes):
     """Changes the current SQL mode.
@@ -103,3 +270,46 @@ WHERE table_schema = database()
 ORDER BY 1 -- (data_length + index_length) DESC
         """
     return self.query(sql)
+
+  #: information_schema.tables.table_type of each kind `exists` looks up
+  OBJECT_KINDS = {"table": "BASE TABLE", "view": "VIEW"}
+
+  def _exists(self, name, kind, schema):
+    if kind not in self.OBJECT_KINDS:
+      raise ValueError("kind must be one of %s." % ", ".join(sorted(self.OBJECT_KINDS)))
+    # There are no schemas apart from databases, 'public' is the current one.
+    sql = (
+      "SELECT COUNT(*) AS table_count FROM information_schema.tables "
+      "WHERE table_name = %s AND table_type = %s AND table_schema = "
+    )
+    if schema == "public":
+      rv = self.query_one(sql + "database()", name, self.OBJECT_KINDS[kind])
+    else:
+      rv = self.query_one(sql + "%s", name, self.OBJECT_KINDS[kind], schema)
+    return bool(rv["table_count"])
+
+  def _load_table_metadata(self, table):
+    columns = self.query(
+      "SELECT column_name AS name, column_type AS type FROM information_schema.columns "
+      "WHERE table_schema = database() AND table_name = %s ORDER BY ordinal_position",
+      table,
+    ).all()
+    if not columns:
+      return None
+
+    indexes = OrderedDict()
+    for row in self.query(
+      "SELECT index_name AS name, non_unique, column_name FROM information_schema.statistics "
+      "WHERE table_schema = database() AND table_name = %s ORDER BY index_name, seq_in_index",
+      table,
+    ):
+      index = indexes.setdefault(
+        row["name"], {"name": row["name"], "columns": [], "unique": not row["non_unique"]}
+      )
+      index["columns"].append(row["column_name"])
+
+    return {
+      "columns": OrderedDict((column["name"], column["type"]) for column in columns),
+      "primary_key": indexes["PRIMARY"]["columns"] if "PRIMARY" in indexes else [],
+      "indexes": list(indexes.values()),
+    }
@@ -0,0 +1,102 @@
+# coding: utf-8
+"""
+Typed connection options, read from the query string of the db URL.
+
+Each driver declares the options it understands as a dict of option name
+to `(converter, default)`. The converters turn the URL's text into the
+option's type and raise ValueError for values they don't accept, so a bad
+URL fails when the `Database` is created rather than on first use.
+
+    sqlite:///app.db?cache_size=-64000&synchronous=NORMAL
+    postgres://app@db/app?application_name=worker&sslmode=require
+"""
+from __future__ import unicode_literals, print_function, absolute_import, with_statement
+
+_TRUE = ("1", "true", "yes", "on")
+_FALSE = ("0", "false", "no", "off")
+
+
+def boolean(value):
+  """Converts 1/0, true/false, yes/no or on/off."""
+  text = value.lower()
+  if text in _TRUE:
+    return True
+  if text in _FALSE:
+    return False
+  raise ValueError("expected one of %s" % ", ".join(_TRUE + _FALSE))
+
+
+def choice(*allowed):
+  """Returns a converter accepting only the given values, in any case.
+
+  Values are returned as spelled in `allowed`.
+  """
+  by_key = dict((value.lower(), value) for value in allowed)
+
+  def convert(value):
+    try:
+      return by_key[value.lower()]
+    except KeyError:
+      raise ValueError("expected one of %s" % ", ".join(allowed))
+
+  return convert
+
+
+def non_negative(convert):
+  """Returns a converter rejecting the negative values of `convert`."""
+
+  def check(value):
+    value = convert(value)
+    if value < 0:
+      raise ValueError("must not be negative")
+    return value
+
+  return check
+
+
+def positive(convert):
+  """Returns a converter rejecting zero and the negative values of `convert`."""
+
+  def check(value):
+    value = convert(value)
+    if value <= 0:
+      raise ValueError("must be greater than zero")
+    return value
+
+  return check
+
+
+def parse_options(query, spec):
+  """Converts the URL's query string arguments to typed options.
+
+  Args:
+      query (dict): the `query` component of `parse_db_url`, may be None
+      spec (dict): option name to `(converter, default)`
+
+  Returns:
+      dict: every option in `spec`, with its converted value or default
+
+  Raises:
+      ValueError: If an option is unknown or its value invalid.
+  """
+  query = query or {}
+  unknown = sorted(set(query) - set(spec))
+  if unknown:
+    raise ValueError(
+      "Unknown connection option(s) %s. Supported: %s."
+      % (", ".join(unknown), ", ".join(sorted(spec)) or "none")
+    )
+
+  options = {}
+  for name, (convert, default) in spec.items():
+    if name not in query:
+      options[name] = default
+      continue
+    value = query[name]
+    try:
+      options[name] = convert(value)
+    except ValueError as exception:
+      raise ValueError(
+        "Invalid value %r for connection option '%s': %s" % (value, name, exception)
+      )
+  return options
@@ -0,0 +1,271 @@
+# coding: utf-8
+"""
+Normalization of query plans returned by each dialect's EXPLAIN.
+
+Every plan is flattened into a list of nodes, in the order the engine
+reports them, each a dict with the same keys whatever the dialect:
+
+    operation     the engine's name for the step ('Seq Scan', 'ALL', 'SCAN')
+    table         the table read by the step, if any
+    index         the index used by the step, if any
+    rows          the estimated number of rows, if known
+    cost          the estimated cost, in the engine's own units, if known
+    actual_rows   the rows actually produced, when the plan was analyzed
+    filter        the condition applied to the rows read, if known
+    full_scan     True when the step reads the whole table
+    depth         nesting level of the step in the plan tree
+"""
+from __future__ import unicode_literals, print_function, absolute_import, with_statement
+
+import json
+import re
+
+from ezrecords.compat import string_types
+
+
+def plan_node(
+  operation,
+  table=None,
+  index=None,
+  rows=None,
+  cost=None,
+  actual_rows=None,
+  filter=None,
+  full_scan=False,
+  depth=0,
+):
+  """Returns a normalized plan node, see the module docstring."""
+  return {
+    "operation": operation,
+    "table": table,
+    "index": index,
+    "rows": rows,
+    "cost": cost,
+    "actual_rows": actual_rows,
+    "filter": filter,
+    "full_scan": full_scan,
+    "depth": depth,
+  }
+
+
+def plan_warnings(nodes):
+  """Flags the full table scans of a plan.
+
+  A full scan that filters rows is flagged as a likely missing index, as
+  an index on the filtered columns would let the engine skip the rest.
+
+  Returns:
+      list: warning messages
+  """
+  warnings = []
+  for node in nodes:
+    if not node["full_scan"] or not node["table"]:
+      continue
+    if node["filter"]:
+      warnings.append(
+        "Missing index: full scan of '%s' filtered by %s." % (node["table"], node["filter"])
+      )
+    else:
+      warnings.append("Full scan of '%s'." % node["table"])
+  return warnings
+
+
+def _number(value):
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return None
+
+
+# ----------------------------------------------------------------------
+# Postgres
+# ----------------------------------------------------------------------
+
+
+def parse_postgres_plan(raw):
+  """Flattens the output of `EXPLAIN (FORMAT JSON)`.
+
+  Args:
+      raw (list|str): the single value returned by the EXPLAIN
+
+  Returns:
+      list: normalized nodes
+  """
+  if isinstance(raw, string_types):
+    raw = json.loads(raw)
+
+  nodes = []
+
+  def walk(plan, depth):
+    nodes.append(
+      plan_node(
+        plan["Node Type"],
+        table=plan.get("Relation Name"),
+        index=plan.get("Index Name"),
+        rows=_number(plan.get("Plan Rows")),
+        cost=_number(plan.get("Total Cost")),
+        actual_rows=_number(plan.get("Actual Rows")),
+        filter=plan.get("Filter"),
+        full_scan=plan["Node Type"] in ("Seq Scan", "Parallel Seq Scan"),
+        depth=depth,
+      )
+    )
+    for child in plan.get("Plans", []):
+      walk(child, depth + 1)
+
+  for statement in raw:
+    walk(statement["Plan"], 0)
+  return nodes
+
+
+# ----------------------------------------------------------------------
+# MySQL
+# ----------------------------------------------------------------------
+
+
+def parse_mysql_plan(raw):
+  """Flattens the output of `EXPLAIN FORMAT=JSON`.
+
+  Returns:
+      tuple: (normalized nodes, warnings about filesorts and temporary
+      tables, which MySQL only reports on the enclosing operation)
+  """
+  if isinstance(raw, string_types):
+    raw = json.loads(raw)
+
+  nodes = []
+  warnings = []
+
+  def walk(value, depth):
+    if isinstance(value, list):
+      for item in value:
+        walk(item, depth)
+      return
+    if not isinstance(value, dict):
+      return
+
+    if value.get("using_filesort"):
+      warnings.append("Sort without an index (filesort).")
+    if value.get("using_temporary_table"):
+      warnings.append("Temporary table used for grouping or sorting.")
+
+    table = value.get("table")
+    if isinstance(table, dict) and "table_name" in table:
+      cost_info = table.get("cost_info", {})
+      nodes.append(
+        plan_node(
+          table.get("access_type"),
+          table=table["table_name"],
+          index=table.get("key"),
+          rows=_number(table.get("rows_examined_per_scan")),
+          cost=_number(cost_info.get("prefix_cost") or cost_info.get("read_cost")),
+          filter=table.get("attached_condition"),
+          full_scan=table.get("access_type") == "ALL",
+          depth=depth,
+        )
+      )
+
+    for key, child in value.items():
+      if isinstance(child, (dict, list)):
+        walk(child, depth + 1)
+
+  walk(raw, 0)
+  return nodes, warnings
+
+
+_MYSQL_ANALYZE_LINE = re.compile(
+  r"^(?P<indent>\s*)-> (?P<operation>.+?)"
+  r"(?:\s+\(cost=(?P<cost>[\d.e+]+) rows=(?P<rows>[\d.e+]+)\))?"
+  r"(?:\s+\(actual time=[\d.]+\.\.[\d.]+ rows=(?P<actual_rows>[\d.e+]+) loops=\d+\))?"
+  r"(?:\s+\(never executed\))?\s*$"
+)
+_MYSQL_TABLE = re.compile(r"\bon (?P<table>\w+)(?: using (?P<index>\w+))?")
+
+
+def parse_mysql_analyze(text):
+  """Flattens the tree printed by `EXPLAIN ANALYZE` (MySQL 8.0.18+)."""
+  nodes = []
+  for line in text.splitlines():
+    match = _MYSQL_ANALYZE_LINE.match(line)
+    if match is None:
+      continue
+    operation = match.group("operation")
+    table = _MYSQL_TABLE.search(operation)
+    filter = None
+    if operation.startswith("Filter: "):
+      filter = operation[len("Filter: ") :]
+    nodes.append(
+      plan_node(
+        operation,
+        table=table.group("table") if table else None,
+        index=table.group("index") if table else None,
+        rows=_number(match.group("rows")),
+        cost=_number(match.group("cost")),
+        actual_rows=_number(match.group("actual_rows")),
+        filter=filter,
+        full_scan=operation.startswith("Table scan on "),
+        depth=len(match.group("indent")) // 4,
+      )
+    )
+
+  # The filter is printed as the parent of the scan it applies to.
+  for parent, child in zip(nodes, nodes[1:]):
+    if parent["filter"] and child["full_scan"] and child["depth"] == parent["depth"] + 1:
+      child["filter"] = parent["filter"]
+  return nodes
+
+
+# ----------------------------------------------------------------------
+# SQLite
+# ----------------------------------------------------------------------
+
+_SQLITE_STEP = re.compile(
+  r"^(?P<operation>SCAN|SEARCH)(?: TABLE)? (?P<table>\S+)(?: AS \S+)?"
+  r"(?: USING (?P<automatic>AUTOMATIC )?(?:COVERING |PARTIAL )*INDEX(?: (?P<index>[^\s(]\S*))?"
+  r"| USING (?:INTEGER )?PRIMARY KEY)?"
+)
+
+
+def parse_sqlite_plan(rows):
+  """Flattens the rows returned by `EXPLAIN QUERY PLAN`.
+
+  Args:
+      rows (list): (id, parent, notused, detail) rows, as dicts or tuples
+
+  Returns:
+      tuple: (normalized nodes, warnings about automatic indexes and
+      temporary b-trees)
+  """
+  nodes = []
+  warnings = []
+  depths = {0: -1}
+  for row in rows:
+    if isinstance(row, dict):
+      id, parent, detail = row["id"], row["parent"], row["detail"]
+    else:
+      id, parent, detail = row[0], row[1], row[3]
+    depth = depths.get(parent, -1) + 1
+    depths[id] = depth
+
+    match = _SQLITE_STEP.match(detail)
+    if match is None:
+      if "TEMP B-TREE" in detail:
+        warnings.append("Temporary b-tree used: %s." % detail.lower())
+      nodes.append(plan_node(detail, depth=depth))
+      continue
+
+    if match.group("automatic"):
+      warnings.append(
+        "Missing index: SQLite built a temporary index on '%s' (%s)."
+        % (match.group("table"), detail)
+      )
+    nodes.append(
+      plan_node(
+        match.group("operation"),
+        table=match.group("table"),
+        index=match.group("index"),
+        full_scan=match.group("operation") == "SCAN" and " USING " not in detail,
+        depth=depth,
+      )
+    )
+  return nodes, warnings
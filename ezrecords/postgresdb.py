@@ -1,19 +1,77 @@
 # coding: utf-8
+import re
+from collections import OrderedDict
+from timeit import default_timer as timer
+
 import psycopg2
+import psycopg2.errorcodes
 import psycopg2.extras
 import psycopg2.extensions
 
 from ezrecords.abstractdb import Database
+from ezrecords.options import boolean, choice, non_negative, positive
+from ezrecords.plans import parse_postgres_plan
+from ezrecords.records import Record, RecordCollection
+from ezrecords.util import chunked
 
-# My database is Unicode, but I receive all strings as UTF-8 `str`.
-# Can I receive unicode `objects` instead?
-psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
-psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
+# INSERT ... VALUES with one row of values, nested parentheses allowed once.
+# No literal may come before the row, where VALUES could be quoted text.
+_SINGLE_ROW_INSERT = re.compile(
+  r"^\s*INSERT\b[^'\"$]*?\bVALUES\s*(?P<row>\((?:[^()]|\([^()]*\))*\))(?!\s*,)",
+  re.IGNORECASE,
+)
 
 
 class PostgresDb(Database):
-  def __init__(self, db_url=None, logger=None):
-    super(PostgresDb, self).__init__(db_url=db_url, logger=logger)
+  CONNECTION_OPTIONS = {
+    "application_name": (str, None),
+    # Milliseconds, the default for statements run without a timeout
+    "statement_timeout": (non_negative(int), None),
+    # Seconds to wait for the connection
+    "connect_timeout": (positive(int), None),
+    # TCP keepalives, to notice dead connections behind firewalls and NATs
+    "keepalives": (boolean, None),
+    "keepalives_idle": (positive(int), None),
+    "keepalives_interval": (positive(int), None),
+    "keepalives_count": (positive(int), None),
+    "sslmode": (choice("disable", "allow", "prefer", "require", "verify-ca", "verify-full"), None),
+  }
+
+  def __init__(self, db_url=None, logger=None, **kwargs):
+    super(PostgresDb, self).__init__(db_url=db_url, logger=logger, **kwargs)
+    self._max_params = 65535
+
+    # Statements without a timeout of their own keep the URL's, which is
+    # already set on the session.
+    if self.timeout is None and self.options["statement_timeout"]:
+      self.timeout = self.options["statement_timeout"] / 1000.0
+
+    #: Number of server-side cursors opened, used to name them
+    self._stream_cursors = 0
+
+    #: A connection of a closed stream, kept for the next one
+    self._idle_stream_connection = None
+
+    self._type_codes = {
+      16: "bool",
+      20: "int",
+      21: "int",
+      23: "int",
+      26: "int",
+      700: "float",
+      701: "float",
+      1700: "decimal",
+      1082: "date",
+      1114: "datetime",
+      1184: "datetime",
+      1083: "time",
+      18: "text",
+      19: "text",
+      25: "text",
+      1042: "text",
+      1043: "text",
+      17: "bytes",
+    }
 
   def _connect(self):
     # Psycopg automatically converts Postgres JSON data into Python objects.
@@ -21,19 +79,14 @@ class PostgresDb(Database):
     # psycopg2.extras.register_default_json(loads=lambda x: x)  # if enabled PQ stops working
 
     if self._connection is None:
-      self._connection = psycopg2.connect(
-        dbname=self._database,
-        user=self._user,
-        password=self._password,
-        host=self._host,
-        port=self._port,
-        cursor_factory=psycopg2.extras.DictCursor,
-      )
-
-      # psycopg2 starts a new transaction on connection opening by default,
-      # that means we have to commit after every statement and we don't want that.
-      # if I want a transaction I'll start by hand.
-      self._connection.rollback()  # rollback implicit transaction first. http://stackoverflow.com/questions/39028663/unable-to-set-psycopg2-autocommit-after-shp2pgsql-import
+      self._connection = self._open_connection()
+      if self.options["statement_timeout"] is not None:
+        self._session_timeout = self.options["statement_timeout"]
+
+      # psycopg2 would BEGIN before the first statement and leave every one
+      # in a transaction until committed. Transactions are started by hand.
+      # No statement ran yet, so there's no transaction to roll back and
+      # switching to autocommit is a client-side change, with no round-trip.
       self._connection.autocommit = True
 
       # READCOMMITED
@@ -41,10 +94,297 @@ class PostgresDb(Database):
       # self._connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
       # self.set_charset('utf8')
 
+  def _open_connection(self):
+    # libpq applies these while connecting, without extra round-trips.
+    parameters = dict(
+      (name, value)
+      for name, value in self.options.items()
+      if value is not None and name != "statement_timeout"
+    )
+    if "keepalives" in parameters:
+      parameters["keepalives"] = int(parameters["keepalives"])
+    statement_timeout = self.options["statement_timeout"]
+    if statement_timeout is not None:
+      parameters["options"] = "-c statement_timeout=%d" % statement_timeout
+
+    connection = psycopg2.connect(
+      dbname=self._database,
+      user=self._user,
+      password=self._password,
+      host=self._host,
+      port=self._port,
+      cursor_factory=psycopg2.extras.DictCursor,
+      **parameters
+    )
+
+    # Decode text as `str` on this connection only, rather than for every
+    # psycopg2 connection in the process.
+    psycopg2.extensions.register_type(psycopg2.extensions.UNICODE, connection)
+    psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY, connection)
+    return connection
+
+  def close(self):
+    super(PostgresDb, self).close()
+    connection, self._idle_stream_connection = self._idle_stream_connection, None
+    if connection is not None:
+      connection.close()
+
   def _set_charset(self, charset, collate=None):
     sql = "SET NAMES %s"
     self.query(sql, charset)
 
+  def _stream_cursor(self):
+    # A named cursor is a server-side cursor: fetchmany pulls one batch per
+    # round-trip. It only lives as long as its transaction.
+    self._stream_cursors += 1
+    name = "ezrecords_%d" % self._stream_cursors
+    if self._in_transaction:
+      # psycopg2 only declares WITH HOLD cursors on autocommit connections.
+      # The rows aren't materialized until the transaction commits.
+      return self._connection.cursor(name=name, withhold=True)
+
+    # WITH HOLD would outlive the statement's own transaction by
+    # materializing the whole result when it ends. Stream in a transaction
+    # instead, on a connection of its own so the statements run meanwhile
+    # aren't part of it. Out of autocommit, psycopg2 BEGINs before the
+    # DECLARE.
+    connection, self._idle_stream_connection = self._idle_stream_connection, None
+    if connection is None or connection.closed:
+      connection = self._open_connection()
+    return _StreamCursor(self, connection.cursor(name=name))
+
+  def _begin(self, isolation_level, read_only, deferrable):
+    # The connection stays in autocommit: an explicit BEGIN opens the
+    # transaction, with no set_session round-trips before and after it.
+    sql = "BEGIN"
+    if isolation_level:
+      sql += " ISOLATION LEVEL " + isolation_level
+    if read_only:
+      sql += " READ ONLY"
+    if deferrable:
+      sql += " DEFERRABLE"
+    self.query(sql)
+
+  def _commit(self):
+    self.query("COMMIT")
+
+  def _rollback(self):
+    self.query("ROLLBACK")
+
+  def _set_timeout(self, cursor, timeout):
+    # statement_timeout stays set on the session, so only pay the round-trip
+    # when the deadline differs from the one already in place.
+    milliseconds = int(timeout * 1000) if timeout else 0
+    if isinstance(cursor, _StreamCursor):
+      # Streams have a connection of their own, and a transaction for the
+      # SET LOCAL to end with.
+      if milliseconds != (self.options["statement_timeout"] or 0):
+        with cursor.connection.cursor() as session_cursor:
+          session_cursor.execute("SET LOCAL statement_timeout = %s", (milliseconds,))
+      return
+    if milliseconds != self._session_timeout:
+      # Named cursors run a single statement, so SET on a cursor of its own.
+      with self._connection.cursor() as session_cursor:
+        session_cursor.execute("SET statement_timeout = %s", (milliseconds,))
+      self._session_timeout = milliseconds
+
+  def _is_timeout_error(self, exception):
+    return getattr(exception, "pgcode", None) == psycopg2.errorcodes.QUERY_CANCELED
+
+  def _is_retryable_error(self, exception):
+    return getattr(exception, "pgcode", None) in (
+      psycopg2.errorcodes.SERIALIZATION_FAILURE,
+      psycopg2.errorcodes.DEADLOCK_DETECTED,
+    )
+
+  def _run_upsert(self, table, sql, columns, batch, conflict_columns, update_columns, timeout):
+    # xmax is only set on row versions written by an UPDATE, so it tells
+    # the inserted rows from the updated ones without another query.
+    rows = self.query(
+      sql + " RETURNING (xmax = 0) AS inserted",
+      *[value for row in batch for value in row],
+      timeout=timeout,
+    )
+    inserted = sum(1 for row in rows if row[0])
+    return inserted, len(rows) - inserted
+
+  def bulk_insert(self, table, columns, values, timeout=None, batch_size=1000, returning=None):
+    """Bulk insert, one multi-row INSERT per `batch_size` rows.
+
+    The rows are rendered into the statement by psycopg2's execute_values,
+    so the driver's parameter limit doesn't apply.
+
+    Args:
+        table (str): Table name
+        columns (tuple|list): columns to insert
+        values (iterable): rows of values to insert
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
+        batch_size (int, optional): rows per statement
+        returning (tuple|list, optional): columns of the inserted rows to
+            return, like generated ids
+
+    Returns:
+        int: The number of rows inserted or, with `returning`, a
+        `RecordCollection` of the returned columns, in insertion order.
+
+    Examples:
+        >>> db.bulk_insert('users', ['name'], [('a',), ('b',)], returning=['id'])
+    """
+    sql = "INSERT INTO %s (%s) VALUES %%s" % (table, ", ".join(columns))
+    if returning:
+      sql += " RETURNING " + ", ".join(returning)
+
+    start = timer()
+    values = list(values)
+    rows = self._execute_values(sql, values, batch_size, timeout, fetch=bool(returning))
+    self._record_bulk("bulk_insert", len(values), self.affected_rows, start)
+    if not returning:
+      return self.affected_rows
+    return RecordCollection(Record(list(row.keys()), list(row.values())) for row in rows)
+
+  def executemany(self, sql, values, timeout=None, batch_size=100, count_rows=True):
+    """Runs a statement once for every row of parameters in `values`.
+
+    A single-row `INSERT ... VALUES (...)` is turned into multi-row INSERTs
+    of `batch_size` rows, rendered by psycopg2's execute_values, so it
+    takes one round-trip per batch.
+
+    Other statements are sent `batch_size` at a time by psycopg2's
+    execute_batch when `count_rows` is False. The server only reports the
+    count of each batch's last statement then, so the number of affected
+    rows is unknown. Otherwise they run once per row. Use `bulk_update`
+    for batched updates that are counted.
+
+    Args:
+        sql (str): the SQL statement
+        values (iterable): rows of values for the statement's placeholders
+        timeout (float, optional): Statement timeout in seconds.
+            Defaults to `Database.timeout`
+        batch_size (int, optional): rows, or statements, per round-trip
+        count_rows (bool, optional): False trades the count of affected
+            rows for batched round-trips, see above
+
+    Returns:
+        int: The number of rows affected, or -1 if it isn't counted.
+    """
+    match = _SINGLE_ROW_INSERT.match(sql)
+    if match is None and count_rows:
+      return super(PostgresDb, self).executemany(sql, values, timeout=timeout)
+
+    timeout = self._resolve_timeout(sql, timeout)
+    sql = self.prepare(sql)
+    if match is None:
+      self._execute_batch(sql, [tuple(row) for row in values], batch_size, timeout)
+      return self.affected_rows
+
+    match = _SINGLE_ROW_INSERT.match(sql)
+    self._execute_values(
+      sql[: match.start("row")] + "%s" + sql[match.end("row") :],
+      [tuple(row) for row in values],
+      batch_size,
+      timeout,
+      template=match.group("row"),
+    )
+    return self.affected_rows
+
+  def _execute_batch(self, sql, rows, batch_size, timeout):
+    """Runs `sql` once per row, sending `batch_size` statements per round-trip."""
+    self.connect()
+    cursor = self._connection.cursor()
+    self.last_query = sql
+    try:
+      with self._statement_timeout(cursor, timeout):
+        for page in chunked(rows, batch_size):
+          psycopg2.extras.execute_batch(cursor, sql, page, page_size=len(page))
+          self.queries_executed += 1
+    finally:
+      cursor.close()
+    self.affected_rows = -1
+
+  def _execute_values(self, sql, rows, batch_size, timeout, fetch=False, template=None):
+    """Runs `sql`, whose single `VALUES %s` takes the rows, with at most
+    `batch_size` rows per statement.
+
+    Returns:
+        list: the rows returned by the statements, when `fetch` is True
+    """
+    if timeout is None:
+      timeout = self.timeout
+
+    self.connect()
+    cursor = self._connection.cursor()
+    self.last_query = sql
+
+    affected_rows = 0
+    fetched = []
+    try:
+      with self._statement_timeout(cursor, timeout):
+        # One page per call, to add up the rowcount of every statement.
+        for page in chunked(rows, batch_size):
+          result = psycopg2.extras.execute_values(
+            cursor, sql, page, template=template, page_size=len(page), fetch=fetch
+          )
+          affected_rows += cursor.rowcount
+          if fetch:
+            fetched.extend(result)
+          self.queries_executed += 1
+    finally:
+      cursor.close()
+
+    self.affected_rows = affected_rows
+    return fetched
+
+  def _bulk_update(self, table, rows, key_columns, columns, batch_size, timeout):
+    # Join the table against a VALUES list holding the keys and new values.
+    # VALUES can't infer the column types from parameters, so cast them.
+    names = key_columns + columns
+    metadata = self.table_metadata(table)
+    if metadata is None:
+      raise ValueError("Unknown table '%s'." % table)
+    types = metadata["columns"]
+    for name in names:
+      # The quoted names are case-sensitive, like the catalog.
+      if name not in types:
+        raise ValueError("Unknown column '%s' in table '%s'." % (name, table))
+    sql = 'UPDATE "%s" SET %s FROM (VALUES %%s) AS v (%s) WHERE %s' % (
+      table,
+      ", ".join('"%s" = v."%s"' % (column, column) for column in columns),
+      ", ".join('"%s"' % name for name in names),
+      " AND ".join('"%s"."%s" = v."%s"' % (table, key, key) for key in key_columns),
+    )
+    self._execute_values(
+      sql,
+      ([row[name] for name in names] for row in rows),
+      batch_size,
+      timeout,
+      template="(" + ", ".join("%%s::%s" % types[name] for name in names) + ")",
+    )
+    return self.affected_rows
+
+  def _bulk_delete(self, table, key_column, keys, batch_size, timeout):
+    # The whole chunk is bound as a single array parameter, so the statement
+    # text is the same for every chunk and the parameter limit doesn't apply.
+    sql = 'DELETE FROM "%s" WHERE "%s" = ANY(%%s)' % (table, key_column)
+
+    affected_rows = 0
+    for batch in chunked(keys, batch_size or 10000):
+      self.query(sql, batch, timeout=timeout)
+      affected_rows += self.affected_rows
+
+    self.affected_rows = affected_rows
+    return affected_rows
+
+  def _in_conditions(self, column, values, max_params):
+    # One array parameter whatever the list's length, so there's a single
+    # statement text and no chunks.
+    return [('"%s" = ANY(%%s)' % column, [values])]
+
+  def _explain(self, sql, args, analyze, timeout):
+    options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+    raw = self.query("EXPLAIN (%s) %s" % (options, sql), *args, timeout=timeout, one=True)[0]
+    return raw, parse_postgres_plan(raw), []
+
   def _db_version(self):
     rv = self.get_var(
       "SELECT split_part(ltrim(version(), 'PostgreSQL '), ' ', 1) as server_version;"
@@ -55,17 +395,97 @@ class PostgresDb(Database):
     """select a new database to work with"""
     raise NotImplementedError("Dynamic db switching not allowed in Postgres")
 
-  def exists(self, name, kind="table", schema="public"):
-    rv = self.query_one(
-      "SELECT EXISTS (SELECT relname FROM pg_class WHERE relname=%s)", name
-    )
-    return rv["exists"]
-
   def _get_table_names(self):
     sql = """
 SELECT table_name as "table"
 FROM information_schema.tables
-WHERE table_schema='public'
+WHERE table_schema = ANY (current_schemas(false))
 ORDER BY table_name
         """
     return self.query(sql)
+
+  #: pg_class.relkind of each kind `exists` looks up
+  OBJECT_KINDS = {
+    "table": ("r", "p"),
+    "view": ("v", "m"),
+    "index": ("i", "I"),
+    "sequence": ("S",),
+    "foreign table": ("f",),
+  }
+
+  def _exists(self, name, kind, schema):
+    if kind not in self.OBJECT_KINDS:
+      raise ValueError("kind must be one of %s." % ", ".join(sorted(self.OBJECT_KINDS)))
+    rv = self.query_one(
+      "SELECT EXISTS (SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+      "WHERE c.relname = %s AND n.nspname = %s AND c.relkind = ANY (%s)) AS it_exists",
+      name,
+      schema,
+      list(self.OBJECT_KINDS[kind]),
+    )
+    return rv["it_exists"]
+
+  def _load_table_metadata(self, table):
+    relation = '"%s"' % table.replace('"', '""')
+    columns = self.query(
+      "SELECT attname AS name, format_type(atttypid, atttypmod) AS type FROM pg_attribute "
+      "WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped ORDER BY attnum",
+      relation,
+    ).all()
+    if not columns:
+      return None
+
+    indexes = self.query(
+      """
+SELECT i.relname AS name, ix.indisunique AS is_unique, ix.indisprimary AS is_primary,
+       array_agg(a.attname::text ORDER BY k.position) AS columns
+FROM pg_index ix
+JOIN pg_class i ON i.oid = ix.indexrelid
+JOIN LATERAL unnest(ix.indkey) WITH ORDINALITY AS k (attnum, position) ON true
+JOIN pg_attribute a ON a.attrelid = ix.indrelid AND a.attnum = k.attnum
+WHERE ix.indrelid = to_regclass(%s)
+GROUP BY i.relname, ix.indisunique, ix.indisprimary
+ORDER BY i.relname
+        """,
+      relation,
+    ).all()
+
+    primary_key = [index["columns"] for index in indexes if index["is_primary"]]
+    return {
+      "columns": OrderedDict((column["name"], column["type"]) for column in columns),
+      "primary_key": primary_key[0] if primary_key else [],
+      "indexes": [
+        {"name": index["name"], "columns": index["columns"], "unique": index["is_unique"]}
+        for index in indexes
+      ],
+    }
+
+
+class _StreamCursor(object):
+  """A named cursor on a connection of its own, in a transaction that's
+  committed once the cursor is closed. The connection is then kept for the
+  next stream, or closed if there's one already."""
+
+  def __init__(self, db, cursor):
+    self._db = db
+    self._connection = cursor.connection
+    self._cursor = cursor
+    self._open = True
+
+  def __getattr__(self, name):
+    return getattr(self._cursor, name)
+
+  def close(self):
+    if not self._open:
+      return
+    self._open = False
+    try:
+      self._cursor.close()
+    finally:
+      if not self._connection.closed:
+        # A failed transaction is rolled back by the COMMIT.
+        self._connection.commit()
+        if self._db._idle_stream_connection is None and self._db._connection is not None:
+          self._db._idle_stream_connection = self._connection
+        else:
+          self._connection.close()
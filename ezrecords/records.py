@@ -1,20 +1,24 @@
 # coding: utf-8
 from __future__ import unicode_literals, print_function, absolute_import, with_statement
+import datetime
 from collections import OrderedDict
 from inspect import isclass
 
 import tablib
 
+from ezrecords.columnar import COLUMNAR_FORMATS, export_columnar
+from ezrecords.util import json_dumps
 
-def _reduce_datetimes(row):
-  """Receives a row, converts datetimes to strings."""
 
-  row = list(row)
+_TEMPORAL_TYPES = (datetime.date, datetime.time)  # datetime is a date
+_TEMPORAL_KINDS = ("date", "datetime", "time")
 
-  for i in range(len(row)):
-    if hasattr(row[i], "isoformat"):
-      row[i] = row[i].isoformat()
-  return tuple(row)
+
+def _reduce_datetimes(row):
+  """Receives a row, converts datetimes to strings."""
+  return tuple(
+    value.isoformat() if isinstance(value, _TEMPORAL_TYPES) else value for value in row
+  )
 
 
 def _is_exception(obj):
@@ -49,7 +53,7 @@ class Record(object):
     return self._values
 
   def __repr__(self):
-    return "<Record {}>".format(self.export("json")[1:-1])
+    return "<Record {}>".format(self.to_json())
 
   def __getitem__(self, key):
     # Support for index-based lookup.
@@ -89,6 +93,10 @@ class Record(object):
 
     return OrderedDict(items) if ordered else dict(items)
 
+  def to_json(self):
+    """Returns the row as a JSON object, see `ezrecords.util.json_dumps`."""
+    return json_dumps(dict(zip(self._keys, self._values)))
+
   @property
   def dataset(self):
     """A Tablib Dataset containing the row."""
@@ -108,14 +116,35 @@ class Record(object):
 class RecordCollection(object):
   """A set of excellent Records from a query."""
 
-  def __init__(self, rows):
+  def __init__(self, rows, description=None, column_types=None, close=None):
     self._rows = rows
     self._all_rows = []
     self.pending = True
 
+    # Releases what the pending rows are read from, like a streamed cursor
+    self._close = close
+
+    #: The `cursor.description` of the query, when known
+    self.description = description
+
+    #: The type name of each column, see `Database._column_types_of`
+    self.column_types = column_types
+
   def __repr__(self):
     return "<RecordCollection size={} pending={}>".format(len(self), self.pending)
 
+  def __del__(self):
+    self.close()
+
+  def close(self):
+    """Stops reading the pending rows, e.g. of a stream abandoned halfway,
+    and releases its cursor. Rows already fetched are kept."""
+    close, self._close = self._close, None
+    if close is not None:
+      self.pending = False
+      self._rows = iter(())
+      close()
+
   def __iter__(self):
     """Iterate over all rows, consuming the underlying generator
     only when necessary."""
@@ -163,15 +192,79 @@ class RecordCollection(object):
     if is_int:
       return rows[0]
     else:
-      return RecordCollection(iter(rows))
+      return RecordCollection(iter(rows), self.description, self.column_types)
 
   def __len__(self):
     return len(self._all_rows)
 
   def export(self, format, **kwargs):
-    """Export the RecordCollection to a given format (courtesy of Tablib)."""
+    """Export the RecordCollection to a given format.
+
+    Text and office formats are courtesy of Tablib. The columnar formats
+    'arrow', 'feather', 'parquet' and 'npz' are written batch by batch, see
+    `ezrecords.columnar.export_columnar` for their arguments.
+    """
+    if format in COLUMNAR_FORMATS:
+      return export_columnar(self, format, **kwargs)
     return self.dataset.export(format, **kwargs)
 
+  def to_json(self, stream=None, lines=False, batch_size=1000):
+    """Serializes the rows to JSON without going through Tablib.
+
+    Args:
+        stream (file, optional): text file object to write to, batch by
+            batch. Rows still pending are streamed through without being
+            kept in the collection, see `iter_batches`.
+        lines (bool, optional): write one JSON object per line (JSON Lines)
+            instead of an array
+        batch_size (int, optional): rows serialized at a time
+
+    Returns:
+        str: The JSON document, if no `stream` was given.
+
+    Examples:
+        >>> db.query('SELECT * FROM users').to_json()
+        '[{"id":1,"name":"scott"}]'
+        >>> db.query('SELECT * FROM events', stream=True).to_json(stream=f, lines=True)
+    """
+    if stream is None:
+      rows = [dict(zip(row._keys, row._values)) for row in self]
+      if lines:
+        return "".join(json_dumps(row) + "\n" for row in rows)
+      return json_dumps(rows)
+
+    separator = "" if lines else "["
+    for batch in self.iter_batches(batch_size):
+      rows = [dict(zip(row._keys, row._values)) for row in batch]
+      if lines:
+        stream.write("".join(json_dumps(row) + "\n" for row in rows))
+      else:
+        # Serialize the whole batch at once and splice it into the array.
+        stream.write(separator + json_dumps(rows)[1:-1])
+        separator = ","
+    if not lines:
+      stream.write("[]" if separator == "[" else "]")
+
+  def iter_batches(self, size):
+    """Yields lists of at most `size` Records.
+
+    Rows already fetched are yielded first. Rows still pending are taken
+    straight from the query without being kept in the collection, so large
+    results can be processed in constant memory, but only once.
+    """
+    for i in range(0, len(self._all_rows), size):
+      yield self._all_rows[i : i + size]
+
+    batch = []
+    for row in self._rows:
+      batch.append(row)
+      if len(batch) == size:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+    self.pending = False
+
   @property
   def dataset(self):
     """A Tablib Dataset representation of the RecordCollection."""
@@ -187,9 +280,13 @@ class RecordCollection(object):
     first = self[0]
 
     data.headers = first.keys()
+
+    # Skip the per-value checks when the column types say there's no date.
+    reduce = self.column_types is None or any(
+      kind is None or kind in _TEMPORAL_KINDS for kind in self.column_types
+    )
     for row in self.all():
-      row = _reduce_datetimes(row.values())
-      data.append(row)
+      data.append(_reduce_datetimes(row.values()) if reduce else tuple(row.values()))
 
     return data
 
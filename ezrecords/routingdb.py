@@ -0,0 +1,343 @@
+# coding: utf-8
+"""
+Read/write splitting across one primary and many read replicas.
+"""
+from __future__ import unicode_literals, print_function, absolute_import, with_statement
+
+import os
+from timeit import default_timer as timer
+
+from ezrecords.abstractdb import Database, create_database
+from ezrecords.exceptions import QueryTimeoutError
+from ezrecords.util import is_read_statement
+
+
+class RoutingDatabase(Database):
+  """Database that sends reads to replicas and writes to the primary.
+
+  SELECT-like statements issued through `query` and the `get_*` helpers are
+  balanced across the healthy replicas. Everything else, stored procedures
+  and every statement inside a transaction go to the primary.
+
+  Attributes:
+      primary (Database): the database receiving writes
+      replicas (list): the replica databases. Unreachable ones are None
+          until a health check manages to connect to them.
+      balancing (str): 'round_robin' or 'least_latency'
+      sticky_window (float): seconds after a write during which reads are
+          still sent to the primary, so callers read their own writes
+      health_check_interval (float): seconds between replica health checks
+
+  Examples:
+      >>> db = RoutingDatabase(
+      ...   'postgres://app@primary/app',
+      ...   ['postgres://app@replica1/app', 'postgres://app@replica2/app'],
+      ...   sticky_window=1.0,
+      ... )
+      >>> db.insert('users', name='scott')  # primary
+      >>> db.get_results('SELECT * FROM users')  # a replica
+  """
+
+  BALANCING_STRATEGIES = ("round_robin", "least_latency")
+
+  #: Weight of the newest sample in the replica latency moving average.
+  LATENCY_DECAY = 0.2
+
+  #: Dialect hooks answered by the primary, see `_on_primary`.
+  PRIMARY_HOOKS = (
+    "_stream_cursor",
+    "_resolve_timeout",
+    "_set_timeout",
+    "_clear_timeout",
+    "_is_timeout_error",
+    "_is_retryable_error",
+    "_explain",
+    "_db_version",
+    "_keyset_condition",
+    "_keyset_values",
+    "_upsert_clause",
+    "_in_conditions",
+    "_script_statements",
+  )
+
+  #: Writes that drivers implement in their own way, run by the primary.
+  PRIMARY_OPERATIONS = (
+    "_insert_returning",
+    "_run_upsert",
+    "_bulk_update",
+    "_bulk_delete",
+    "_run_script_batch",
+    "bulk_insert",
+    "executemany",
+  )
+
+  def __init__(
+    self,
+    primary_url=None,
+    replica_urls=(),
+    logger=None,
+    balancing="round_robin",
+    sticky_window=0,
+    health_check_interval=30,
+    **kwargs
+  ):
+    if balancing not in self.BALANCING_STRATEGIES:
+      raise ValueError(
+        "balancing must be one of %s." % ", ".join(self.BALANCING_STRATEGIES)
+      )
+
+    primary_url = primary_url or os.getenv("DATABASE_URL", None)
+    self._database_kwargs = dict(kwargs, logger=logger)
+
+    self.primary = create_database(primary_url, **self._database_kwargs)
+    self.replica_urls = list(replica_urls)
+    self.replicas = [None] * len(self.replica_urls)
+    self.balancing = balancing
+    self.sticky_window = sticky_window
+    self.health_check_interval = health_check_interval
+
+    self._healthy = [False] * len(self.replica_urls)
+    self._latencies = [0.0] * len(self.replica_urls)
+    self._next_replica = 0
+    self._last_write = None
+    self._last_health_check = None
+
+    super(RoutingDatabase, self).__init__(db_url=primary_url, logger=logger, **kwargs)
+    self._placeholder = self.primary._placeholder
+    self._max_params = self.primary._max_params
+
+    self.check_replicas()
+
+  def _parse_options(self, query):
+    # The primary validated and applies them.
+    return self.primary.options
+
+  def _connect(self):
+    self.primary.connect()
+    self._connection = self.primary._connection
+
+  def _set_charset(self, charset, collate=None):
+    for database in [self.primary] + [r for r in self.replicas if r is not None]:
+      database.set_charset(charset, collate)
+
+  def close(self):
+    for database in [self.primary] + [r for r in self.replicas if r is not None]:
+      database.close()
+
+  def _reset_stats(self):
+    super(RoutingDatabase, self)._reset_stats()
+    self.stats.update(
+      {
+        # Statements sent to the primary and to the replicas
+        "primary_queries": 0,
+        "replica_queries": 0,
+        # Reads moved to the primary because their replica failed
+        "replica_failovers": 0,
+      }
+    )
+
+  # ------------------------------------------------------------------
+  # Routing
+  # ------------------------------------------------------------------
+
+  def query(self, sql, *args, **kwargs):
+    """Runs the query on the primary or on a replica.
+
+    See `Database.query` for the arguments.
+    """
+    index = self._route(sql, kwargs.get("proc", False))
+
+    if index is not None:
+      try:
+        return self._run(self.replicas[index], sql, args, kwargs, index)
+      except QueryTimeoutError:
+        raise
+      except Exception:
+        # A bad statement fails on every server, so only fail over when
+        # the replica itself is gone.
+        if self._check_replica(index):
+          raise
+        self.stats["replica_failovers"] += 1
+
+    rv = self._run(self.primary, sql, args, kwargs)
+    if not self._in_transaction and not is_read_statement(sql):
+      self._last_write = timer()
+    return rv
+
+  def _route(self, sql, proc=False):
+    """Picks where the statement runs.
+
+    Returns:
+        int: The index of the replica to use or None for the primary.
+    """
+    if proc or self._in_transaction or not is_read_statement(sql):
+      return None
+
+    if (
+      self.sticky_window
+      and self._last_write is not None
+      and timer() - self._last_write < self.sticky_window
+    ):
+      return None
+
+    if (
+      self._last_health_check is None
+      or timer() - self._last_health_check >= self.health_check_interval
+    ):
+      self.check_replicas()
+
+    healthy = [i for i, is_healthy in enumerate(self._healthy) if is_healthy]
+    if not healthy:
+      return None
+
+    if self.balancing == "least_latency":
+      return min(healthy, key=lambda i: self._latencies[i])
+
+    # round_robin
+    for offset in range(len(self.replicas)):
+      index = (self._next_replica + offset) % len(self.replicas)
+      if self._healthy[index]:
+        self._next_replica = index + 1
+        return index
+
+  def _run(self, database, sql, args, kwargs, index=None):
+    database.show_sql = self.show_sql
+    database.show_errors = self.show_errors
+    database.save_queries = self.save_queries
+    if kwargs.get("timeout") is None:
+      kwargs = dict(kwargs, timeout=self.timeout)
+
+    start = timer()
+    try:
+      rv = database.query(sql, *args, **kwargs)
+    except QueryTimeoutError:
+      self.stats["queries_timed_out"] += 1
+      raise
+    finally:
+      self.last_query = database.last_query
+      self.saved_queries.extend(database.saved_queries)
+      del database.saved_queries[:]
+
+    if index is None:
+      self.stats["primary_queries"] += 1
+    else:
+      self.stats["replica_queries"] += 1
+      self._record_latency(index, timer() - start)
+
+    self.affected_rows = database.affected_rows
+    self.last_insert_id = database.last_insert_id
+    self.queries_executed += 1
+    self._last_result = rv
+    return rv
+
+  def _record_latency(self, index, elapsed):
+    self._latencies[index] += self.LATENCY_DECAY * (elapsed - self._latencies[index])
+
+  # ------------------------------------------------------------------
+  # Health checks
+  # ------------------------------------------------------------------
+
+  def check_replicas(self):
+    """Probes every replica, reconnecting to the ones that were down.
+
+    Returns:
+        list: The health flag of each replica, in `replicas` order.
+    """
+    for index in range(len(self.replicas)):
+      self._check_replica(index)
+    self._last_health_check = timer()
+    return list(self._healthy)
+
+  def _check_replica(self, index):
+    start = timer()
+    try:
+      if self.replicas[index] is None:
+        self.replicas[index] = create_database(
+          self.replica_urls[index], **self._database_kwargs
+        )
+      self.replicas[index].query("SELECT 1")
+    except Exception as exception:
+      if self.logger:
+        self.logger.warning("Replica %s is unhealthy: %s" % (index, exception))
+      replica, self.replicas[index] = self.replicas[index], None
+      if replica is not None and replica._connection is not None:
+        try:
+          replica.close()
+        except Exception:
+          pass
+      self._healthy[index] = False
+      return False
+
+    self._record_latency(index, timer() - start)
+    self._healthy[index] = True
+    return True
+
+  # ------------------------------------------------------------------
+  # Transaction Management
+  # ------------------------------------------------------------------
+
+  def begin_transaction(self, isolation_level=None, read_only=False, deferrable=False):
+    self.primary.begin_transaction(isolation_level, read_only, deferrable)
+    self._in_transaction = True
+
+  def rollback(self):
+    self.primary.rollback()
+    self._in_transaction = False
+
+  def commit(self):
+    self.primary.commit()
+    self._in_transaction = False
+    self._last_write = timer()
+
+  # ------------------------------------------------------------------
+  # Helpers & Common queries
+  # ------------------------------------------------------------------
+
+  def use(self, db_name):
+    self.primary.use(db_name)
+
+  def exists(self, name, kind="table", schema="public"):
+    return self.primary.exists(name, kind=kind, schema=schema)
+
+  # The primary caches the schema metadata, and sees the DDL that clears it.
+  def db_version(self):
+    return self.primary.db_version()
+
+  def get_table_names(self):
+    return self.primary.get_table_names()
+
+  def table_metadata(self, table):
+    return self.primary.table_metadata(table)
+
+  def refresh(self):
+    self.primary.refresh()
+
+
+def _on_primary(name, writes):
+  def hook(self, *args, **kwargs):
+    if not writes:
+      return getattr(self.primary, name)(*args, **kwargs)
+    try:
+      return getattr(self.primary, name)(*args, **kwargs)
+    finally:
+      self.affected_rows = self.primary.affected_rows
+      self.last_insert_id = self.primary.last_insert_id
+      self.stats["last_bulk"] = self.primary.stats["last_bulk"]
+      # Inside a transaction, the commit starts the sticky window.
+      if not self._in_transaction:
+        self._last_write = timer()
+
+  hook.__name__ = name
+  hook.__doc__ = getattr(Database, name).__doc__
+  return hook
+
+
+# The primary knows its SQL dialect, and the statements of writes must not
+# be served by a lagging replica, so both go to the primary. Forwarding
+# them all here keeps hooks added to Database from silently falling back
+# to the generic SQL.
+for _name in RoutingDatabase.PRIMARY_HOOKS:
+  setattr(RoutingDatabase, _name, _on_primary(_name, writes=False))
+for _name in RoutingDatabase.PRIMARY_OPERATIONS:
+  setattr(RoutingDatabase, _name, _on_primary(_name, writes=True))
+del _name
@@ -0,0 +1,118 @@
+# coding: utf-8
+"""
+Splits SQL scripts into statements, reading them a line at a time.
+
+Delimiters inside string literals, quoted identifiers, comments and
+dollar-quoted bodies don't end a statement, and the mysql client's
+`DELIMITER` command changes the delimiter for the statements that follow,
+e.g. to define procedures whose bodies contain `;`.
+"""
+from __future__ import unicode_literals, print_function, absolute_import, with_statement
+
+import re
+
+_DELIMITER_COMMAND = re.compile(r"^\s*DELIMITER\s+(\S+)\s*$", re.IGNORECASE)
+_DOLLAR_TAG = r"\$(?:[A-Za-z_]\w*)?\$"
+
+
+def _opening_pattern(delimiter, dollar_quotes, hash_comments):
+  tokens = [re.escape(delimiter), "'", '"', "`", "--", r"/\*"]
+  if hash_comments:
+    tokens.append("#")
+  if dollar_quotes:
+    tokens.append(_DOLLAR_TAG)
+  return re.compile("|".join(tokens))
+
+
+def _find_closing(line, pos, closing, backslash_escapes):
+  """Returns the index right past `closing` in `line`, or None."""
+  while True:
+    end = line.find(closing, pos)
+    if end == -1:
+      return None
+    if closing in ("'", '"') and backslash_escapes:
+      # An odd number of backslashes right before escapes the quote.
+      backslashes = len(line[:end]) - len(line[:end].rstrip("\\"))
+      if backslashes % 2:
+        pos = end + 1
+        continue
+    if closing in ("'", '"', "`") and line.startswith(closing, end + 1):
+      # Doubled quotes stand for the quote itself.
+      pos = end + 2
+      continue
+    return end + len(closing)
+
+
+def split_statements(
+  lines, delimiter=";", backslash_escapes=False, dollar_quotes=True, hash_comments=False
+):
+  """Yields the statements of a SQL script.
+
+  Statements are yielded without their delimiter, comments included.
+  Blank and comment-only statements are skipped.
+
+  Args:
+      lines (iterable): the script's lines, e.g. an open file
+      delimiter (str): what ends a statement until `DELIMITER` changes it
+      backslash_escapes (bool): backslashes escape quotes in literals, as
+          in MySQL
+      dollar_quotes (bool): `$$` and `$tag$` quote bodies, as in Postgres
+      hash_comments (bool): `#` starts a comment, as in MySQL
+
+  Yields:
+      tuple: (line number the statement starts on, the statement)
+  """
+  opening = _opening_pattern(delimiter, dollar_quotes, hash_comments)
+  parts = []
+  has_code = False  # anything but blanks and comments in `parts`
+  first_line = None
+  closing = None  # what ends the literal or comment we're in, if any
+
+  for number, line in enumerate(lines, 1):
+    if closing is None and not has_code:
+      match = _DELIMITER_COMMAND.match(line)
+      if match:
+        delimiter = match.group(1)
+        opening = _opening_pattern(delimiter, dollar_quotes, hash_comments)
+        parts, first_line = [], None
+        continue
+
+    pos = 0
+    while pos < len(line):
+      if closing is not None:
+        end = _find_closing(line, pos, closing, backslash_escapes)
+        if end is None:
+          parts.append(line[pos:])
+          break
+        parts.append(line[pos:end])
+        pos, closing = end, None
+        continue
+
+      match = opening.search(line, pos)
+      end = match.start() if match else len(line)
+      if line[pos:end].strip():
+        has_code = True
+        first_line = first_line or number
+      parts.append(line[pos:end])
+      if match is None:
+        break
+
+      token = match.group()
+      pos = match.end()
+      if token == delimiter:
+        if has_code:
+          yield first_line, "".join(parts).strip()
+        parts, has_code, first_line = [], False, None
+        continue
+
+      parts.append(token)
+      if token in ("--", "#"):
+        parts.append(line[pos:])
+        break
+      if token != "/*":
+        has_code = True
+        first_line = first_line or number
+      closing = {"'": "'", '"': '"', "`": "`", "/*": "*/"}.get(token, token)
+
+  if has_code:
+    yield first_line, "".join(parts).strip()
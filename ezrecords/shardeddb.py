@@ -0,0 +1,212 @@
+# coding: utf-8
+"""
+Key-based routing across several databases holding slices of the same schema.
+"""
+from __future__ import unicode_literals, print_function, absolute_import, with_statement
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ezrecords.abstractdb import Database, create_database
+from ezrecords.compat import string_types
+from ezrecords.records import RecordCollection
+
+
+class ShardedDatabase(object):
+  """Routes rows to the shard owning their key and fans reads out to all.
+
+  Single-row operations (`insert`, `update`, `delete`, `get_row`) run on the
+  shard that `router` picks for the row's key. `query` without a key runs
+  on every shard in parallel and merges the results.
+
+  Attributes:
+      shards (dict): shard name to `Database`
+      router (callable): receives a key, returns the name of its shard
+      key_column (str): column holding the shard key, used to find the key
+          of rows given to the DML helpers
+
+  Examples:
+      >>> db = ShardedDatabase(
+      ...   {'eu': 'mysql://app@eu/app', 'us': 'mysql://app@us/app'},
+      ...   router=lambda tenant_id: 'eu' if tenant_id % 2 else 'us',
+      ...   key_column='tenant_id',
+      ... )
+      >>> db.insert('invoices', tenant_id=7, total=10)
+      >>> db.query('SELECT * FROM invoices', order_by='-total', limit=10)
+  """
+
+  def __init__(self, shards, router, key_column=None, logger=None, max_workers=None, **kwargs):
+    """Connects to every shard.
+
+    Args:
+        shards (dict): shard name to either a `Database` or a db URL
+        router (callable): maps a shard key to a shard name
+        key_column (str, optional): column holding the shard key
+        logger (logging.Logger, optional): logger for the shards created here
+        max_workers (int, optional): threads used for scatter-gather queries.
+            Defaults to one per shard.
+        **kwargs: forwarded to the shards created from URLs
+    """
+    if not shards:
+      raise ValueError("You must provide at least one shard.")
+
+    self.shards = {}
+    for name, shard in shards.items():
+      if not isinstance(shard, Database):
+        shard = create_database(shard, logger=logger, **kwargs)
+      self.shards[name] = shard
+
+    self.router = router
+    self.key_column = key_column
+    self.max_workers = max_workers or len(self.shards)
+
+  def shard_for(self, key):
+    """Returns the `Database` owning the given shard key."""
+    name = self.router(key)
+    try:
+      return self.shards[name]
+    except KeyError:
+      raise ValueError("Key %r was routed to unknown shard %r." % (key, name))
+
+  def _key_of(self, row):
+    if self.key_column is None:
+      raise ValueError("key_column must be set to route rows to shards.")
+    if self.key_column not in row:
+      raise ValueError("Rows must include the shard key column '%s'." % self.key_column)
+    return row[self.key_column]
+
+  def close(self):
+    """Closes the connection to every shard."""
+    for shard in self.shards.values():
+      shard.close()
+
+  # ------------------------------------------------------------------
+  # Queries
+  # ------------------------------------------------------------------
+
+  def query(self, sql, *args, **kwargs):
+    """Runs a query on one shard, or on all of them and merges the rows.
+
+    Args:
+        sql (str): the SQL query
+        *args: Values to be replace into the format string
+        **kwargs:
+            key: run only on the shard owning this key
+            order_by: column name, or list of them, to sort the merged
+                rows by. Prefix a name with '-' for descending order.
+            limit: maximum number of merged rows to return
+            Anything else is passed on to `Database.query`.
+
+    Returns:
+        A `RecordCollection`, or a single `Record` if `one=True` is given.
+
+    Notes:
+        `order_by` and `limit` are pushed down to the shards by wrapping
+        `sql` in a subquery, so each shard sorts and returns at most `limit`
+        rows and only those are merged here.
+    """
+    if "key" in kwargs:
+      return self.shard_for(kwargs.pop("key")).query(sql, *args, **kwargs)
+
+    order_by = kwargs.pop("order_by", None)
+    limit = kwargs.pop("limit", None)
+    one = kwargs.pop("one", False)
+
+    if isinstance(order_by, string_types):
+      order_by = [order_by]
+    order_by = [(c[1:], True) if c.startswith("-") else (c, False) for c in order_by or []]
+
+    if order_by or limit is not None:
+      sql = "SELECT * FROM (%s) AS _shard" % sql.strip().rstrip(";")
+      if order_by:
+        sql += " ORDER BY " + ", ".join(
+          '"%s"%s' % (column, " DESC" if descending else "") for column, descending in order_by
+        )
+      if limit is not None:
+        sql += " LIMIT %d" % limit
+
+    def run(shard):
+      rows = shard.query(sql, *args, **kwargs)
+      return [] if rows is None else rows.all()
+
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      shard_rows = list(executor.map(run, self.shards.values()))
+
+    rows = [row for chunk in shard_rows for row in chunk]
+
+    # Stable sorts, least significant column first, give the multi-column
+    # order. NULLs sort last regardless of direction.
+    for column, descending in reversed(order_by):
+      rows.sort(
+        key=lambda row, c=column, d=descending: ((row[c] is None) != d, row[c]),
+        reverse=descending,
+      )
+
+    if limit is not None:
+      rows = rows[:limit]
+
+    results = RecordCollection(iter(rows))
+    return results.first() if one else results
+
+  def get_row(self, key, query, output_type="record", row_offset=0, timeout=None):
+    """Retrieve one row from the shard owning `key`.
+
+    See `Database.get_row`.
+    """
+    return self.shard_for(key).get_row(
+      query, output_type=output_type, row_offset=row_offset, timeout=timeout
+    )
+
+  # ------------------------------------------------------------------
+  # DML
+  # ------------------------------------------------------------------
+
+  def insert(self, table, data=None, timeout=None, **kwargs):
+    """Inserts a row into the shard owning its key. See `Database.insert`."""
+    if data is not None:
+      kwargs.update(data)
+    return self.shard_for(self._key_of(kwargs)).insert(table, kwargs, timeout=timeout)
+
+  def bulk_insert(self, table, columns, values, timeout=None, batch_size=1000, returning=None):
+    """Inserts rows, one bulk insert per shard. See `Database.bulk_insert`.
+
+    Returns:
+        int: The number of rows inserted across all shards or, with
+        `returning`, a `RecordCollection` of the returned columns in the
+        order the rows were given.
+    """
+    if self.key_column not in columns:
+      raise ValueError("Rows must include the shard key column '%s'." % self.key_column)
+    key_index = list(columns).index(self.key_column)
+
+    rows_by_shard = {}
+    positions_by_shard = {}
+    for position, value in enumerate(values):
+      shard = self.shard_for(value[key_index])
+      rows_by_shard.setdefault(shard, []).append(value)
+      positions_by_shard.setdefault(shard, []).append(position)
+
+    affected_rows = 0
+    returned = {}
+    for shard, rows in rows_by_shard.items():
+      result = shard.bulk_insert(
+        table, columns, rows, timeout=timeout, batch_size=batch_size, returning=returning
+      )
+      if returning:
+        returned.update(zip(positions_by_shard[shard], result))
+        affected_rows += len(rows)
+      else:
+        affected_rows += result
+
+    if returning:
+      return RecordCollection(iter([returned[position] for position in sorted(returned)]))
+    return affected_rows
+
+  def update(self, table, data, where, timeout=None):
+    """Updates rows in the shard owning `where`'s key. See `Database.update`."""
+    return self.shard_for(self._key_of(where)).update(table, data, where, timeout=timeout)
+
+  def delete(self, table, where=None, timeout=None, **kwargs):
+    """Deletes rows in the shard owning `where`'s key. See `Database.delete`."""
+    if where is not None:
+      kwargs.update(where)
+    return self.shard_for(self._key_of(kwargs)).delete(table, kwargs, timeout=timeout)
@@ -6,10 +6,21 @@ https://speakerdeck.com/pycon2016/dave-sawyer-sqlite-gotchas-and-gimmes
 https://speakerdeck.com/eueung/python-sqlite
 """
 
+import os
+import queue
+import re
 import sqlite3
 import datetime
+import threading
+from collections import OrderedDict
+from timeit import default_timer as timer
 
 from ezrecords.abstractdb import Database
+from ezrecords.compat import numeric_types, quote, string_types
+from ezrecords.exceptions import QueryTimeoutError
+from ezrecords.options import choice, non_negative
+from ezrecords.plans import parse_sqlite_plan
+from ezrecords.util import is_read_statement, json_dumps
 
 def adapt_date_iso(val):
     """Adapt datetime.date to ISO 8601 date."""
@@ -23,56 +34,107 @@ def adapt_datetime_epoch(val):
     """Adapt datetime.datetime to Unix timestamp."""
     return int(val.timestamp())
 
+# sqlite3 only has process-wide adapters, its default ones are deprecated
+# since 3.12. Dates are stored as ISO 8601 text and datetimes as Unix
+# timestamps, the format existing databases hold, unless
+# `store_datetimes_as_iso` switches to ISO 8601 text.
 sqlite3.register_adapter(datetime.date, adapt_date_iso)
-sqlite3.register_adapter(datetime.datetime, adapt_datetime_iso)
 sqlite3.register_adapter(datetime.datetime, adapt_datetime_epoch)
 
-def convert_date(val):
-    """Convert ISO 8601 date to datetime.date object."""
-    return datetime.date.fromisoformat(val.decode())
 
-def convert_datetime(val):
-    """Convert ISO 8601 datetime to datetime.datetime object."""
-    return datetime.datetime.fromisoformat(val.decode())
+def store_datetimes_as_iso(enabled=True):
+  """Stores datetimes as ISO 8601 text, which SQLite's date and time
+  functions understand, instead of Unix timestamps.
 
-def convert_timestamp(val):
-    """Convert Unix epoch timestamp to datetime.datetime object."""
-    return datetime.datetime.fromtimestamp(int(val))
+  It applies to every SQLite connection in the process. Columns already
+  holding timestamps keep them: convert them first, e.g. with
+  `UPDATE t SET c = strftime('%Y-%m-%dT%H:%M:%S', c, 'unixepoch', 'localtime')
+  WHERE typeof(c) = 'integer'`.
 
-sqlite3.register_converter("date", convert_date)
-sqlite3.register_converter("datetime", convert_datetime)
-sqlite3.register_converter("timestamp", convert_timestamp)
+  Args:
+      enabled (bool, optional): False goes back to Unix timestamps
+  """
+  adapter = adapt_datetime_iso if enabled else adapt_datetime_epoch
+  sqlite3.register_adapter(datetime.datetime, adapter)
+
+
+#: The comment numbering the statements of a script batch
+_SCRIPT_STATEMENT = re.compile(r"\s*/\* (\d+) \*/")
+
+
+def _page_size(value):
+  size = int(value)
+  if size < 512 or size > 65536 or size & (size - 1):
+    raise ValueError("must be a power of two between 512 and 65536")
+  return size
 
 class SQLiteDb(Database):
-  def __init__(self, db_url=None, logger=None):
-    super(SQLiteDb, self).__init__(db_url=db_url, logger=logger)
+  #: `query_in` lists longer than this are bound as a single JSON array
+  IN_LIST_JSON_THRESHOLD = 256
+
+  SCRIPT_SYNTAX = {"dollar_quotes": False}
+
+  CONNECTION_OPTIONS = {
+    # Pages (positive) or KiB (negative) of page cache per connection
+    "cache_size": (int, None),
+    # Bytes of the database file read through memory-mapped I/O
+    "mmap_size": (non_negative(int), None),
+    # Only applies to new databases, before WAL is enabled
+    "page_size": (_page_size, None),
+    # Milliseconds to wait for a lock held by another connection
+    "busy_timeout": (non_negative(int), 5000),
+    "synchronous": (choice("OFF", "NORMAL", "FULL", "EXTRA"), "OFF"),
+    # Requires SQLite 3.7.0 (Jul 2010) for WAL
+    "journal_mode": (choice("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"), "WAL"),
+    # Prepared statements kept by the sqlite3 module per connection
+    "cached_statements": (non_negative(int), 128),
+  }
+
+  def __init__(self, db_url=None, logger=None, read_only=False, **kwargs):
+    #: Open the database file with mode=ro, any write fails
+    self.read_only = read_only
+    super(SQLiteDb, self).__init__(db_url=db_url, logger=logger, **kwargs)
     self._placeholder = "?"
+    # SQLITE_MAX_VARIABLE_NUMBER defaults to 32766 since 3.32.0
+    self._max_params = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
 
   def _connect(self):
     if self._connection is None:
+      options = self.options
+      database, uri = self._database, False
+      if self.read_only:
+        database, uri = "file:%s?mode=ro" % quote(os.path.abspath(database)), True
+
       self._connection = sqlite3.connect(
-        self._database,
+        database,
+        uri=uri,
+        timeout=options["busy_timeout"] / 1000.0,
+        cached_statements=options["cached_statements"],
         check_same_thread=False,  # allows us to use multiple threads on the same connection
-        isolation_level="DEFERRED",  # so we can control transactions
+        # Autocommit: the sqlite3 module would otherwise BEGIN implicitly
+        # before DML and leave the writes uncommitted until the next commit.
+        isolation_level=None,
       )
 
       def _make_dicts(cursor, row):
-        return dict(
-          (cursor.description[idx][0], value) for idx, value in enumerate(row)
-        )
+        return dict(zip([column[0] for column in cursor.description], row))
 
       # self._connection.row_factory = sqlite3.Row
       self._connection.row_factory = _make_dicts
 
       # This might be pointless once created with an encoding one cannot switch it
-      self._connection.execute('PRAGMA encoding = "UTF-8"')
+      pragmas = ['encoding = "UTF-8"', "foreign_keys = ON"]
+      # page_size has to come before journal_mode, WAL fixes the page size.
+      for name in ("page_size", "journal_mode", "synchronous", "cache_size", "mmap_size"):
+        # Read-only connections can't change the database file's settings.
+        if self.read_only and name in ("page_size", "journal_mode"):
+          continue
+        if options[name] is not None:
+          pragmas.append("%s = %s" % (name, options[name]))
+      pragmas.append("temp_store = MEMORY")
 
-      self._connection.execute("PRAGMA foreign_keys = ON")
-
-      # Requires SQLite 3.7.0 (Jul 2010)
-      self._connection.execute("PRAGMA journal_mode = WAL")
-      self._connection.execute("PRAGMA temp_store = MEMORY")
-      self._connection.execute("PRAGMA synchronous = OFF")
+      # A single call runs them all, instead of one execute per PRAGMA.
+      self._connection.executescript("".join("PRAGMA %s;" % pragma for pragma in pragmas))
 
   def _set_charset(self, charset, collate=None):
     # This might be pointless once created with an encoding one cannot switch it
@@ -81,6 +143,163 @@ class SQLiteDb(Database):
       raise ValueError("charset")
     self.query('PRAGMA encoding = "%s"' % charset)
 
+  def _insert_returning(self, table, columns, batch, returning, timeout):
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+      return super(SQLiteDb, self)._insert_returning(table, columns, batch, returning, timeout)
+
+    # No RETURNING before 3.35. SQLite runs in-process, so inserting row by
+    # row and reading each back by its rowid costs no round-trips.
+    insert = self._insert_sql(table, columns, 1)
+    select = "SELECT %s FROM %s WHERE rowid = ?" % (", ".join(returning), table)
+    rows = []
+    with self.transaction():
+      for row in batch:
+        self.query(insert, *row, timeout=timeout)
+        rows.append(self.query(select, self.last_insert_id, one=True))
+    self.affected_rows = len(rows)
+    return rows
+
+  def _in_conditions(self, column, values, max_params):
+    # Past a few padded sizes, bind the list as one JSON array unnested by
+    # json_each (built in since 3.38). Only for values that read back from
+    # JSON as they were bound: dates, say, would lose their format.
+    if (
+      len(values) > self.IN_LIST_JSON_THRESHOLD
+      and sqlite3.sqlite_version_info >= (3, 38, 0)
+      and all(isinstance(value, numeric_types + string_types) for value in values)
+    ):
+      condition = '"%s" IN (SELECT value FROM json_each(?))' % column
+      return [(condition, [json_dumps(values)])]
+    return super(SQLiteDb, self)._in_conditions(column, values, max_params)
+
+  def _bulk_update(self, table, rows, key_columns, columns, batch_size, timeout):
+    # SQLite runs in-process, so re-binding one prepared UPDATE per row costs
+    # no round-trips and avoids building huge CASE expressions.
+    sql = 'UPDATE "%s" SET %s WHERE %s' % (
+      table,
+      ", ".join('"%s" = ?' % column for column in columns),
+      " AND ".join('"%s" = ?' % column for column in key_columns),
+    )
+    values = ([row[c] for c in columns] + [row[k] for k in key_columns] for row in rows)
+    return self.executemany(sql, values, timeout=timeout)
+
+  def _begin(self, isolation_level, read_only, deferrable):
+    # SQLite transactions are always serializable, so the isolation level
+    # has nothing to change.
+    self.query("BEGIN")
+    if read_only:
+      self.query("PRAGMA query_only = ON")
+
+  def _commit(self):
+    self._end_read_only()
+    try:
+      self._connection.commit()
+    except sqlite3.OperationalError:
+      # A COMMIT refused because the database is locked leaves the
+      # transaction open, so it can't be retried with a new BEGIN.
+      self._connection.rollback()
+      raise
+
+  def _rollback(self):
+    self._end_read_only()
+    self._connection.rollback()
+
+  def _end_read_only(self):
+    # query_only is a connection setting, it outlives the transaction.
+    self._connection.execute("PRAGMA query_only = OFF")
+
+  def executemany(self, sql, values, timeout=None):
+    # In autocommit every row would be a transaction of its own, each
+    # synced to disk, so group the rows in one.
+    if self._in_transaction:
+      return super(SQLiteDb, self).executemany(sql, values, timeout=timeout)
+    with self.transaction():
+      return super(SQLiteDb, self).executemany(sql, values, timeout=timeout)
+
+  def _script_statements(self, lines):
+    # Trigger bodies hold delimiters of their own: join the pieces until
+    # SQLite says the statement is complete.
+    pending = None
+    for line, sql in super(SQLiteDb, self)._script_statements(lines):
+      if pending is not None:
+        line, sql = pending[0], pending[1] + "\n;\n" + sql
+      pending = None if sqlite3.complete_statement(sql + "\n;") else (line, sql)
+      if pending is None:
+        yield line, sql
+    if pending is not None:
+      yield pending
+
+  def _run_script_batch(self, statements, timeout, seconds):
+    # executescript would commit the open transaction first.
+    if self._in_transaction:
+      return super(SQLiteDb, self)._run_script_batch(statements, timeout, seconds)
+
+    # The whole batch runs in one executescript. The trace callback fires as
+    # each statement starts, which times them and tells which one failed.
+    # It fires again for every trigger the statement runs, with the same
+    # text, so statements are told apart by a numbered comment.
+    started = {}
+    committed = []
+
+    def trace(sql):
+      match = _SCRIPT_STATEMENT.match(sql)
+      if match:
+        started.setdefault(int(match.group(1)), timer())
+      elif sql.strip() == "COMMIT;":
+        committed.append(timer())
+
+    script = "BEGIN;%s\nCOMMIT;" % "".join(
+      "\n/* %d */ %s\n;" % (i, sql) for i, sql in enumerate(statements)
+    )
+    self.last_query = statements[-1]
+    self._connection.set_trace_callback(trace)
+    try:
+      with self._statement_timeout(None, self._resolve_timeout(script, timeout)):
+        self._connection.executescript(script)
+    except Exception:
+      if self._connection.in_transaction:
+        self._connection.execute("ROLLBACK")
+      raise
+    finally:
+      self._connection.set_trace_callback(None)
+      # Each statement ends when the next one, or the COMMIT, starts.
+      starts = [started[i] for i in range(len(started))] + committed
+      seconds.extend(end - begin for begin, end in zip(starts, starts[1:]))
+      self.queries_executed += len(seconds)
+
+  def _set_timeout(self, cursor, timeout):
+    # SQLite runs in-process, so there's no server-side timeout. Instead the
+    # progress handler checks the deadline every few VM instructions and
+    # returning True makes SQLite interrupt the statement.
+    if not timeout:
+      return
+
+    deadline = timer() + timeout
+    self._connection.set_progress_handler(lambda: timer() > deadline, 1000)
+
+  def _clear_timeout(self, cursor, timeout):
+    if timeout:
+      self._connection.set_progress_handler(None, 0)
+
+  def _is_timeout_error(self, exception):
+    return isinstance(exception, sqlite3.OperationalError) and (
+      "interrupted" in str(exception)
+    )
+
+  def _is_retryable_error(self, exception):
+    return isinstance(exception, sqlite3.OperationalError) and (
+      "database is locked" in str(exception)
+    )
+
+  def _explain(self, sql, args, analyze, timeout):
+    rows = self.query("EXPLAIN QUERY PLAN " + sql, *args, timeout=timeout)
+    raw = [] if rows is None else rows.all(as_dict=True)
+    nodes, warnings = parse_sqlite_plan(raw)
+    if analyze:
+      # No EXPLAIN ANALYZE in SQLite: run the statement, explain() times it.
+      self.query(sql, *args, timeout=timeout)
+    return raw, nodes, warnings
+
   def _db_version(self):
     sql = "SELECT sqlite_version() as version"
     row = self.query_one(sql)
@@ -91,12 +310,202 @@ class SQLiteDb(Database):
     """select a new database to work with"""
     raise NotImplementedError("Dynamic db switching not allowed in SQLite")
 
-  def exists(self, name, kind="table", schema="public"):
+  def _get_table_names(self):
+    return self.query(
+      "SELECT name as \"table\" FROM sqlite_master WHERE type IN ('table', 'view') ORDER BY name"
+    )
+
+  #: sqlite_master.type values `exists` looks up
+  OBJECT_KINDS = ("table", "view", "index", "trigger")
+
+  def _exists(self, name, kind, schema):
+    if kind not in self.OBJECT_KINDS:
+      raise ValueError("kind must be one of %s." % ", ".join(self.OBJECT_KINDS))
+    # Schemas are the attached databases, 'public' is the main one.
+    schema = "main" if schema == "public" else schema
     rv = self.query_one(
-      "SELECT exists(SELECT name FROM sqlite_master WHERE type='table' AND name=?) as it_exists",
+      'SELECT exists(SELECT name FROM "%s".sqlite_master WHERE type = ? AND name = ?) AS it_exists'
+      % schema.replace('"', '""'),
+      kind,
       name,
     )
     return bool(rv["it_exists"])
 
-  def _get_table_names(self):
-    return self.query('SELECT tbl_name as "table" FROM sqlite_master')
+  def _load_table_metadata(self, table):
+    quoted = '"%s"' % table.replace('"', '""')
+    columns = self.query("PRAGMA table_info(%s)" % quoted).all()
+    if not columns:
+      return None
+
+    indexes = []
+    for index in self.query("PRAGMA index_list(%s)" % quoted):
+      index_columns = self.query('PRAGMA index_info("%s")' % index["name"].replace('"', '""'))
+      indexes.append(
+        {
+          "name": index["name"],
+          "columns": [column["name"] for column in index_columns],
+          "unique": bool(index["unique"]),
+        }
+      )
+
+    return {
+      "columns": OrderedDict((column["name"], column["type"]) for column in columns),
+      "primary_key": [
+        column["name"] for column in sorted(columns, key=lambda c: c["pk"]) if column["pk"]
+      ],
+      "indexes": indexes,
+    }
+
+
+class PooledSQLiteDb(SQLiteDb):
+  """SQLite database with one writer connection and a pool of readers.
+
+  In WAL mode readers don't block the writer nor each other, but a single
+  shared connection runs one statement at a time. Here reads issued
+  through `query` (see `is_read_statement`) run on whichever read-only
+  connection is free, so read throughput grows with the number of readers.
+  Everything else, streamed queries, and every statement of the thread
+  that holds a transaction run on the writer.
+
+  Writers queue for the writer connection. A thread holds it from
+  `begin_transaction` until `commit` or `rollback`, and one waiting longer
+  than the `busy_timeout` connection option gets the OperationalError
+  SQLite raises for a busy database, which `run_in_transaction` retries.
+
+  Attributes:
+      readers (list): the read-only `SQLiteDb`s
+
+  Examples:
+      >>> db = PooledSQLiteDb('sqlite:///app.db?busy_timeout=2000', readers=8)
+      >>> db.insert('users', name='scott')  # writer
+      >>> db.get_results('SELECT * FROM users')  # a reader
+  """
+
+  def __init__(self, db_url=None, logger=None, readers=None, **kwargs):
+    """Opens the writer connection and `readers` read-only ones.
+
+    Args:
+        readers (int, optional): number of read-only connections. Defaults
+            to the number of CPUs.
+        See `Database` for the other arguments.
+    """
+    super(PooledSQLiteDb, self).__init__(db_url=db_url, logger=logger, **kwargs)
+    if self._database in ("", ":memory:"):
+      self.close()
+      raise ValueError("In-memory databases can't be shared by several connections.")
+
+    self._write_lock = threading.RLock()
+    #: The thread in a transaction on the writer, if any
+    self._transaction_thread = None
+    #: Guards `stats`, `queries_executed` and `saved_queries`, which reader
+    #: threads update while the writer runs. Held for writer statements,
+    #: never while waiting for a connection.
+    self._stats_lock = threading.RLock()
+
+    self.readers = [
+      SQLiteDb(db_url=self.db_url, logger=logger, read_only=True, **kwargs)
+      for _ in range(readers or os.cpu_count() or 1)
+    ]
+    self._idle_readers = queue.Queue()
+    for reader in self.readers:
+      self._idle_readers.put(reader)
+
+  def close(self):
+    super(PooledSQLiteDb, self).close()
+    for reader in getattr(self, "readers", []):
+      reader.close()
+
+  def _reset_stats(self):
+    super(PooledSQLiteDb, self)._reset_stats()
+    self.stats.update(
+      {
+        # Statements run on the writer and on the readers
+        "writer_queries": 0,
+        "reader_queries": 0,
+      }
+    )
+
+  def register_converter(self, type, converter):
+    super(PooledSQLiteDb, self).register_converter(type, converter)
+    for reader in self.readers:
+      reader.register_converter(type, converter)
+
+  def _acquire_writer(self):
+    """Waits for the writer connection, as long as SQLite itself would
+    wait for a lock held by another connection."""
+    if not self._write_lock.acquire(timeout=self.options["busy_timeout"] / 1000.0):
+      raise sqlite3.OperationalError("database is locked")
+
+  def query(self, sql, *args, **kwargs):
+    """Runs reads on a reader and everything else on the writer.
+
+    See `Database.query` for the arguments.
+    """
+    if (
+      kwargs.get("proc")
+      or kwargs.get("stream")
+      or self._transaction_thread is threading.current_thread()
+      or not is_read_statement(sql)
+    ):
+      self._acquire_writer()
+      try:
+        with self._stats_lock:
+          self.stats["writer_queries"] += 1
+          return super(PooledSQLiteDb, self).query(sql, *args, **kwargs)
+      finally:
+        self._write_lock.release()
+
+    reader = self._idle_readers.get()
+    reader.show_sql = self.show_sql
+    reader.show_errors = self.show_errors
+    reader.save_queries = self.save_queries
+    if kwargs.get("timeout") is None:
+      kwargs = dict(kwargs, timeout=self.timeout)
+
+    try:
+      rv = reader.query(sql, *args, **kwargs)
+    except QueryTimeoutError:
+      with self._stats_lock:
+        self.stats["queries_timed_out"] += 1
+      raise
+    finally:
+      last_query, saved_queries = reader.last_query, reader.saved_queries[:]
+      affected_rows, last_insert_id = reader.affected_rows, reader.last_insert_id
+      del reader.saved_queries[:]
+      # Returned before taking the lock, which a writer statement explaining
+      # itself on a reader may hold.
+      self._idle_readers.put(reader)
+      with self._stats_lock:
+        self.last_query = last_query
+        self.saved_queries.extend(saved_queries)
+
+    with self._stats_lock:
+      self.stats["reader_queries"] += 1
+      self.affected_rows = affected_rows
+      self.last_insert_id = last_insert_id
+      self.queries_executed += 1
+    return rv
+
+  def _run_script_batch(self, statements, timeout, seconds):
+    self._acquire_writer()
+    try:
+      with self._stats_lock:
+        self.stats["writer_queries"] += len(statements)
+        return super(PooledSQLiteDb, self)._run_script_batch(statements, timeout, seconds)
+    finally:
+      self._write_lock.release()
+
+  def begin_transaction(self, isolation_level=None, read_only=False, deferrable=False):
+    self._acquire_writer()
+    try:
+      super(PooledSQLiteDb, self).begin_transaction(isolation_level, read_only, deferrable)
+    except Exception:
+      self._write_lock.release()
+      raise
+    self._transaction_thread = threading.current_thread()
+
+  def _end_transaction(self, committed):
+    with self._stats_lock:
+      super(PooledSQLiteDb, self)._end_transaction(committed)
+    self._transaction_thread = None
+    self._write_lock.release()
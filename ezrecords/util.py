@@ -2,7 +2,15 @@
 from __future__ import absolute_import, print_function, unicode_literals, with_statement
 
 import datetime
+import json
 import re
+import uuid
+from functools import lru_cache
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
 
 from ezrecords.compat import (
   PY3,
@@ -121,6 +129,158 @@ def parse_db_url(name):
     raise ValueError("Could not parse rfc1738 URL from string '%s'" % name)
 
 
+_LEADING_NOISE = re.compile(r"^(?:\s+|--[^\n]*\n?|/\*.*?\*/|\()+", re.DOTALL)
+_DDL_KEYWORDS = ("CREATE", "ALTER", "DROP", "RENAME")
+_READ_KEYWORDS = ("SELECT", "WITH", "SHOW", "EXPLAIN", "DESCRIBE", "DESC", "VALUES")
+_WRITE_MARKERS = re.compile(
+  r"\b(?:INSERT|UPDATE|DELETE|MERGE|FOR\s+UPDATE|FOR\s+SHARE|FOR\s+NO\s+KEY\s+UPDATE|"
+  r"LOCK\s+IN\s+SHARE\s+MODE|INTO)\b",
+  re.IGNORECASE,
+)
+# Literals, quoted identifiers and comments, so words inside them aren't
+# mistaken for write markers.
+_QUOTED_OR_COMMENT = re.compile(
+  r"""
+    '(?:[^']|'')*'
+  | "(?:[^"]|"")*"
+  | `[^`]*`
+  | --[^\n]*
+  | /\*.*?\*/
+  | \$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?\$(?P=tag)\$
+  """,
+  re.VERBOSE | re.DOTALL,
+)
+
+
+def is_read_statement(sql):
+  """Tells whether the SQL statement only reads data.
+
+  Leading comments and parentheses are skipped. SELECTs that lock rows
+  (`FOR UPDATE`, `FOR SHARE`), write into tables (`SELECT ... INTO`) or use
+  data-modifying CTEs are not considered reads. Literals, quoted identifiers
+  and comments are ignored when looking for those.
+
+  Args:
+      sql (str): the SQL statement
+
+  Returns:
+      bool: True if the statement can safely run on a read replica.
+  """
+  sql = _LEADING_NOISE.sub("", sql)
+  keyword = sql.split(None, 1)[0].upper() if sql else ""
+  if keyword not in _READ_KEYWORDS:
+    return False
+  return _WRITE_MARKERS.search(_QUOTED_OR_COMMENT.sub(" ", sql)) is None
+
+
+def is_ddl_statement(sql):
+  """Tells whether the SQL statement changes the schema.
+
+  Args:
+      sql (str): the SQL statement
+
+  Returns:
+      bool: True for CREATE, ALTER, DROP and RENAME statements.
+  """
+  sql = _LEADING_NOISE.sub("", sql)
+  keyword = sql.split(None, 1)[0].upper() if sql else ""
+  return keyword in _DDL_KEYWORDS
+
+
+# Literals, quoted identifiers and comments are matched as a whole so the
+# parameters inside them are left alone, as are Postgres' :: casts.
+_NAMED_PARAMS = re.compile(
+  r"""
+    '(?:[^']|'')*'
+  | "(?:[^"]|"")*"
+  | `[^`]*`
+  | --[^\n]*
+  | /\*.*?\*/
+  | \$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?\$(?P=tag)\$
+  | ::
+  | :(?P<colon>[A-Za-z_]\w*)
+  | %\((?P<pyformat>[^)]+)\)s
+  """,
+  re.VERBOSE | re.DOTALL,
+)
+
+
+@lru_cache(maxsize=512)
+def compile_named_params(sql, placeholder):
+  """Translates the `:name` and `%(name)s` parameters of a statement to
+  the driver's positional placeholder.
+
+  The result is cached per statement text, so binding values afterwards
+  is a lookup of the names in order.
+
+  Args:
+      sql (str): the SQL statement
+      placeholder (str): the driver's positional placeholder, `?` or `%s`
+
+  Returns:
+      tuple: (the translated statement, the parameter names in the order
+      their values are expected)
+
+  Examples:
+      >>> compile_named_params('SELECT * FROM t WHERE a = :a AND b > :b', '?')
+      ('SELECT * FROM t WHERE a = ? AND b > ?', ('a', 'b'))
+  """
+  names = []
+
+  def replace(match):
+    name = match.group("colon") or match.group("pyformat")
+    if name is None:
+      return match.group(0)
+    names.append(name)
+    return placeholder
+
+  return _NAMED_PARAMS.sub(replace, sql), tuple(names)
+
+
+def chunked(iterable, size):
+  """Splits an iterable into lists of at most `size` items."""
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+
+def json_default(value):
+  """Encodes the database types the json module doesn't know about.
+
+  Dates and times become ISO 8601 strings, intervals their number of
+  seconds, decimals and UUIDs strings (so no precision is lost) and binary
+  values hex strings.
+  """
+  if isinstance(value, (datetime.date, datetime.time)):
+    return value.isoformat()
+  if isinstance(value, datetime.timedelta):
+    return value.total_seconds()
+  if isinstance(value, (Decimal, uuid.UUID)):
+    return str(value)
+  if isinstance(value, (bytes, bytearray, memoryview)):
+    return bytes(value).hex()
+  raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
+
+
+def json_dumps(obj):
+  """Serializes `obj` to a compact JSON string, with orjson when installed.
+
+  See `json_default` for how dates, decimals and binary values are encoded.
+  """
+  if orjson is not None:
+    try:
+      return orjson.dumps(obj, default=json_default).decode("utf-8")
+    except TypeError:
+      # orjson refuses integers wider than 64 bits, the json module doesn't.
+      pass
+  return json.dumps(obj, default=json_default, ensure_ascii=False, separators=(",", ":"))
+
+
 def _rfc_1738_quote(text):
   return re.sub(r"[:@/]", lambda m: "%%%X" % ord(m.group(0)), text)
 
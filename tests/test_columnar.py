@@ -0,0 +1,93 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals, with_statement
+
+import ast
+import io
+import struct
+import unittest
+import zipfile
+
+from ezrecords.sqlitedb import SQLiteDb
+
+try:
+  import pyarrow
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+
+def read_npy(data):
+  """Returns the header dict and the raw data of a version 1 .npy file."""
+  (header_length,) = struct.unpack("<H", data[8:10])
+  header = ast.literal_eval(data[10 : 10 + header_length].decode("latin1"))
+  return header, data[10 + header_length :]
+
+
+class ColumnarExportTests(unittest.TestCase):
+  def setUp(self):
+    self.db = SQLiteDb(db_url="sqlite:///:memory:")
+    self.db.query(
+      """
+CREATE TABLE events AS
+WITH RECURSIVE counter(id) AS (SELECT 1 UNION ALL SELECT id + 1 FROM counter LIMIT 25)
+SELECT id, CASE WHEN id % 5 THEN 'event ' || id END AS name, id / 2.0 AS score FROM counter
+        """
+    )
+
+  def tearDown(self):
+    self.db.close()
+
+  def test_streamed_queries_fetch_rows_in_batches(self):
+    rows = self.db.query("SELECT * FROM events ORDER BY id", stream=True, batch_size=10)
+    batches = list(rows.iter_batches(10))
+
+    self.assertEqual([10, 10, 5], [len(batch) for batch in batches])
+    self.assertEqual(25, batches[-1][-1]["id"])
+    self.assertFalse(rows.pending)
+
+  def test_exports_one_npy_array_per_column(self):
+    rows = self.db.query("SELECT * FROM events ORDER BY id", stream=True, batch_size=10)
+    archive = zipfile.ZipFile(io.BytesIO(rows.export("npz", batch_size=10)))
+
+    self.assertEqual(
+      ["id.npy", "name.npy", "name__mask.npy", "score.npy"], sorted(archive.namelist())
+    )
+
+    header, data = read_npy(archive.read("id.npy"))
+    self.assertEqual((25,), header["shape"])
+    self.assertTrue(header["descr"].endswith("i8"))
+    self.assertEqual(list(range(1, 26)), list(struct.unpack("<25q", data)))
+
+    header, data = read_npy(archive.read("name.npy"))
+    self.assertTrue(header["descr"].endswith("U8"))
+    self.assertEqual("event 1", data[: 8 * 4].decode("utf-32-le").rstrip("\0"))
+
+    _, mask = read_npy(archive.read("name__mask.npy"))
+    self.assertEqual([i % 5 == 0 for i in range(1, 26)], [bool(b) for b in bytearray(mask)])
+
+  def test_exports_empty_results(self):
+    rows = self.db.query("SELECT * FROM events WHERE id < 0", stream=True)
+    self.assertEqual([], zipfile.ZipFile(io.BytesIO(rows.export("npz"))).namelist())
+
+  @unittest.skipUnless(pyarrow, "pyarrow is not installed")
+  def test_exports_parquet(self):
+    rows = self.db.query("SELECT * FROM events ORDER BY id", stream=True, batch_size=10)
+    table = pyarrow.parquet.read_table(pyarrow.BufferReader(rows.export("parquet", batch_size=10)))
+
+    self.assertEqual(25, table.num_rows)
+    self.assertEqual(["id", "name", "score"], table.column_names)
+    self.assertEqual(
+      {"id": 5, "name": None, "score": 2.5}, table.slice(4, 1).to_pylist()[0]
+    )
+
+  @unittest.skipUnless(pyarrow, "pyarrow is not installed")
+  def test_exports_arrow_streams(self):
+    rows = self.db.query("SELECT * FROM events ORDER BY id")
+    table = pyarrow.ipc.open_stream(rows.export("arrow")).read_all()
+
+    self.assertEqual(25, table.num_rows)
+    self.assertEqual(pyarrow.int64(), table.schema.field("id").type)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,94 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals, with_statement
+
+import threading
+import unittest
+
+from ezrecords.cursors import close_rows, iter_prefetched
+from ezrecords.sqlitedb import SQLiteDb
+
+
+class FakeCursor(object):
+  """Serves `rows` in batches and records the calls made to it."""
+
+  def __init__(self, rows, fail_after=None):
+    self.rows = list(rows)
+    self.fail_after = fail_after
+    self.fetches = 0
+    self.closed = False
+
+  def fetchmany(self, size):
+    self.fetches += 1
+    if self.fail_after is not None and self.fetches > self.fail_after:
+      raise IOError("connection lost")
+    batch, self.rows = self.rows[:size], self.rows[size:]
+    return [dict(row) for row in batch]
+
+  def close(self):
+    self.closed = True
+
+
+class PrefetchTests(unittest.TestCase):
+  def test_yields_every_row_and_closes_the_cursor(self):
+    cursor = FakeCursor({"id": i} for i in range(10))
+    first = cursor.fetchmany(3)
+    rows = iter_prefetched(cursor, first, 3, depth=2, converters=(("id", str),))
+
+    self.assertEqual([str(i) for i in range(10)], [row["id"] for row in rows])
+    self.assertTrue(cursor.closed)
+
+  def test_stops_fetching_when_closed_early(self):
+    cursor = FakeCursor({"id": i} for i in range(1000))
+    rows = iter_prefetched(cursor, cursor.fetchmany(10), 10, depth=1)
+
+    self.assertEqual(0, next(rows)["id"])
+    rows.close()
+    self.assertTrue(cursor.closed)
+    self.assertTrue(cursor.fetches < 10)
+
+  def test_raises_fetch_errors_to_the_caller(self):
+    cursor = FakeCursor(({"id": i} for i in range(10)), fail_after=2)
+    rows = iter_prefetched(cursor, cursor.fetchmany(2), 2)
+
+    with self.assertRaises(IOError):
+      list(rows)
+    self.assertTrue(cursor.closed)
+
+  def test_streamed_queries_can_prefetch(self):
+    db = SQLiteDb(db_url="sqlite:///:memory:")
+    try:
+      sql = "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n LIMIT 50) SELECT x FROM n"
+      rows = db.query(sql, stream=True, batch_size=7, prefetch=2)
+      self.assertEqual(list(range(1, 51)), [row.x for row in rows])
+    finally:
+      db.close()
+
+  def test_close_rows_closes_the_cursor_of_an_unstarted_generator(self):
+    cursor = FakeCursor({"id": i} for i in range(10))
+    rows = iter_prefetched(cursor, cursor.fetchmany(3), 3)
+    close_rows(rows, cursor)
+    self.assertTrue(cursor.closed)
+    self.assertEqual([], list(rows))
+
+  def test_closing_an_abandoned_stream_stops_prefetching(self):
+    db = SQLiteDb(db_url="sqlite:///:memory:")
+    try:
+      sql = "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n LIMIT 5000) SELECT x FROM n"
+      rows = db.query(sql, stream=True, batch_size=10, prefetch=1)
+      self.assertEqual(1, next(rows).x)
+      rows.close()
+      self.assertFalse(rows.pending)
+      self.assertEqual([1], [row.x for row in rows])
+      prefetching = [t for t in threading.enumerate() if t.name == "ezrecords-prefetch"]
+      self.assertEqual([], prefetching)
+
+      # Never iterated
+      rows = db.query(sql, stream=True, batch_size=10, prefetch=1)
+      rows.close()
+      self.assertEqual(1, db.get_var("SELECT 1"))
+    finally:
+      db.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
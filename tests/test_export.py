@@ -0,0 +1,66 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals, with_statement
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ezrecords.export import partitioned_export, split_range
+from ezrecords.sqlitedb import SQLiteDb
+
+
+class PartitionedExportTests(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.url = "sqlite:///" + os.path.join(self.directory, "export.db")
+    db = SQLiteDb(db_url=self.url)
+    db.query(
+      """
+CREATE TABLE events AS
+WITH RECURSIVE counter(id) AS (SELECT 1 UNION ALL SELECT id + 1 FROM counter LIMIT 100)
+SELECT id, 'event ' || id AS name FROM counter
+        """
+    )
+    db.close()
+    self.path = os.path.join(self.directory, "events")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_writes_one_shard_per_partition(self):
+    shards = partitioned_export(self.url, "events", "id", self.path, "jsonl", partitions=3)
+    self.assertEqual([34, 34, 32], [rows for _, rows in shards])
+
+    with open(shards[1][0]) as shard:
+      first = json.loads(shard.readline())
+    self.assertEqual({"id": 35, "name": "event 35"}, first)
+
+  def test_merges_shards_in_key_order(self):
+    files = partitioned_export(
+      self.url, "SELECT * FROM events WHERE id > 10", "id", self.path, partitions=4, merge=True
+    )
+    self.assertEqual([(self.path, 90)], files)
+    self.assertEqual(["events"], [f for f in os.listdir(self.directory) if f != "export.db"])
+
+    with open(self.path) as merged:
+      lines = merged.read().splitlines()
+    self.assertEqual("id,name", lines[0])
+    self.assertEqual(list(range(11, 101)), [int(line.split(",")[0]) for line in lines[1:]])
+
+  def test_sqlite_date_keys_keep_the_minimum(self):
+    db = SQLiteDb(db_url=self.url)
+    db.query("CREATE TABLE days (day DATE, n int)")
+    db.bulk_insert("days", ("day", "n"), [("2024-01-%02d" % day, day) for day in range(1, 10)])
+    db.close()
+
+    self.assertEqual(
+      [("2024-01-01", "2024-01-04"), ("2024-01-04", "2024-01-07"), ("2024-01-07", None)],
+      split_range("2024-01-01", "2024-01-09", 3),
+    )
+    files = partitioned_export(self.url, "days", "day", self.path, partitions=3, merge=True)
+    self.assertEqual([(self.path, 9)], files)
+    with open(self.path) as merged:
+      lines = merged.read().splitlines()
+    self.assertEqual("2024-01-01", lines[1].split(",")[0])
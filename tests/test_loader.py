@@ -0,0 +1,107 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals, with_statement
+
+import asyncio
+import logging
+import time
+import unittest
+
+from ezrecords.loader import AsyncLoader, Loader
+from ezrecords.sqlitedb import SQLiteDb
+
+
+class LoaderTests(unittest.TestCase):
+  def setUp(self):
+    self.db = SQLiteDb(db_url="sqlite:///:memory:", logger=logging.getLogger())
+    self.db.query("CREATE TABLE test_user (id INTEGER PRIMARY KEY, username varchar(191), team int)")
+    self.db.bulk_insert(
+      "test_user", ("id", "username", "team"), [(i, "user%s" % i, i % 2) for i in range(1, 6)]
+    )
+    self.db.queries_executed = 0
+
+  def tearDown(self):
+    self.db.close()
+
+  def test_loads_in_a_batch_with_one_query(self):
+    users = Loader(self.db, "SELECT * FROM test_user WHERE {in}", "id")
+    with users.batch():
+      first, second, missing = users.load(1), users.load(2), users.load(9)
+      self.assertFalse(first.done())
+
+    self.assertEqual("user1", first.result().username)
+    self.assertEqual("user2", second.result().username)
+    self.assertIsNone(missing.result())
+    self.assertEqual(1, self.db.queries_executed)
+
+    # Memoized
+    self.assertIs(first, users.load(1))
+    self.assertEqual(["user1", "user3"], [user.username for user in users.load_many([1, 3])])
+    self.assertEqual(2, self.db.queries_executed)
+
+  def test_results_asked_for_within_the_batch_fetch_it(self):
+    users = Loader(self.db, "SELECT * FROM test_user WHERE {in}", "id")
+    with users.batch():
+      first, second = users.load(1), users.load(2)
+      self.assertEqual("user1", first.result().username)
+      self.assertTrue(second.done())
+    self.assertEqual(1, self.db.queries_executed)
+
+  def test_loads_every_row_of_a_key(self):
+    teams = Loader(self.db, "SELECT * FROM test_user WHERE {in} ORDER BY id", "team", many=True)
+    members, nobody = teams.load_many([1, 7])
+    self.assertEqual([1, 3, 5], [user.id for user in members])
+    self.assertEqual([], nobody)
+
+  def test_failed_loads_are_not_memoized(self):
+    users = Loader(self.db, "SELECT * FROM missing_table WHERE {in}", "id")
+    with self.assertRaises(Exception):
+      with users.batch():
+        result = users.load(1)
+    with self.assertRaises(Exception):
+      result.result()
+    self.assertIsNot(result, users._cache.get(1))
+
+  def test_async_loads_in_one_tick_share_a_query(self):
+    users = AsyncLoader(self.db, "SELECT * FROM test_user WHERE {in}", "id")
+
+    async def main():
+      first, second = await asyncio.gather(users.load(1), users.load(2))
+      again = await users.load(1)
+      return first, second, again
+
+    first, second, again = asyncio.run(main())
+    self.assertEqual(["user1", "user2"], [first.username, second.username])
+    self.assertIs(first, again)
+    self.assertEqual(1, self.db.queries_executed)
+
+  def test_async_loaders_on_one_db_fetch_one_batch_at_a_time(self):
+    users = AsyncLoader(self.db, "SELECT * FROM test_user WHERE {in}", "id")
+    teams = AsyncLoader(self.db, "SELECT * FROM test_user WHERE {in}", "team", many=True)
+    self.assertIs(users._lock, teams._lock)
+
+    running = []
+    overlapped = []
+    fetch = self.db.query_in
+
+    def query_in(*args, **kwargs):
+      overlapped.append(bool(running))
+      running.append(True)
+      try:
+        time.sleep(0.05)
+        return fetch(*args, **kwargs)
+      finally:
+        running.pop()
+
+    self.db.query_in = query_in
+
+    async def main():
+      return await asyncio.gather(users.load(1), teams.load(0))
+
+    user, team = asyncio.run(main())
+    self.assertEqual("user1", user.username)
+    self.assertEqual([2, 4], sorted(member.id for member in team))
+    self.assertEqual([False, False], overlapped)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -48,9 +48,19 @@ CREATE TABLE IF NOT EXISTS test_user (
     rows = self.db.get_table_names()
     self.assertIn("test_user", map(lambda x: x.table, rows))
 
+  def test_table_metadata(self):
+    metadata = self.db.table_metadata("test_user")
+    self.assertEqual(["id", "username", "password", "created_at"], list(metadata["columns"]))
+    self.assertEqual(["id"], metadata["primary_key"])
+    self.assertIn(["username"], [index["columns"] for index in metadata["indexes"]])
+    self.assertIsNone(self.db.table_metadata("non_existing_table"))
+
   def test_can_check_for_table_existence(self):
     self.assertTrue(self.db.exists("test_user"))
     self.assertFalse(self.db.exists("non_existing_table"))
+    self.assertTrue(self.db.exists("test_user", schema="test"))
+    self.assertFalse(self.db.exists("test_user", kind="view"))
+    self.assertTrue(self.db.exists("tables", kind="view", schema="information_schema"))
 
   def test_can_switch_to_valid_charset(self):
     self.db.set_charset("UTF8")
@@ -83,6 +93,64 @@ END;
     rv = self.db.call_procedure("adds", 1, 2)
     self.assertEqual(3, rv[0]["a + b"])
 
+  def test_upsert_counts_inserted_and_updated_rows(self):
+    self.db.insert("test_user", {"username": "x", "password": "secret"})
+    counts = self.db.bulk_upsert(
+      "test_user",
+      ("username", "password"),
+      [("x", "changed"), ("y", "secret")],
+      ["username"],
+    )
+    self.assertEqual({"inserted": 1, "updated": 1}, counts)
+
+  def test_upsert_counts_unchanged_rows_as_updated(self):
+    self.db.bulk_insert("test_user", ("username", "password"), [("x", "a"), ("y", "b")])
+    counts = self.db.bulk_upsert(
+      "test_user",
+      ("username", "password"),
+      [("x", "a"), ("y", "changed"), ("z", "c")],
+      ["username"],
+    )
+    self.assertEqual({"inserted": 1, "updated": 2}, counts)
+
+  def test_bulk_update_and_delete_by_key(self):
+    self.db.bulk_insert("test_user", ("username", "password"), [("x", "a"), ("y", "b")])
+    rows = [{"username": "x", "password": "c"}, {"username": "y", "password": "d"}]
+    self.assertEqual(2, self.db.bulk_update("test_user", rows, ["username"]))
+    self.assertEqual(
+      ["c", "d"], self.db.get_col("SELECT password FROM test_user ORDER BY username")
+    )
+    self.assertEqual(2, self.db.bulk_delete("test_user", "username", ["x", "y"]))
+
+  def test_bulk_insert_returns_auto_increment_ids(self):
+    rows = [("user%s" % i, "secret") for i in range(5)]
+    ids = self.db.bulk_insert("test_user", ("username", "password"), rows, batch_size=2, returning=["id"])
+    self.assertEqual(
+      self.db.get_col("SELECT id FROM test_user ORDER BY id"), [row.id for row in ids]
+    )
+    self.assertEqual(5, self.db.affected_rows)
+
+  def test_bulk_insert_refuses_to_return_ids_with_interleaved_lock_mode(self):
+    step = self.db.get_var("SELECT @@auto_increment_increment")
+    self.db._autoinc = (2, step)
+    rows = [("user%s" % i, "secret") for i in range(3)]
+    with self.assertRaisesRegex(ValueError, "innodb_autoinc_lock_mode = 2"):
+      self.db.bulk_insert("test_user", ("username", "password"), rows, returning=["id"])
+    self.assertEqual(0, self.db.get_var("SELECT count(*) FROM test_user"))
+
+  def test_only_selects_take_a_timeout(self):
+    self.assertEqual(1, self.db.get_var("SELECT 1", timeout=5))
+    self.assertEqual(5000, self.db.get_var("SELECT @@SESSION.max_execution_time"))
+    with self.assertRaises(ValueError):
+      self.db.insert("test_user", {"username": "x", "password": "secret"}, timeout=5)
+    with self.assertRaises(ValueError):
+      self.db.executemany("DELETE FROM test_user WHERE id = %s", [(1,)], timeout=5)
+
+    # The default timeout is left to SELECTs
+    self.db.timeout = 5
+    self.db.insert("test_user", {"username": "x", "password": "secret"})
+    self.assertEqual(1, self.db.get_var("SELECT count(*) FROM test_user"))
+
   def test_transactions(self):
     self.db.begin_transaction()
     self.db.insert("test_user", {"username": "x", "password": "secret"})
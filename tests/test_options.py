@@ -0,0 +1,34 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals, with_statement
+
+import unittest
+
+from ezrecords.options import boolean, choice, non_negative, parse_options
+
+SPEC = {
+  "timeout": (non_negative(float), 10.0),
+  "compress": (boolean, False),
+  "mode": (choice("OFF", "NORMAL"), None),
+}
+
+
+class ConnectionOptionsTests(unittest.TestCase):
+  def test_converts_values_and_fills_in_defaults(self):
+    self.assertEqual(
+      {"timeout": 2.5, "compress": True, "mode": "NORMAL"},
+      parse_options({"timeout": "2.5", "compress": "yes", "mode": "normal"}, SPEC),
+    )
+    self.assertEqual({"timeout": 10.0, "compress": False, "mode": None}, parse_options(None, SPEC))
+
+  def test_rejects_unknown_options_and_invalid_values(self):
+    with self.assertRaises(ValueError) as context:
+      parse_options({"timeot": "1"}, SPEC)
+    self.assertIn("timeot", str(context.exception))
+
+    for query in ({"timeout": "-1"}, {"timeout": "soon"}, {"compress": "2"}, {"mode": "FULL"}):
+      with self.assertRaises(ValueError):
+        parse_options(query, SPEC)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,98 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals, with_statement
+
+import unittest
+
+from ezrecords.plans import (
+  parse_mysql_analyze,
+  parse_mysql_plan,
+  parse_postgres_plan,
+  parse_sqlite_plan,
+  plan_warnings,
+)
+
+
+class PlanParsingTests(unittest.TestCase):
+  def test_parses_postgres_json_plans(self):
+    raw = [
+      {
+        "Plan": {
+          "Node Type": "Hash Join",
+          "Total Cost": 35.5,
+          "Plan Rows": 10,
+          "Plans": [
+            {
+              "Node Type": "Seq Scan",
+              "Relation Name": "orders",
+              "Total Cost": 20.0,
+              "Plan Rows": 10,
+              "Filter": "(status = 'open'::text)",
+            },
+            {
+              "Node Type": "Index Scan",
+              "Relation Name": "users",
+              "Index Name": "users_pkey",
+              "Total Cost": 8.3,
+              "Plan Rows": 1,
+            },
+          ],
+        }
+      }
+    ]
+    nodes = parse_postgres_plan(raw)
+
+    self.assertEqual(["Hash Join", "Seq Scan", "Index Scan"], [n["operation"] for n in nodes])
+    self.assertEqual([0, 1, 1], [n["depth"] for n in nodes])
+    self.assertEqual("users_pkey", nodes[2]["index"])
+    self.assertEqual(
+      ["Missing index: full scan of 'orders' filtered by (status = 'open'::text)."],
+      plan_warnings(nodes),
+    )
+
+  def test_parses_mysql_json_plans(self):
+    raw = """{"query_block": {"select_id": 1, "ordering_operation": {"using_filesort": true,
+      "nested_loop": [
+        {"table": {"table_name": "orders", "access_type": "ALL", "rows_examined_per_scan": 900,
+                   "cost_info": {"prefix_cost": "92.25"}, "attached_condition": "(`orders`.`status` = 'open')"}},
+        {"table": {"table_name": "users", "access_type": "eq_ref", "key": "PRIMARY",
+                   "rows_examined_per_scan": 1, "cost_info": {"prefix_cost": "407.25"}}}
+      ]}}}"""
+    nodes, warnings = parse_mysql_plan(raw)
+
+    self.assertEqual(["orders", "users"], [n["table"] for n in nodes])
+    self.assertEqual([True, False], [n["full_scan"] for n in nodes])
+    self.assertEqual(900, nodes[0]["rows"])
+    self.assertEqual("PRIMARY", nodes[1]["index"])
+    self.assertEqual(["Sort without an index (filesort)."], warnings)
+    self.assertTrue(plan_warnings(nodes)[0].startswith("Missing index: full scan of 'orders'"))
+
+  def test_parses_mysql_analyze_trees(self):
+    text = (
+      "-> Filter: (orders.status = 'open')  (cost=92.25 rows=90) "
+      "(actual time=0.05..0.61 rows=42 loops=1)\n"
+      "    -> Table scan on orders  (cost=92.25 rows=900) "
+      "(actual time=0.04..0.50 rows=900 loops=1)\n"
+    )
+    nodes = parse_mysql_analyze(text)
+
+    self.assertEqual([0, 1], [n["depth"] for n in nodes])
+    self.assertEqual(42, nodes[0]["actual_rows"])
+    self.assertEqual("orders", nodes[1]["table"])
+    self.assertEqual("(orders.status = 'open')", nodes[1]["filter"])
+
+  def test_parses_sqlite_query_plans(self):
+    rows = [
+      (2, 0, 0, "SCAN orders"),
+      (4, 0, 0, "SEARCH users USING AUTOMATIC COVERING INDEX (id=?)"),
+      (7, 0, 0, "USE TEMP B-TREE FOR ORDER BY"),
+    ]
+    nodes, warnings = parse_sqlite_plan(rows)
+
+    self.assertEqual([True, False, False], [n["full_scan"] for n in nodes])
+    self.assertEqual(["Full scan of 'orders'."], plan_warnings(nodes))
+    self.assertEqual(2, len(warnings))
+    self.assertTrue(warnings[0].startswith("Missing index"))
+
+
+if __name__ == "__main__":
+  unittest.main()
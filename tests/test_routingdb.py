@@ -0,0 +1,106 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals, with_statement
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from ezrecords.routingdb import RoutingDatabase
+
+
+class RoutingDatabaseTests(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.urls = [
+      "sqlite:///" + os.path.join(self.directory, name)
+      for name in ("primary.db", "replica1.db", "replica2.db")
+    ]
+    logger = logging.getLogger()
+    self.db = RoutingDatabase(self.urls[0], self.urls[1:], logger=logger)
+
+    # Tag each server so tests can tell where a read was served from.
+    for server, database in [("primary", self.db.primary)] + [
+      ("replica%s" % (i + 1), replica) for i, replica in enumerate(self.db.replicas)
+    ]:
+      database.query("CREATE TABLE server AS SELECT '%s' AS name" % server)
+
+  def tearDown(self):
+    self.db.close()
+    shutil.rmtree(self.directory)
+
+  def test_reads_are_balanced_across_replicas(self):
+    names = [self.db.get_var("SELECT name FROM server") for _ in range(4)]
+    self.assertEqual(["replica1", "replica2", "replica1", "replica2"], names)
+    self.assertEqual(4, self.db.stats["replica_queries"])
+
+  def test_writes_and_transactions_go_to_the_primary(self):
+    self.db.begin_transaction()
+    self.assertEqual("primary", self.db.get_var("SELECT name FROM server"))
+    self.db.update("server", {"name": "written"}, {"name": "primary"})
+    self.db.commit()
+
+    self.assertEqual("written", self.db.primary.get_var("SELECT name FROM server"))
+    self.assertEqual(2, self.db.stats["primary_queries"])
+
+  def test_reads_stick_to_the_primary_after_writes(self):
+    self.db.sticky_window = 60
+    self.assertEqual("replica1", self.db.get_var("SELECT name FROM server"))
+    self.db.insert("server", name="another")
+    self.assertEqual("primary", self.db.get_var("SELECT name FROM server"))
+
+  def test_reads_stick_to_the_primary_after_bulk_writes(self):
+    self.db.sticky_window = 60
+    self.db.primary.query("CREATE UNIQUE INDEX server_name ON server (name)")
+    script = os.path.join(self.directory, "script.sql")
+    with open(script, "w") as file_handle:
+      file_handle.write("INSERT INTO server VALUES ('scripted');\n")
+
+    writes = [
+      lambda: self.db.bulk_insert("server", ("name",), [("bulk",)]),
+      lambda: self.db.executemany("INSERT INTO server VALUES (?)", [("many",)]),
+      lambda: self.db.bulk_upsert("server", ("name",), [("upserted",)], ["name"], []),
+      lambda: self.db.run_script(script),
+    ]
+    for write in writes:
+      self.db._last_write = None
+      write()
+      self.assertEqual("primary", self.db.get_var("SELECT name FROM server"))
+    self.assertEqual(0, self.db.stats["replica_queries"])
+
+  def test_unhealthy_replicas_are_closed(self):
+    replica = self.db.replicas[0]
+    replica._connection.close()
+    closed = []
+
+    def close():
+      closed.append(replica)
+      raise RuntimeError("already closed")
+
+    replica.close = close
+    self.assertEqual([False, True], self.db.check_replicas())
+    self.assertIsNone(self.db.replicas[0])
+    self.assertEqual([replica], closed)
+
+  def test_unhealthy_replicas_are_skipped(self):
+    self.db.replicas[0].close()
+    self.db.balancing = "least_latency"
+    self.assertEqual([False, True], self.db.check_replicas())
+    self.assertEqual("replica2", self.db.get_var("SELECT name FROM server"))
+
+  def test_writes_use_the_primarys_dialect_hooks(self):
+    for database in [self.db.primary] + self.db.replicas:
+      database.query("CREATE TABLE users (id INTEGER PRIMARY KEY, name varchar(191))")
+    self.db.insert("users", id=1, name="scott")
+
+    # The replicas have no users, counting them there would report inserts.
+    counts = self.db.bulk_upsert("users", ("id", "name"), [(1, "lion"), (2, "jones")], ["id"])
+    self.assertEqual({"inserted": 1, "updated": 1}, counts)
+    self.assertEqual(1, self.db.bulk_update("users", [{"id": 1, "name": "tiger"}], ["id"]))
+    self.assertEqual("tiger", self.db.primary.get_var("SELECT name FROM users WHERE id = 1"))
+
+    self.db.sticky_window = 60
+    pages = list(self.db.iter_pages("users", "id", page_size=1))
+    self.assertEqual([[1], [2]], [[row.id for row in page] for page in pages])
+    self.assertEqual(0, self.db.stats["replica_queries"])
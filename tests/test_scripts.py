@@ -0,0 +1,70 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals, with_statement
+
+import unittest
+
+from ezrecords.scripts import split_statements
+
+
+def split(script, **kwargs):
+  return [sql for _, sql in split_statements(script.splitlines(True), **kwargs)]
+
+
+class SplitStatementsTest(unittest.TestCase):
+  def test_splits_on_the_delimiter(self):
+    self.assertEqual(
+      ["CREATE TABLE t (a int)", "INSERT INTO t\nVALUES (1)"],
+      split("CREATE TABLE t (a int);\nINSERT INTO t\nVALUES (1);\n\n;"),
+    )
+    self.assertEqual(["SELECT 1", "SELECT 2"], split("SELECT 1; SELECT 2"))
+
+  def test_delimiters_in_literals_and_comments_are_ignored(self):
+    script = """INSERT INTO t VALUES ('a;b', 'it''s; fine', "c;d");
+-- a comment; with a delimiter
+/* a block;
+   comment */ SELECT `e;f` FROM t;
+-- only a comment;
+"""
+    statements = split(script)
+    self.assertEqual(2, len(statements))
+    self.assertTrue(statements[0].startswith("INSERT INTO t VALUES ('a;b', 'it''s; fine', \"c;d\")"))
+    self.assertTrue(statements[1].endswith("SELECT `e;f` FROM t"))
+
+  def test_dollar_quoted_bodies_are_kept_whole(self):
+    script = """CREATE FUNCTION f() RETURNS int AS $body$
+BEGIN
+  RETURN 1;
+END;
+$body$ LANGUAGE plpgsql;
+DO $$ BEGIN PERFORM 1; END $$;
+"""
+    statements = split(script)
+    self.assertEqual(2, len(statements))
+    self.assertIn("RETURN 1;", statements[0])
+
+  def test_delimiter_command_changes_the_delimiter(self):
+    script = """DELIMITER //
+CREATE PROCEDURE p()
+BEGIN
+  SELECT 1;
+END //
+DELIMITER ;
+CALL p();
+"""
+    statements = split(script, dollar_quotes=False)
+    self.assertEqual(["CREATE PROCEDURE p()\nBEGIN\n  SELECT 1;\nEND", "CALL p()"], statements)
+
+  def test_mysql_syntax(self):
+    script = "INSERT INTO t VALUES ('a\\';b'); # a comment;\nSELECT 1;"
+    self.assertEqual(
+      ["INSERT INTO t VALUES ('a\\';b')", "# a comment;\nSELECT 1"],
+      split(script, backslash_escapes=True, hash_comments=True),
+    )
+
+  def test_yields_the_line_each_statement_starts_on(self):
+    lines = "-- header\n\nSELECT 1;\nSELECT\n2;".splitlines(True)
+    self.assertEqual([3, 4], [line for line, _ in split_statements(lines)])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,66 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals, with_statement
+
+import logging
+import unittest
+
+from ezrecords.shardeddb import ShardedDatabase
+
+
+class ShardedDatabaseTests(unittest.TestCase):
+  def setUp(self):
+    logger = logging.getLogger()
+    self.db = ShardedDatabase(
+      {"odd": "sqlite:///:memory:", "even": "sqlite:///:memory:"},
+      router=lambda tenant_id: "odd" if tenant_id % 2 else "even",
+      key_column="tenant_id",
+      logger=logger,
+    )
+    for shard in self.db.shards.values():
+      shard.query("CREATE TABLE invoice (tenant_id int, total int)")
+
+    self.db.bulk_insert(
+      "invoice", ("tenant_id", "total"), [(1, 10), (2, 40), (3, 30), (4, 20), (5, None)]
+    )
+
+  def tearDown(self):
+    self.db.close()
+
+  def test_rows_are_written_to_their_shard(self):
+    self.assertEqual(3, self.db.shards["odd"].get_var("SELECT count(*) FROM invoice"))
+    self.assertEqual(2, self.db.shards["even"].get_var("SELECT count(*) FROM invoice"))
+
+    self.db.insert("invoice", tenant_id=6, total=60)
+    self.assertEqual(60, self.db.get_row(6, "SELECT * FROM invoice WHERE tenant_id = 6").total)
+
+    self.assertEqual(1, self.db.update("invoice", {"total": 11}, {"tenant_id": 1}))
+    self.assertEqual(1, self.db.delete("invoice", tenant_id=2))
+    self.assertEqual(0, self.db.shards["even"].get_var("SELECT count(*) FROM invoice WHERE tenant_id = 2"))
+
+    with self.assertRaises(ValueError):
+      self.db.insert("invoice", total=1)
+
+  def test_bulk_insert_returns_rows_in_input_order(self):
+    rows = self.db.bulk_insert(
+      "invoice", ("tenant_id", "total"), [(7, 70), (8, 80), (9, 90)], returning=["tenant_id", "total"]
+    )
+    self.assertEqual([(7, 70), (8, 80), (9, 90)], [(row.tenant_id, row.total) for row in rows])
+
+  def test_bulk_insert_rejects_rows_routed_to_unknown_shards(self):
+    self.db.router = lambda tenant_id: "odd" if tenant_id % 2 else "gone"
+    with self.assertRaisesRegex(ValueError, "unknown shard 'gone'"):
+      self.db.bulk_insert("invoice", ("tenant_id", "total"), [(7, 70), (8, 80)])
+    self.assertEqual(3, self.db.shards["odd"].get_var("SELECT count(*) FROM invoice"))
+
+  def test_queries_are_gathered_from_all_shards(self):
+    rows = self.db.query("SELECT * FROM invoice")
+    self.assertEqual(5, len(rows.all()))
+
+    rows = self.db.query("SELECT * FROM invoice", order_by="-total", limit=3)
+    self.assertEqual([40, 30, 20], [row.total for row in rows])
+
+    rows = self.db.query("SELECT * FROM invoice", order_by="total")
+    self.assertEqual([10, 20, 30, 40, None], [row.total for row in rows])
+
+    rows = self.db.query("SELECT * FROM invoice", key=2)
+    self.assertEqual([2, 4], [row.tenant_id for row in rows])
@@ -2,11 +2,19 @@
 from __future__ import absolute_import, print_function, unicode_literals, with_statement
 
 import datetime
+import io
+import json
 import logging
 import os
+import shutil
+import sqlite3
+import sys
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
-from ezrecords.sqlitedb import SQLiteDb
+from ezrecords.exceptions import QueryTimeoutError, ScriptError
+from ezrecords.sqlitedb import PooledSQLiteDb, SQLiteDb, store_datetimes_as_iso
 
 class SQLiteDbTests(unittest.TestCase):
   def setUp(self):
@@ -70,6 +78,48 @@ CREATE TABLE test_user (
       2, self.db.bulk_insert("test_user", columns_as_list, rows_as_lists_tuple)
     )
 
+  def test_bulk_insert_returns_generated_ids_in_order(self):
+    rows = [("user%s" % i, "secret") for i in range(7)]
+    ids = self.db.bulk_insert(
+      "test_user", ("username", "password"), rows, batch_size=3, returning=["id", "username"]
+    )
+    self.assertEqual(list(range(1, 8)), [row.id for row in ids])
+    self.assertEqual("user6", ids[6].username)
+    self.assertEqual(7, self.db.stats["last_bulk"]["rows"])
+    self.assertEqual(7, self.db.affected_rows)
+
+  def test_upsert(self):
+    self.db.insert("test_user", username="abc", password="secret")
+
+    self.assertEqual(
+      {"inserted": 0, "updated": 1},
+      self.db.upsert("test_user", {"username": "abc", "password": "new"}, ["username"]),
+    )
+    self.assertEqual("new", self.db.get_var("SELECT password FROM test_user"))
+
+    counts = self.db.bulk_upsert(
+      "test_user",
+      ("username", "password"),
+      [("abc", "newer"), ("def", "secret"), ("ghi", "secret")],
+      ["username"],
+      batch_size=2,
+    )
+    self.assertEqual({"inserted": 2, "updated": 1}, counts)
+    self.assertEqual(3, self.db.affected_rows)
+
+    counts = self.db.bulk_upsert(
+      "test_user", ("username", "password"), [("abc", "newer"), ("mno", "x")], ["username"]
+    )
+    self.assertEqual({"inserted": 1, "updated": 1}, counts)
+
+    counts = self.db.bulk_upsert(
+      "test_user", ("username", "password"), [("abc", "x"), ("jkl", "x")], ["username"], []
+    )
+    self.assertEqual({"inserted": 1, "updated": 0}, counts)
+    self.assertEqual(
+      "newer", self.db.get_var("SELECT password FROM test_user WHERE username = 'abc'")
+    )
+
   def test_update(self):
     self.db.insert("test_user", username="abc", password="secret")
     self.assertEqual(
@@ -79,11 +129,111 @@ CREATE TABLE test_user (
       0, self.db.update("test_user", {"password": "None"}, {"username": None})
     )
 
+  def test_dml_statements_are_built_once_per_column_set(self):
+    self.db.insert("test_user", username="abc", password="secret")
+    self.db.insert("test_user", {"password": "secret", "username": "def"})
+    self.assertEqual(
+      "INSERT INTO test_user (username, password) VALUES (?, ?)", self.db.last_query
+    )
+    self.db.update("test_user", {"password": "new"}, {"username": "abc"})
+    self.db.update("test_user", {"password": None}, {"username": "def"})
+    self.assertEqual(2, len(self.db._dml_templates))
+
+    self.assertEqual(["abc", "def"], self.db.get_col("SELECT username FROM test_user ORDER BY id"))
+    self.assertEqual("new", self.db.get_var("SELECT password FROM test_user WHERE id = 1"))
+
+    with self.assertRaises(ValueError):
+      self.db.insert("test_user", username="ghi", pasword="typo")
+
+  def test_bulk_update(self):
+    self.db.bulk_insert(
+      "test_user", ("id", "username", "password"), [(1, "abc", "x"), (2, "def", "x"), (3, "ghi", "x")]
+    )
+    rows = [
+      {"id": 1, "username": "abc", "password": "one"},
+      {"id": 3, "username": "ghi", "password": "three"},
+      {"id": 4, "username": "jkl", "password": "missing"},
+    ]
+    self.assertEqual(2, self.db.bulk_update("test_user", rows, ["id"]))
+    self.assertEqual(
+      ["one", "x", "three"], self.db.get_col("SELECT password FROM test_user ORDER BY id")
+    )
+    self.assertEqual(3, self.db.stats["last_bulk"]["rows"])
+    self.assertEqual(2, self.db.stats["last_bulk"]["affected_rows"])
+
+    rows = [{"id": 1, "username": "abc"}, {"id": 2, "Username": "def"}]
+    with self.assertRaisesRegex(ValueError, "'Username'"):
+      self.db.bulk_update("test_user", rows, ["id"])
+    rows = [{"id": 1, "username": "abc"}, {"username": "def", "password": "x"}]
+    with self.assertRaisesRegex(ValueError, "'id'"):
+      self.db.bulk_update("test_user", rows, ["id"])
+
+  def test_bulk_delete(self):
+    self.db.bulk_insert(
+      "test_user", ("id", "username"), [(i, "user%s" % i) for i in range(1, 11)]
+    )
+    self.assertEqual(5, self.db.bulk_delete("test_user", "id", [2, 4, 6, 8, 10, 12], batch_size=4))
+    self.assertEqual([1, 3, 5, 7, 9], self.db.get_col("SELECT id FROM test_user ORDER BY id"))
+    self.assertEqual("bulk_delete", self.db.stats["last_bulk"]["operation"])
+
+  def test_query_in_pads_lists_to_a_few_statements(self):
+    self.db.bulk_insert(
+      "test_user", ("id", "username"), [(i, "user%s" % i) for i in range(1, 11)]
+    )
+    rows = self.db.query_in(
+      "SELECT id FROM test_user WHERE username != ? AND {in} AND id < ? ORDER BY id",
+      "id",
+      [1, 2, 3, 9],
+      "user2",
+      9,
+    )
+    self.assertEqual([1, 3], [row.id for row in rows])
+
+    rows = self.db.query_in("SELECT id FROM test_user WHERE {in} ORDER BY id", "id", [1, 2, 3])
+    self.assertEqual([1, 2, 3], [row.id for row in rows])
+    self.assertIn('"id" IN (?, ?, ?, ?)', self.db.last_query)
+    self.assertEqual([], self.db.query_in("SELECT id FROM test_user WHERE {in}", "id", []).all())
+
+  def test_query_in_splits_lists_past_the_parameter_limit(self):
+    self.db.bulk_insert(
+      "test_user", ("id", "username"), [(i, "user%s" % i) for i in range(1, 11)]
+    )
+    self.db._max_params = 5
+    rows = self.db.query_in("SELECT id FROM test_user WHERE {in}", "id", range(1, 12))
+    self.assertEqual(list(range(1, 11)), sorted(row.id for row in rows))
+    self.assertIn('"id" IN (?, ?, ?, ?)', self.db.last_query)
+
+    self.db.query_in("DELETE FROM test_user WHERE username != ? AND {in}", "id", range(7), "user1")
+    self.assertEqual(5, self.db.affected_rows)
+
+  def test_query_in_binds_long_lists_as_json(self):
+    self.db.bulk_insert(
+      "test_user", ("id", "username"), [(i, "user%s" % i) for i in range(1, 11)]
+    )
+    names = ["user%s" % i for i in range(1000)]
+    rows = self.db.query_in("SELECT id FROM test_user WHERE {in}", "username", names)
+    self.assertEqual(10, len(rows.all()))
+    if sqlite3.sqlite_version_info >= (3, 38, 0):
+      self.assertIn("json_each", self.db.last_query)
+
   def test_delete(self):
     self.db.insert("test_user", username="abc", password="secret")
     self.assertEqual(1, self.db.delete("test_user", {"username": "abc"}))
     self.assertEqual(0, self.db.delete("test_user", {"username": None}))
 
+  def test_iter_pages(self):
+    self.db.bulk_insert(
+      "test_user", ("id", "username", "password"), [(i, "user%02d" % i, str(i % 3)) for i in range(1, 11)]
+    )
+
+    pages = [[row.id for row in page] for page in self.db.iter_pages("test_user", "id", 4)]
+    self.assertEqual([[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]], pages)
+
+    rows = self.db.iter_pages(
+      "SELECT id, password FROM test_user", ["password", "id"], 3, after=("1", 4), records=True
+    )
+    self.assertEqual([7, 10, 2, 5, 8], [row.id for row in rows])
+
   def test_get_var(self):
     var = self.db.get_var("SELECT 1 + 1 as x")
     self.assertEqual(2, var)
@@ -130,11 +280,58 @@ CREATE TABLE test_user (
     self.db.query("INSERT INTO numbers (integers, floats) VALUES (%d, %f)", 3, 3.14)
     self.db.query("DROP TABLE IF EXISTS numbers")
 
+  def test_named_params_are_bound_by_name(self):
+    self.db.insert("test_user", username="abc", password="secret")
+    row = self.db.query(
+      "SELECT * FROM test_user WHERE username = :name AND password = %(password)s",
+      params={"name": "abc", "password": "secret"},
+      one=True,
+    )
+    self.assertEqual("abc", row.username)
+
+    with self.assertRaises(ValueError):
+      self.db.query("SELECT * FROM test_user WHERE username = :name", params={})
+    with self.assertRaises(ValueError):
+      self.db.query("SELECT * FROM test_user WHERE username = :name", "abc", params={})
+
   def test_files_queries_are_executed(self):
     query_file_path = os.path.join(os.path.dirname(__file__), "sample_query.sql")
     rv = self.db.query_file(query_file_path, one=True)
     self.assertEqual(1, rv["maximum"])
 
+  def test_scripts_run_in_batches_and_resume_after_failures(self):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "script.sql")
+    with io.open(path, "w", encoding="utf-8") as script:
+      script.write(
+        """-- Seed
+CREATE TABLE counts (n int);
+CREATE TRIGGER count_users AFTER INSERT ON test_user
+BEGIN
+  INSERT INTO counts VALUES (NEW.id);
+END;
+INSERT INTO test_user (id, username) VALUES (1, 'a;b');
+INSERT INTO test_user (id, username) VALUES (2, 'c');
+INSERT INTO test_user (id, username) VALUES (1, 'duplicate');
+INSERT INTO test_user (id, username) VALUES (3, 'd');
+"""
+      )
+    try:
+      with self.assertRaises(ScriptError) as context:
+        self.db.run_script(path, batch_size=2)
+      error = context.exception
+      self.assertEqual((5, 9, 5), (error.statement, error.line, error.resume_from))
+      self.assertEqual(["a;b", "c"], self.db.get_col("SELECT username FROM test_user ORDER BY id"))
+      self.assertEqual(2, self.db.get_var("SELECT count(*) FROM counts"))
+
+      self.db.query("DELETE FROM test_user WHERE id = 1")
+      with self.db.transaction():
+        timings = self.db.run_script(path, start=error.resume_from)
+      self.assertEqual([5, 6], [number for number, _ in timings])
+      self.assertEqual(3, self.db.get_var("SELECT count(*) FROM test_user"))
+    finally:
+      shutil.rmtree(directory)
+
   def test_when_inserting_records_last_auto_increment_value(self):
     self.db.insert(
       "test_user", username="abc", password="secret", created_at=datetime.datetime.now()
@@ -176,6 +373,48 @@ CREATE TABLE test_user (
     rows = self.db.query("SELECT * FROM test_user")
     self.assertIsNotNone(rows.dataset)
 
+  def test_datetimes_are_stored_as_unix_timestamps(self):
+    created_at = datetime.datetime(2020, 1, 2, 3, 4, 5)
+    self.db.insert("test_user", username="abc", password="secret", created_at=created_at)
+    self.assertEqual(
+      int(created_at.timestamp()), self.db.get_var("SELECT created_at FROM test_user")
+    )
+    self.db.insert("test_user", username="def", password="secret", created_at=created_at.date())
+    self.assertEqual(
+      "2020-01-02", self.db.get_var("SELECT created_at FROM test_user WHERE username = 'def'")
+    )
+
+  def test_datetimes_can_be_stored_as_iso_8601(self):
+    created_at = datetime.datetime(2020, 1, 2, 3, 4, 5)
+    store_datetimes_as_iso()
+    try:
+      self.db.insert("test_user", username="abc", password="secret", created_at=created_at)
+    finally:
+      store_datetimes_as_iso(False)
+    self.assertEqual(
+      "2020-01-02T03:04:05", self.db.get_var("SELECT created_at FROM test_user")
+    )
+    self.assertEqual(
+      "2020-01-02", self.db.get_var("SELECT date(created_at) FROM test_user")
+    )
+
+  def test_json_serialization(self):
+    self.db.insert("test_user", username="abc", password="secret")
+    self.db.insert("test_user", username="def", password="secret")
+    sql = "SELECT id, username, created_at FROM test_user ORDER BY id"
+
+    expected = [
+      {"id": 1, "username": "abc", "created_at": None},
+      {"id": 2, "username": "def", "created_at": None},
+    ]
+    rows = self.db.query(sql)
+    self.assertEqual(expected, json.loads(rows.to_json()))
+    self.assertEqual('<Record {"id":2,"username":"def","created_at":null}>', repr(rows[1]))
+
+    stream = io.StringIO()
+    self.db.query(sql, stream=True, batch_size=1).to_json(stream=stream, lines=True)
+    self.assertEqual(expected, [json.loads(line) for line in stream.getvalue().splitlines()])
+
   # Driver Specific
   # ---
 
@@ -196,6 +435,64 @@ CREATE TABLE test_user (
     self.assertTrue(self.db.exists("test_user"))
     self.assertFalse(self.db.exists("non_existing_table"))
 
+  def test_exists_looks_up_other_kinds_and_schemas(self):
+    self.db.query("CREATE VIEW test_user_names AS SELECT username FROM test_user")
+    self.assertTrue(self.db.exists("test_user_names", kind="view"))
+    self.assertFalse(self.db.exists("test_user", kind="view"))
+    self.assertTrue(self.db.exists("test_user", schema="main"))
+    self.assertFalse(self.db.exists("test_user_names", kind="table", schema="main"))
+    self.assertFalse(self.db.exists("test_user", schema="temp"))
+    with self.assertRaises(ValueError):
+      self.db.exists("test_user", kind="sequence")
+
+  def test_caches_table_metadata(self):
+    metadata = self.db.table_metadata("test_user")
+    self.assertEqual(["id", "username", "password", "created_at"], list(metadata["columns"]))
+    self.assertEqual("TIMESTAMP", metadata["columns"]["created_at"])
+    self.assertEqual(["id"], metadata["primary_key"])
+    self.assertEqual(
+      [{"name": "sqlite_autoindex_test_user_1", "columns": ["username"], "unique": True}],
+      metadata["indexes"],
+    )
+
+    queries_executed = self.db.queries_executed
+    self.assertTrue(self.db.exists("test_user"))
+    self.db.table_metadata("test_user")
+    self.assertEqual(queries_executed + 1, self.db.queries_executed)
+
+    # DDL run through query() invalidates the cache.
+    self.db.query("CREATE INDEX test_user_created_at ON test_user (created_at)")
+    self.assertEqual(2, len(self.db.table_metadata("test_user")["indexes"]))
+    self.db.query("CREATE TABLE test_group (id INTEGER PRIMARY KEY)")
+    self.assertTrue(self.db.exists("test_group"))
+    self.db.query("DROP TABLE test_group")
+    self.assertFalse(self.db.exists("test_group"))
+
+  def test_rollback_only_clears_the_metadata_cache_after_ddl(self):
+    self.db.table_metadata("test_user")
+    self.db.begin_transaction()
+    self.db.insert("test_user", {"username": "x", "password": "secret"})
+    self.db.rollback()
+    queries_executed = self.db.queries_executed
+    self.db.table_metadata("test_user")
+    self.assertEqual(queries_executed, self.db.queries_executed)
+
+    self.db.begin_transaction()
+    self.db.query("CREATE TABLE test_group (id INTEGER PRIMARY KEY)")
+    self.assertTrue(self.db.exists("test_group"))
+    self.db.rollback()
+    self.assertFalse(self.db.exists("test_group"))
+
+    with self.db.transaction():
+      try:
+        with self.db.transaction():
+          self.db.query("CREATE TABLE test_group (id INTEGER PRIMARY KEY)")
+          self.assertTrue(self.db.exists("test_group"))
+          raise RuntimeError()
+      except RuntimeError:
+        pass
+      self.assertFalse(self.db.exists("test_group"))
+
   def test_can_switch_to_valid_charsets(self):
     self.db.set_charset("UTF-8")
     self.db.set_charset("UTF-16")
@@ -226,5 +523,226 @@ CREATE TABLE test_user (
     self.db.commit()
     self.assertEqual(1, self.db.get_var("SELECT count(*) as x FROM test_user"))
 
+  def test_nested_transactions_use_savepoints(self):
+    with self.db.transaction():
+      self.db.insert("test_user", {"username": "x", "password": "secret"})
+      with self.assertRaises(ValueError):
+        with self.db.transaction():
+          self.db.insert("test_user", {"username": "y", "password": "secret"})
+          raise ValueError("undo y only")
+
+    self.assertEqual(["x"], self.db.get_col("SELECT username FROM test_user"))
+    self.assertFalse(self.db.in_transaction)
+    self.assertEqual(1, self.db.stats["transactions"])
+
+    with self.assertRaises(ValueError):
+      with self.db.transaction():
+        self.db.insert("test_user", {"username": "z", "password": "secret"})
+        raise ValueError("undo everything")
+
+    self.assertEqual(1, self.db.get_var("SELECT count(*) as x FROM test_user"))
+    self.assertEqual(1, self.db.stats["rollbacks"])
+
+  def test_savepoint_errors_dont_hide_the_original_one(self):
+    query = self.db.query
+    savepoint_statements = []
+
+    def aborted(sql, *args, **kwargs):
+      if sql.startswith(("ROLLBACK TO", "RELEASE")):
+        savepoint_statements.append(sql.split(" SAVEPOINT")[0])
+        raise sqlite3.OperationalError("current transaction is aborted")
+      return query(sql, *args, **kwargs)
+
+    self.db.query = aborted
+    with self.assertRaises(ValueError):
+      with self.db.transaction():
+        with self.db.transaction():
+          raise ValueError("deadlock")
+    self.assertEqual(["ROLLBACK TO"], savepoint_statements)
+    self.assertFalse(self.db.in_transaction)
+
+  def test_read_only_transactions_reject_writes(self):
+    with self.assertRaises(Exception):
+      with self.db.transaction(read_only=True):
+        self.db.insert("test_user", {"username": "x", "password": "secret"})
+
+    self.db.insert("test_user", {"username": "x", "password": "secret"})
+    with self.assertRaises(ValueError):
+      self.db.begin_transaction(isolation_level="snapshot")
+
+  def test_retries_transactions_when_the_database_is_locked(self):
+    attempts = []
+
+    def add_user(db):
+      db.insert("test_user", {"username": "x%s" % len(attempts), "password": "secret"})
+      attempts.append(1)
+      if len(attempts) < 3:
+        raise sqlite3.OperationalError("database is locked")
+      return len(attempts)
+
+    self.assertEqual(3, self.db.run_in_transaction(add_user, backoff=0, name="add_user"))
+    self.assertEqual(["x2"], self.db.get_col("SELECT username FROM test_user"))
+    self.assertEqual({"add_user": 2}, self.db.stats["transaction_retries"])
+
+    del attempts[:]
+    with self.assertRaises(sqlite3.OperationalError):
+      self.db.run_in_transaction(add_user, retries=1, backoff=0)
+    with self.assertRaises(ZeroDivisionError):
+      self.db.run_in_transaction(lambda db: 1 / 0, backoff=0)
+    self.assertEqual(1, self.db.get_var("SELECT count(*) FROM test_user"))
+
+  def test_measures_connect_latency(self):
+    self.assertEqual(1, self.db.stats["connections"])
+    self.assertTrue(self.db.stats["last_connect_seconds"] > 0)
+
+    self.db.query("SELECT 1")
+    self.assertEqual(1, self.db.stats["connections"])
+
+  def test_applies_connection_options_from_the_url(self):
+    db = SQLiteDb(db_url="sqlite:///:memory:?cache_size=-4000&synchronous=normal&busy_timeout=250")
+    try:
+      self.assertEqual(-4000, db.get_var("PRAGMA cache_size"))
+      self.assertEqual(1, db.get_var("PRAGMA synchronous"))
+      self.assertEqual(250, db.get_var("PRAGMA busy_timeout"))
+    finally:
+      db.close()
+
+    with self.assertRaises(ValueError):
+      SQLiteDb(db_url="sqlite:///:memory:?page_size=1000")
+
+  def test_writes_outside_transactions_are_committed(self):
+    directory = tempfile.mkdtemp()
+    url = "sqlite:///" + os.path.join(directory, "autocommit.db")
+    writer = SQLiteDb(db_url=url)
+    reader = SQLiteDb(db_url=url)
+    try:
+      writer.query("CREATE TABLE t (id INTEGER PRIMARY KEY)")
+      writer.insert("t", {"id": 1})
+      self.assertEqual(1, reader.get_var("SELECT count(*) FROM t"))
+    finally:
+      writer.close()
+      reader.close()
+      shutil.rmtree(directory)
+
   def test_warns_for_multiple_statements(self):
     pass
+
+  def test_explain_flags_full_scans(self):
+    plan = self.db.explain("SELECT * FROM test_user WHERE password = ?", "secret")
+    self.assertTrue(plan["nodes"][0]["full_scan"])
+    self.assertEqual(["Full scan of 'test_user'."], plan["warnings"])
+
+    plan = self.db.explain("SELECT * FROM test_user WHERE username = ?", "abc")
+    self.assertEqual("sqlite_autoindex_test_user_1", plan["nodes"][0]["index"])
+    self.assertEqual([], plan["warnings"])
+
+  def test_slow_queries_are_explained(self):
+    self.db.slow_query_threshold = 0
+    self.db.query("SELECT * FROM test_user WHERE password = ?", "secret")
+
+    self.assertEqual(1, self.db.stats["slow_queries"])
+    slow_query = self.db.slow_queries[-1]
+    self.assertEqual("SELECT * FROM test_user WHERE password = ?", slow_query["sql"])
+    self.assertEqual(["Full scan of 'test_user'."], slow_query["plan"]["warnings"])
+    self.assertEqual("SELECT * FROM test_user WHERE password = ?", self.db.last_query)
+
+  def test_slow_queries_are_explained_in_a_savepoint_within_transactions(self):
+    statements = []
+    query = self.db.query
+
+    def recording(sql, *args, **kwargs):
+      statements.append(sql)
+      return query(sql, *args, **kwargs)
+
+    def failing_explain(sql, args, analyze, timeout):
+      raise sqlite3.OperationalError("no such table")
+
+    self.db.query = recording
+    self.db._explain = failing_explain
+    self.db.slow_query_threshold = 0
+    with self.db.transaction():
+      self.db.insert("test_user", {"username": "x", "password": "secret"})
+
+    self.assertIn("ROLLBACK TO SAVEPOINT ezrecords_1", statements)
+    self.assertIsNone(self.db.slow_queries[-1]["plan"])
+    self.assertEqual(1, self.db.get_var("SELECT count(*) FROM test_user"))
+
+  def test_long_running_queries_time_out(self):
+    endless = """
+WITH RECURSIVE counter(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM counter)
+SELECT count(*) FROM counter
+        """
+    with self.assertRaises(QueryTimeoutError):
+      self.db.query(endless, timeout=0.1)
+
+    self.db.timeout = 0.1
+    with self.assertRaises(QueryTimeoutError):
+      self.db.get_var(endless)
+
+    self.assertEqual(2, self.db.stats["queries_timed_out"])
+    self.assertEqual(2, self.db.get_var("SELECT 1 + 1 as x"))
+
+
+class PooledSQLiteDbTests(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.url = "sqlite:///" + os.path.join(self.directory, "pooled.db")
+    self.db = PooledSQLiteDb(self.url + "?busy_timeout=100", readers=2)
+    self.db.query("CREATE TABLE test_user (id INTEGER PRIMARY KEY, username varchar(191))")
+
+  def tearDown(self):
+    self.db.close()
+    shutil.rmtree(self.directory)
+
+  def test_reads_go_to_readers_and_writes_to_the_writer(self):
+    self.db.insert("test_user", id=1, username="abc")
+    self.db.flush()
+    self.assertEqual("abc", self.db.get_var("SELECT username FROM test_user"))
+    self.db.query("UPDATE test_user SET username = 'def'")
+
+    self.assertEqual(1, self.db.stats["writer_queries"])
+    self.assertEqual(1, self.db.stats["reader_queries"])
+    with self.assertRaises(sqlite3.OperationalError):
+      self.db.readers[0].query("DELETE FROM test_user")
+
+  def test_reads_run_in_parallel(self):
+    self.db.bulk_insert("test_user", ("id", "username"), [(i, "user%s" % i) for i in range(100)])
+
+    def count():
+      return self.db.get_var("SELECT count(*) FROM test_user")
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+      counts = list(executor.map(lambda _: count(), range(20)))
+    self.assertEqual([100] * 20, counts)
+
+  def test_stats_count_every_query_from_concurrent_threads(self):
+    self.db.insert("test_user", id=1, username="abc")
+    self.db.flush()
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+      with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: self.db.get_var("SELECT 1"), range(2000)))
+    finally:
+      sys.setswitchinterval(interval)
+    self.assertEqual(2000, self.db.stats["reader_queries"])
+    self.assertEqual(2000, self.db.queries_executed)
+
+  def test_transactions_hold_the_writer(self):
+    with self.db.transaction():
+      self.db.insert("test_user", id=1, username="abc")
+      # The transaction's own reads see its writes, other threads don't.
+      self.assertEqual(1, self.db.get_var("SELECT count(*) FROM test_user"))
+      with ThreadPoolExecutor(max_workers=1) as executor:
+        self.assertEqual(
+          0, executor.submit(self.db.get_var, "SELECT count(*) FROM test_user").result()
+        )
+        insert = executor.submit(self.db.insert, "test_user", id=2, username="def")
+        with self.assertRaises(sqlite3.OperationalError):
+          insert.result()
+
+    self.assertEqual([1], self.db.get_col("SELECT id FROM test_user"))
+
+  def test_requires_a_database_file(self):
+    with self.assertRaises(ValueError):
+      PooledSQLiteDb("sqlite:///:memory:")
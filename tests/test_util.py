@@ -1,6 +1,9 @@
+import datetime
+import json
 import unittest
 
-from ezrecords.util import parse_db_url
+from ezrecords import util
+from ezrecords.util import compile_named_params, is_read_statement, json_dumps, parse_db_url
 
 
 class UtilTest(unittest.TestCase):
@@ -18,3 +21,41 @@ class UtilTest(unittest.TestCase):
     parse_db_url("sqlite:///:memory:")  # memory
     parse_db_url("sqlite:///random.db")  # relative
     parse_db_url("sqlite:////random.db")  # absolute
+
+  def test_compiles_named_params_to_positional_placeholders(self):
+    self.assertEqual(
+      ("SELECT * FROM t WHERE a = ? AND b = ? OR a = ?", ("a", "b", "a")),
+      compile_named_params("SELECT * FROM t WHERE a = :a AND b = %(b)s OR a = :a", "?"),
+    )
+
+  def test_named_params_skip_literals_comments_and_casts(self):
+    sql = """SELECT ':a', ":b", $$:c$$, $f$:d$f$, x::int -- :e
+    /* :f */ FROM t WHERE y = :y"""
+    compiled, names = compile_named_params(sql, "%s")
+    self.assertEqual(("y",), names)
+    self.assertEqual(sql.replace(":y", "%s"), compiled)
+
+  def test_named_params_are_compiled_once_per_statement(self):
+    compile_named_params.cache_clear()
+    compile_named_params("SELECT :a", "?")
+    compile_named_params("SELECT :a", "?")
+    self.assertEqual(1, compile_named_params.cache_info().hits)
+
+  def test_read_statements_ignore_keywords_in_literals_and_identifiers(self):
+    self.assertTrue(is_read_statement("SELECT * FROM t WHERE note = 'update'"))
+    self.assertTrue(is_read_statement('SELECT "into", `delete` FROM t -- for update'))
+    self.assertTrue(is_read_statement("/* insert */ SELECT $$merge$$ /* into */"))
+    self.assertFalse(is_read_statement("SELECT * INTO t2 FROM t WHERE note = 'x'"))
+    self.assertFalse(is_read_statement("SELECT * FROM t WHERE note = 'it''s' FOR UPDATE"))
+    self.assertFalse(is_read_statement("WITH d AS (DELETE FROM t RETURNING *) SELECT * FROM d"))
+    self.assertFalse(is_read_statement("UPDATE t SET note = 'select'"))
+
+  def test_json_dumps_encodes_intervals_as_seconds(self):
+    value = {"elapsed": datetime.timedelta(days=1, seconds=1, microseconds=500000)}
+    self.assertEqual({"elapsed": 86401.5}, json.loads(json_dumps(value)))
+
+    orjson, util.orjson = util.orjson, None
+    try:
+      self.assertEqual({"elapsed": 86401.5}, json.loads(json_dumps(value)))
+    finally:
+      util.orjson = orjson